@@ -1,46 +1,306 @@
 import xarray as xr
 import pandas as pd
-from datetime import datetime
 import numpy as np
 
 import matplotlib.pyplot as plt
 import plotly.graph_objects as go
 import cartopy.crs as ccrs
 import matplotlib as mpl
+import io
+import tempfile
+import calendar
+import json
 from cartopy.io.shapereader import natural_earth, Reader
 import math
+from functools import lru_cache
 
-from shiny import App, ui, reactive, render
+from shiny import App, ui, reactive, render, req
 import shinyswatch
 from shinywidgets import output_widget, render_widget
 
 import folium
 
+from apic_derive import monthly_fname, prec_fname, product_fname, find_year_end
+from apic_data import open_cube, decode, land_cells, pack, unpack, nearest_cell, to_cells, period_mean, prec_sums, prefix_sums, custom_window
+from apic_data import annual_values, interannual_sd, lru_cache_bytes, monthly_climatology, calendar_anomalies
+from apic_surfaces import lmwl_fits, LMWL_METHODS, trend_fits, seasonal_cycle, bivariate_probability, gaussian_probability
+from apic_surfaces import index_series, index_at_resolution, index_correlation
+from apic_surfaces import sample_table, batch_matches, match_frequency, credible_region, closest_cells, year_match_bits, match_count, matching_years
+from apic_geo import geotiff_stream, mask_polygons, geojson_stream, cell_areas, region_index, region_summary
+from apic_geo import read_geojson, points_inside
+from apic_extract import TIME_RES, is_valid_point, is_annual, extract_point, extract_all, point_frame, filter_dates, long_frame, with_anomalies
+from apic_extract import csv_chunks, csv_filename, window_label, zip_stream, table_stream, download_frame, dataset_metadata
+from apic_extract import csv_metadata, netcdf_stream, ROW_GROUP, ANNUAL_RES, open_resolution
+
 # adjust directory as necessary
 fpath = ""
 #fpath = "C:/Users/georg/Dropbox/~python_working/aus_isotopes/shiny_app/APIC_shiny_app/"
 
+# compact mode holds the cubes in memory as stored (int16 isotopes if written with
+# `apic_derive.py quantise`, otherwise float32) and decodes them only where calculations need it
+compact = False
+
+# memory allowed for cached mean surfaces (spatial searches and isoscapes, shared by all sessions)
+surface_cache_mb = 64
+# and for rendered isoscape images
+image_cache_mb = 32
+# and for the running sums behind custom running means and seasons (float64, so each isotope's take
+# several times the memory of its cube; the prec sums shared by the isotopes are held once, apart)
+prefix_cache_mb = 256
+# and for the gridded custom running means and seasons themselves
+window_cache_mb = 64
+# and for whole-record values at the resolutions read from file (trends, correlations, anomalies)
+series_cache_mb = 128
+
+# first and last year of the record (the last year follows the newest monthly files, so the
+# app picks up records extended with `apic_derive.py update`)
+year_first = 1962
+year_last = find_year_end(f"{fpath}netcdfs", year_first)
+
+# helper function to get the path of a derived product
+def product_path(iso, product):
+    return f"{fpath}netcdfs/{product_fname(iso, product, year_first, year_last)}"
+
+# long-term mean (calendar year)
+d2H_mean = open_cube(product_path("d2H", "ltm"), compact)
+d18O_mean = open_cube(product_path("d18O", "ltm"), compact)
+dxs_mean = open_cube(product_path("dxs", "ltm"), compact)
+
+# most of the grid is ocean: the searches and monthly extractions work on packed (time, cell) arrays
+# of the land cells only, and results are scattered back onto the grid for plotting
+cells = land_cells(decode(d2H_mean.d2Hp).notnull())
+d2H_mean_pk = pack(d2H_mean.d2Hp, cells)
+d18O_mean_pk = pack(d18O_mean.d18Op, cells)
+dxs_mean_pk = pack(dxs_mean.dxsp, cells)
+
 # monthly data
-d2H = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_196201-202312_monthly_median.nc")
-d18O = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_196201-202312_monthly_median.nc")
-dxs = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_196201-202312_monthly_median.nc")
+d2H = pack(open_cube(f"{fpath}netcdfs/{monthly_fname('d2H', year_first, year_last)}", compact).d2Hp, cells)
+d18O = pack(open_cube(f"{fpath}netcdfs/{monthly_fname('d18O', year_first, year_last)}", compact).d18Op, cells)
+dxs = pack(open_cube(f"{fpath}netcdfs/{monthly_fname('dxs', year_first, year_last)}", compact).dxsp, cells)
 
 # annual data (Jan-Dec)
-d2H_ann = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_1962-2023_ann_median.nc")
-d18O_ann = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_1962-2023_ann_median.nc")
-dxs_ann = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_1962-2023_ann_median.nc")
+d2H_ann = pack(open_cube(product_path("d2H", "ann"), compact).d2Hp, cells)
+d18O_ann = pack(open_cube(product_path("d18O", "ann"), compact).d18Op, cells)
+dxs_ann = pack(open_cube(product_path("dxs", "ann"), compact).dxsp, cells)
 
 years_cal = d2H_ann.time.dt.year.values
 
 # we'll also need the precipitation amount data for if users want to specific time periods
-prec = xr.open_dataset(f"{fpath}netcdfs/prec/aus_prec_v1_195901-202312_monthly_1.nc")
-prec = prec["prec"].sel(time=slice("1962-01-01", None))
-
-# long-term mean (calendar year)
-d2H_mean = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_1962-2023_long-term-annual-mean_median.nc")
-d18O_mean = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_1962-2023_long-term-annual-mean_median.nc")
-dxs_mean = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_1962-2023_long-term-annual-mean_median.nc")
+prec = open_cube(f"{fpath}netcdfs/{prec_fname(year_last)}", compact)
+prec = pack(prec["prec"].sel(time=slice(f"{year_first}-01-01", None)), cells)
+
+# area (km2) of each land cell, for the matched-area summaries
+cell_area_km2 = cell_areas(cells.lat, float(cells.grid_lat[1] - cells.grid_lat[0]), float(cells.grid_lon[1] - cells.grid_lon[0]))
+
+# state/territory outlines (the Natural Earth outlines drawn on the maps), and the state/territory of
+# each land cell, rasterised once (the first time it is needed)
+@lru_cache(maxsize=None)
+def get_states():
+    states_shp = natural_earth(resolution='10m',category='cultural',name='admin_1_states_provinces')
+    states = [rec for rec in Reader(states_shp).records() if rec.attributes.get('admin') == 'Australia']
+    return [rec.attributes.get('name') for rec in states], [rec.geometry for rec in states]
+
+@lru_cache(maxsize=None)
+def get_state_index():
+    names, geoms = get_states()
+    return names, region_index(cells.lat, cells.lon, geoms)
+
+# land cells of a search region, cached by region: a (lat_min, lat_max, lon_min, lon_max) box, a
+# state/territory name, or the path of an uploaded GeoJSON polygon
+@lru_cache(maxsize=16)
+def get_region_cells(kind, key):
+    if kind == "bbox":
+        lat_min, lat_max, lon_min, lon_max = key
+        inside = (cells.lat >= lat_min) & (cells.lat <= lat_max) & (cells.lon >= lon_min) & (cells.lon <= lon_max)
+    elif kind == "state":
+        names, index = get_state_index()
+        inside = index == names.index(key)
+    else:
+        inside = points_inside(cells.lat, cells.lon, read_geojson(key))
+    return np.flatnonzero(inside)
+
+# packed monthly cubes and long-term means by isotope system
+monthly_pk = {"d2H": d2H, "d18O": d18O, "dxs": dxs}
+mean_pk = {"d2H": d2H_mean_pk, "d18O": d18O_mean_pk, "dxs": dxs_mean_pk}
+ann_pk = {"d2H": d2H_ann, "d18O": d18O_ann, "dxs": dxs_ann}
+
+# running sums of prec along time for every land cell, shared by the three isotope systems (a
+# single entry, so it is held in a cache of its own rather than counted against each isotope)
+@lru_cache_bytes(prefix_cache_mb * 2**20)
+def get_prec_sums():
+    return prec_sums(decode(prec).values.astype(np.float64))
+
+# running sums of prec*value and valid-month counts along time for a packed monthly cube. They are
+# several times the size of the cube, so only these are kept within the prefix_cache_mb budget
+@lru_cache_bytes(prefix_cache_mb * 2**20)
+def get_isotope_sums(iso):
+    cs_pd, _, cs_n = prefix_sums(decode(monthly_pk[iso]).values.astype(np.float64), decode(prec).values,
+                                 get_prec_sums())
+    return cs_pd, cs_n
+
+# all three running sums for an isotope: any averaging window is then a difference of two rows,
+# whatever its length
+def get_prefix_sums(iso):
+    cs_pd, cs_n = get_isotope_sums(iso)
+    return cs_pd, get_prec_sums(), cs_n
+
+# user-defined running means and seasons for every land cell, cached by window definition (`start`
+# is 1 for running means, which it does not affect) within the window_cache_mb budget
+@lru_cache_bytes(window_cache_mb * 2**20)
+def get_custom_window(iso, kind, length, start):
+    labels, vals = custom_window(get_prefix_sums(iso), d2H.time.values, kind, length, start)
+    return labels, vals.astype(np.float32)
+
+# user-defined running means and seasons of every isotope system at one land cell, from that cell's
+# monthly values only. Returns the labels and {isotope: values}
+def custom_point(cell, kind, length, start):
+    p = decode(prec[:, [cell]]).values.astype(np.float64)
+    cs_p = prec_sums(p)
+    out = {}
+    for iso in monthly_pk:
+        d = decode(monthly_pk[iso][:, [cell]]).values.astype(np.float64)
+        labels, vals = custom_window(prefix_sums(d, p, cs_p), d2H.time.values, kind, length, start)
+        out[iso] = vals[:, 0].astype(np.float32)
+    return labels, out
+
+# mean surface (over the land cells) of a spatial search or isoscape, cached by its parameters
+# (positionally, with the region always given so both share entries): searches that only change the
+# sample value, offset or range reuse it and just redo the threshold. With a search
+# region (see get_region_cells) only its cells are computed, and the rest are NaN
+@lru_cache_bytes(surface_cache_mb * 2**20)
+def get_mean_surface(iso, search_type, year_start, year_end, months, region=None):
+    sel = slice(None) if region is None else get_region_cells(*region)
+    if search_type == "Long-term mean":
+        vals = decode(mean_pk[iso]).values[sel].astype(np.float64)
+    else:
+        # amount-weighted mean over the chosen years and months
+        vals = period_mean(monthly_pk[iso][:, sel], prec[:, sel], year_start, year_end, list(months))
+    if region is None:
+        return vals
+    out = np.full(len(cells.index), np.nan)
+    out[sel] = vals
+    return out
+
+# amount-weighted means of the chosen months in every year (year, cell), cached per isotope, month
+# subset and search region. For whole years these are the annual (Jan-Dec) cubes. With a region only
+# its cells are computed, and only they are returned (in the order of get_region_cells)
+@lru_cache(maxsize=8)
+def get_annual_values(iso, months, region=None):
+    sel = slice(None) if region is None else get_region_cells(*region)
+    if sorted(months) == list(range(1, 13)):
+        return years_cal, decode(ann_pk[iso][:, sel]).values
+    years, vals = annual_values(monthly_pk[iso][:, sel], prec[:, sel], list(months))
+    return years, vals.astype(np.float32)
+
+# interannual standard deviation of those annual values over a range of years, over the land cells
+# (NaN outside the search region, if there is one)
+@lru_cache(maxsize=16)
+def get_interannual_sd(iso, months, year_start, year_end, region=None):
+    years, vals = get_annual_values(iso, months, region)
+    sd = interannual_sd(vals[(years >= year_start) & (years <= year_end)])
+    if region is None:
+        return sd
+    out = np.full(len(cells.index), np.nan)
+    out[get_region_cells(*region)] = sd
+    return out
+
+# amount-weighted monthly climatology (12, cell) of one isotope system over the whole record,
+# computed the first time it is needed and then shared by all sessions
+@lru_cache(maxsize=None)
+def get_climatology(iso):
+    return monthly_climatology(monthly_pk[iso], prec)
+
+# seasonal cycle of every land cell (amplitude and month of the most depleted values), from the
+# cached climatology, cached per isotope
+@lru_cache(maxsize=None)
+def get_seasonality(iso):
+    return seasonal_cycle(get_climatology(iso))
+
+# anomaly surface at one time step of any point-extraction resolution (`custom` is the window for
+# "custom", else None). Monthly anomalies are from the climatology; the other resolutions' from the
+# mean of their values in the same calendar month (so annual and seasonal values, from their
+# long-term mean). `month` is ignored for values stored by year
+@lru_cache(maxsize=24)
+def get_anomaly_surface(iso, time_res, custom, year, month):
+    if time_res == "custom":
+        times, vals = get_custom_window(iso, *custom)
+    else:
+        times, vals = get_resolution_values(iso, time_res)
+    times = pd.DatetimeIndex(times)
+    at = times.year == year
+    if not is_annual(time_res, custom):
+        at &= times.month == month
+    req(at.any())
+    row = np.flatnonzero(at)[0]
+    if time_res == "monthly":
+        return vals[row].astype(np.float64) - get_climatology(iso)[month - 1]
+    same = np.flatnonzero(times.month == times[row].month)
+    return calendar_anomalies(vals[same], times[same])[same == row][0]
+
+# mean annual precipitation (mm) of each land cell, for offsets modelled on precipitation amount
+@lru_cache(maxsize=None)
+def get_mean_annual_prec():
+    return 12 * decode(prec).mean("time").values.astype(np.float64)
+
+# an uploaded offset surface (the `offset` variable, or else the first variable of a netcdf file)
+# at the land cells, cached by file
+@lru_cache(maxsize=4)
+def get_offset_upload(path):
+    with xr.open_dataset(path) as ds:
+        name = "offset" if "offset" in ds.data_vars else list(ds.data_vars)[0]
+        return to_cells(ds[name].load(), cells)
+
+# values (time, cell) of one isotope system at any stored resolution (monthly, annual, seasonal or
+# running means), with their time stamps. Annual and seasonal values are stamped in the year each
+# starts in. The monthly and annual cubes are already in memory, so only the others are cached
+def get_resolution_values(iso, time_res):
+    if time_res in ("monthly", "ann"):
+        da = (monthly_pk if time_res == "monthly" else ann_pk)[iso]
+        return da.time.values, decode(da).values
+    return get_stored_values(iso, time_res)
+
+# the other resolutions, read from file and cached within the series_cache_mb budget
+@lru_cache_bytes(series_cache_mb * 2**20)
+def get_stored_values(iso, time_res):
+    da = pack(open_resolution(fpath, iso, time_res)[f"{iso}p"], cells)
+    return da.time.values, decode(da).values
+
+# per-cell trends over a range of years, cached per isotope, resolution and period
+@lru_cache(maxsize=16)
+def get_trends(iso, time_res, year_start, year_end):
+    times, vals = get_resolution_values(iso, time_res)
+    years = pd.DatetimeIndex(times).year.values
+    keep = (years >= year_start) & (years <= year_end)
+    return trend_fits(years[keep], vals[keep])
+
+# correlation maps of an uploaded index series (csv at `path`) with one isotope system, at lags of
+# 0..max_lag time steps (index leading), cached by file and settings
+@lru_cache(maxsize=8)
+def get_index_correlation(path, iso, time_res, max_lag):
+    series = index_at_resolution(index_series(pd.read_csv(path, comment="#")), time_res)
+    times, vals = get_resolution_values(iso, time_res)
+    times = pd.DatetimeIndex(times)
+    lags = list(range(max_lag + 1))
+    # the index at each lag, aligned with the isotope values' time axis (by year for the annual and
+    # seasonal values, by month otherwise)
+    if time_res in ANNUAL_RES:
+        x = np.column_stack([series.reindex(times.year - lag).values for lag in lags])
+    else:
+        months = times.to_period("M").to_timestamp()
+        x = np.column_stack([series.reindex(months - pd.DateOffset(months=lag)).values for lag in lags])
+    if not np.isfinite(x[:, 0]).any():
+        raise ValueError("the index does not overlap the isotope record")
+    return index_correlation(x, vals, lags)
+
+# local meteoric water lines for every land cell, fitted to the monthly data the first time they
+# are needed and then shared by all sessions
+@lru_cache(maxsize=None)
+def get_lmwl_fits():
+    return lmwl_fits(d18O, d2H, prec)
    
+month_choices = {"1": "Jan", "2": "Feb", "3": "Mar", "4": "Apr", "5": "May", "6": "Jun",
+                 "7": "Jul", "8": "Aug", "9": "Sep", "10": "Oct", "11": "Nov", "12": "Dec"}
+
 # define pop-up information windows
 modal_ts = ui.modal(
     ui.markdown(
@@ -51,10 +311,16 @@ modal_ts = ui.modal(
         <br><br>All running means are the average of <i>n</i> months up to and including the index month (i.e., right-aligned). 
         For values averaged over July-June and December-February, the year index applies to the calendar year at the <i>start</i> of the 
         averaging period (e.g., the 1990 DJF values represent December 1990 and January-February 1991).
+        <br><br>With `Custom window` you can choose any running mean length (e.g., 9 or 24 months), or a season of any number of 
+        consecutive months (e.g., November-March), which is labelled by its first month.
         <br><br>Timeseries of the δ²H, δ¹⁸O, and <i>dxs</i> values will appear in the window to the right, at the selected temporal resolution. 
         Below is a map showing the location of your lat/lon selection (check that it is where you expect!), and a local meteoric water line for that location. 
         <b>If you update any of the parameters you will need to click the `Extract and plot values` button again to re-calculate the values</b>. 
-        You can download the data to a csv file by clicking the button below the timeseries plot. 
+        You can download the data to a csv file by clicking the button below the timeseries plot, or download every temporal resolution 
+        for the location at once (as a ZIP of csv files or a single Parquet file) with the `Download all resolutions` button. 
+        <br><br>Tick `Plot anomalies` to plot departures from the mean of each calendar month instead (anomaly columns are also added 
+        to the download). Monthly anomalies are from the amount-weighted monthly climatology of the whole record; annual, seasonal 
+        and running-mean anomalies are from the long-term mean of the values at that resolution.
         <br><br> It is important to note that these are modelled values, not primary observations.
         """
     ),
@@ -68,14 +334,32 @@ modal_ts = ui.modal(
 )
 modal_spatial = ui.modal(
     ui.markdown(
-        """To identify possible source regions for a sample, choose an isotope system and enter the value.
+        f"""To identify possible source regions for a sample, choose an isotope system and enter the value.
         If the measured material was not precipitation (or you haven't already calculated an equivalent source water value), you can enter 
         an expected offset and this will be applied to your sample value. You can also enter an expected range (uncertainty) around your specific value 
-        (the default is +/- 2‰ but you should almost certaintly change this - it can also be zero).
-        <br><br>You can choose to search for potential location matches in the long-term (1962-2023) mean <i>or</i> over a particular time period. The latter is useful if 
+        (the default is +/- 2‰ but you should almost certaintly change this - it can also be zero). The locations whose values are 
+        closest to your (offset) value are also listed below the map, and can be downloaded. Where the offset varies with climate 
+        (e.g. for tissue or groundwater samples), it can instead be modelled as a linear function of mean annual precipitation, or 
+        uploaded as a netcdf file with an `offset` variable on a latitude/longitude grid; it is then applied location by location.
+        <br><br>If you only need part of the continent, choose a search region (a latitude/longitude box, a state or territory, or a 
+        polygon uploaded as GeoJSON): only locations inside it are searched, and the map zooms to it.
+        <br><br>The probability search instead scores every location by how likely your value is to have come from there, combining your measurement 
+        uncertainty (1σ) with the year-to-year variability of each location's amount-weighted mean over the chosen years and months.
+        <br><br>If you have measured both δ²H and δ¹⁸O, the joint search scores every location by how likely both values are to have come from there, 
+        given their uncertainties (1σ), if known the covariance of the two measurement errors, and optionally the year-to-year variability. 
+        Both probability searches give a map of relative probability that sums to one over the continent.
+        <br><br>To search for many samples at once, choose the batch search and upload a csv table with a `value` column and, optionally, 
+        `sample`, `isotope` (d2H, d18O or dxs), `offset` and `range` columns; the inputs on this page are used where these are missing. 
+        The map then shows the fraction of samples matching each location, and the per-sample matches can be downloaded as NetCDF or a table.
+        <br><br>The matching years search compares your value and range with each year's amount-weighted mean (of the chosen months) 
+        instead of the mean over all years, and maps the number of years in which each location matches. Click a location on the map 
+        to list its matching years.
+        <br><br>You can choose to search for potential location matches in the long-term ({year_first}-{year_last}) mean <i>or</i> over a particular time period. The latter is useful if 
         you have an idea of when your sample might have formed. If you need a more tailored search, please consider working with the raw data 
         files (see link in the sidebar).
-        <br><br>After entering your parameters and clicking `Find my sample`, a map will appear showing your results.
+        <br><br>After entering your parameters and clicking `Find my sample`, a map will appear showing your results. The map can be downloaded 
+        for use in GIS software as NetCDF, GeoTIFF, or GeoJSON polygons outlining the matching locations (for the probability searches, 
+        the smallest area holding 95% of the probability).
         <br><br> It is important to note that these are modelled values, not primary observations.
         """
     ),
@@ -89,12 +373,93 @@ modal_spatial = ui.modal(
 )
 modal_isoscape = ui.modal(
     ui.markdown(
-        """These maps show the precipitation amount-weighted long-term (1962-2023) annual mean δ²H<sub>P</sub>, δ¹⁸O<sub>P</sub>, and <i>dxs</i><sub>P</sub>
+        f"""These maps show the precipitation amount-weighted long-term ({year_first}-{year_last}) annual mean δ²H<sub>P</sub>, δ¹⁸O<sub>P</sub>, and <i>dxs</i><sub>P</sub>
          values across the Australian continent.
+        <br><br>You can also map the amount-weighted mean of any range of years and any months (e.g. a season). Each year's 
+        selected months are weighted by their precipitation amounts, and the years are then averaged. The difference between 
+        two such periods (e.g. 1991-2023 minus 1962-1990, or one season minus another) can also be mapped, as can the anomaly 
+        at any one time step of the timeseries resolutions: a month (from the amount-weighted climatology of that calendar month), 
+        or a year, season, or running or custom mean (from the long-term mean of those values in the same calendar month).
+        <br><br> It is important to note that these are modelled values, not primary observations.
+        """
+    ),
+    title = "Isoscapes",
+    easy_close = True,
+    footer = ui.div(ui.div(
+        ui.modal_button("Close window"),
+        class_="text-center"),
+        class_="w-100"),
+    size = "xl"
+)
+
+modal_correlation = ui.modal(
+    ui.markdown(
+        """Upload a climate index series (e.g. ENSO, IOD or SAM) as a csv file with a `date` column (or `year` and, for monthly 
+        values, `month` columns) and a `value` column, to map its correlation with precipitation δ²H<sub>P</sub>, δ¹⁸O<sub>P</sub>, 
+        or <i>dxs</i><sub>P</sub> in every grid cell. A monthly index is averaged over the same months as the chosen values 
+        (e.g. December to February for DJF), so it can be used at any resolution; an annual index can be used with the annual 
+        and seasonal values. With a lag, the index leads the isotope values by that many months (or years).
+        <br><br>Locations where the correlation is not significant are shown in grey. The significance test does not allow for 
+        autocorrelation, which is strong in the running means.
+        <br><br> It is important to note that these are modelled values, not primary observations.
+        """
+    ),
+    title = "Index correlations",
+    easy_close = True,
+    footer = ui.div(ui.div(
+        ui.modal_button("Close window"),
+        class_="text-center"),
+        class_="w-100"),
+    size = "xl"
+)
+
+modal_trends = ui.modal(
+    ui.markdown(
+        f"""These maps show the linear trend (per decade) of the annual or seasonal amount-weighted δ²H<sub>P</sub>, δ¹⁸O<sub>P</sub>, 
+        or <i>dxs</i><sub>P</sub> values in every grid cell over the chosen years ({year_first}-{year_last} at most). The Theil-Sen slope 
+        (the median of the slopes between all pairs of years) is robust to outlying years; the ordinary least squares (OLS) slope is 
+        also available. Locations without a significant monotonic trend in a Mann-Kendall test are shown in grey.
         <br><br> It is important to note that these are modelled values, not primary observations.
         """
     ),
-    title = "Long-term mean annual isoscapes",
+    title = "Trends",
+    easy_close = True,
+    footer = ui.div(ui.div(
+        ui.modal_button("Close window"),
+        class_="text-center"),
+        class_="w-100"),
+    size = "xl"
+)
+
+modal_seasonality = ui.modal(
+    ui.markdown(
+        f"""These maps show the seasonal cycle of δ²H<sub>P</sub>, δ¹⁸O<sub>P</sub>, or <i>dxs</i><sub>P</sub> in every grid cell, from its 
+        precipitation amount-weighted monthly climatology ({year_first}-{year_last}): the seasonal amplitude, and the month of the most 
+        depleted (lowest) values. The harmonic fit uses the annual cycle (a sine wave) fitted to the twelve monthly means, so it is 
+        less sensitive to a single unusual month; the range uses the highest and lowest monthly means directly.
+        <br><br> It is important to note that these are modelled values, not primary observations.
+        """
+    ),
+    title = "Seasonality",
+    easy_close = True,
+    footer = ui.div(ui.div(
+        ui.modal_button("Close window"),
+        class_="text-center"),
+        class_="w-100"),
+    size = "xl"
+)
+
+modal_lmwl = ui.modal(
+    ui.markdown(
+        f"""These maps show the parameters of local meteoric water lines (δ²H = slope × δ¹⁸O + intercept) fitted to the
+        monthly precipitation δ²H and δ¹⁸O values ({year_first}-{year_last}) in every grid cell. You can choose between an ordinary least
+        squares fit (OLS), a reduced major axis fit (RMA), and a precipitation amount-weighted least squares fit, which gives
+        more weight to the months that contribute most of the annual precipitation.
+        <br><br>The same local fit is shown for your selected location on the `Extract timeseries` page.
+        <br><br> It is important to note that these are modelled values, not primary observations.
+        """
+    ),
+    title = "Local meteoric water line parameters",
     easy_close = True,
     footer = ui.div(ui.div(
         ui.modal_button("Close window"),
@@ -146,8 +511,8 @@ app_ui = ui.page_fluid(
 
     ui.div(
         ui.markdown(
-            """This online calculator allows users to extract modelled precipitation isotope δ²H, δ¹⁸O, and <i>dxs</i> values 
-             for any location on the Australian continent, within the time period January 1962 to December 2023. 
+            f"""This online calculator allows users to extract modelled precipitation isotope δ²H, δ¹⁸O, and <i>dxs</i> values 
+             for any location on the Australian continent, within the time period January {year_first} to December {year_last}. 
              <br><br>The first two tabs below are for different data extraction types: timeseries or location search. On the `Extract timeseries` page 
              you can enter a location (latitude and
              longitude), choose a temporal resolution and optional date range, then view and download the precipitation isotope δ²H, δ¹⁸O, and <i>dxs</i> values 
@@ -155,7 +520,10 @@ app_ui = ui.page_fluid(
              can enter a δ²H, δ¹⁸O, or <i>dxs</i> value as well as an optional expected offest from precipitation δ²H/δ¹⁸O/<i>dxs</i> and time period of interest. 
              You will then see a map of locations where that sample could have come from. 
              <br><br>The third tab provides simple maps of long-term mean precipitation δ²H/δ¹⁸O/<i>dxs</i> values across the continent 
-             (equivalent to previously-published long-term mean isoscapes).
+             (equivalent to previously-published long-term mean isoscapes), and the fourth maps the slope, intercept and fit of 
+             local meteoric water lines across the continent. The 'Seasonality' tab maps the amplitude of the seasonal cycle and 
+             its most depleted month, 'Index correlations' maps the correlation of precipitation δ²H/δ¹⁸O/<i>dxs</i> with a climate index 
+             series that you upload, and 'Trends' maps the change in values over a chosen range of years.
              <br><br>When choosing a tab, an information window will appear with further important details. To make the information window reappear, click the relevant tab. 
              <br><br>If using data from this online calculator, please cite 
              the <a href="https://egusphere.copernicus.org/preprints/2025/egusphere-2025-2458/" target="_blank">original publication</a>. Please also see the 
@@ -189,11 +557,21 @@ app_ui = ui.page_fluid(
                     ui.input_numeric("lat", "Latitude (decimal degrees)", min=-45, max=-10, value=-28),
                     ui.input_numeric("lon", "Longitude (decimal degrees)", min=112, max=154, value=134),
                     ui.input_select("time_res", "Temporal resolution",
-                    choices = {"monthly": "Monthly", "ann": "Annual (Jan-Dec)", "ann_trop":"Annual (Jul-Jun)",
-                           "DJF":"Annual (DJF)", "MAM":"Annual (MAM)", "JJA":"Annual (JJA)",
-                           "SON":"Annual (SON)", "3mrm":"3-month running mean", "6mrm":"6-month running mean",
-                           "12mrm":"12-month running mean"},
-                    selected="monthly")
+                    choices = TIME_RES,
+                    selected="monthly"),
+                    # any running mean length, or any run of consecutive months as a 'season'
+                    ui.panel_conditional("input.time_res === 'custom'",
+                        ui.input_radio_buttons("custom_kind", "Custom window",
+                                               choices = {"running": "Running mean", "season": "Season"},
+                                               selected = "running", inline=True),
+                        ui.layout_columns(
+                            ui.input_numeric("custom_length", "Length (months)", value=9, min=1, max=120),
+                            ui.panel_conditional("input.custom_kind === 'season'",
+                                ui.input_select("custom_start", "First month", choices=month_choices, selected="11")
+                            ),
+                            col_widths = (6,6)
+                        )
+                    )
                 ),
 
                 # optional inputs: date range, site name for download
@@ -201,10 +579,11 @@ app_ui = ui.page_fluid(
                     ui.card_header(
                         ui.tags.h3("Optional inputs", style="font-weight: bold; font-size: 20px;")
                     ),
-                    ui.input_date_range("date_range", "Select date range", start = "1962-01-01", end = "2023-12-31",
-                                    min = "1962-01-01", max = "2023-12-31"),
+                    ui.input_date_range("date_range", "Select date range", start = f"{year_first}-01-01", end = f"{year_last}-12-31",
+                                    min = f"{year_first}-01-01", max = f"{year_last}-12-31"),
                     ui.input_text("site_name",
                         ui.HTML("Site name <br><i>resets when lat and/or lon are changed</i>")),
+                    ui.input_checkbox("anomalies", "Plot anomalies (departures from the mean of each calendar month)", value=False),
                 ),
     
                 # button to extract and plot the values
@@ -275,9 +654,23 @@ app_ui = ui.page_fluid(
                     ui.card_header("Values for selected location and temporal resolution",
                                 style="text-align: center; font-size: 20px; font-weight: bold;"),
                     output_widget("plot_ts"),
-                    ui.download_button("download_csv", "Click here to download data (after selecting location/resolution and extracting the data)",
-                        class_="btn btn-secondary"),
-                    height = "700px"
+                    ui.layout_columns(
+                        ui.input_radio_buttons("download_format", None,
+                                               choices = {"csv": "csv", "parquet": "Parquet", "arrow": "Arrow IPC"},
+                                               selected = "csv", inline=True),
+                        ui.download_button("download_csv", "Click here to download data (after selecting location/resolution and extracting the data)",
+                            class_="btn btn-secondary"),
+                        col_widths = (4,8)
+                    ),
+                    # every temporal resolution for the selected location in one file
+                    ui.layout_columns(
+                        ui.input_radio_buttons("export_format", None,
+                                               choices = {"zip": "ZIP of csv files", "parquet": "Parquet", "arrow": "Arrow IPC"},
+                                               selected = "zip", inline=True),
+                        ui.download_button("download_all", "Download all resolutions", class_="btn btn-secondary"),
+                        col_widths = (8,4)
+                    ),
+                    height = "760px"
                 ),
                 # now, two cards side by side with the location map and the LMWL
                 # left card
@@ -291,6 +684,7 @@ app_ui = ui.page_fluid(
                 ui.card(
                     ui.card_header("Local meteoric water line",
                                 style="text-align: center; font-size: 20px; font-weight: bold;"),
+                    ui.input_radio_buttons("lmwl_method", None, choices=LMWL_METHODS, selected="ols", inline=True),
                     output_widget("lmwl"),
                     height = "400px"
                 ),
@@ -309,10 +703,36 @@ app_ui = ui.page_fluid(
                     ui.card_header(
                         ui.tags.h3("Required inputs", style="font-weight: bold; font-size: 20px;")
                         ),
+                    ui.input_radio_buttons("search_mode", "Search mode:",
+                                           choices = {"band": "One isotope (value +/- range)", "prob": "One isotope (probability)",
+                                                      "joint": "Joint δ²H and δ¹⁸O", "batch": "Batch (sample table)",
+                                                      "years": "One isotope (matching years)"},
+                                           selected = "band"),
+                    ui.panel_conditional("input.search_mode !== 'joint'",
                         ui.input_select("isotope", "Isotope system",
                                         choices = {"d2H": "δ²H", "d18O": "δ¹⁸O", "dxs":"dxs"}
                         ),
-                    ui.input_numeric("input_val", "Value (‰ VSMOW)", value = 0
+                    ),
+                    ui.panel_conditional("input.search_mode === 'band' || input.search_mode === 'prob' || input.search_mode === 'years'",
+                        ui.input_numeric("input_val", "Value (‰ VSMOW)", value = 0
+                        ),
+                    ),
+                    # a csv of samples: value, and optionally sample, isotope, offset and range columns
+                    # (the inputs on this page fill in any that are missing)
+                    ui.panel_conditional("input.search_mode === 'batch'",
+                        ui.input_file("batch_file", "Sample table (csv)", accept=[".csv", ".txt"]),
+                    ),
+                    # both values with their (1 sigma) uncertainties, and optionally their covariance
+                    ui.panel_conditional("input.search_mode === 'joint'",
+                        ui.layout_columns(
+                            ui.input_numeric("joint_d2H", "δ²H (‰ VSMOW)", value = -30),
+                            ui.input_numeric("joint_d2H_sd", "δ²H uncertainty (1σ, ‰)", value = 5, min = 0),
+                            ui.input_numeric("joint_d18O", "δ¹⁸O (‰ VSMOW)", value = -5),
+                            ui.input_numeric("joint_d18O_sd", "δ¹⁸O uncertainty (1σ, ‰)", value = 0.7, min = 0),
+                            col_widths = (6,6,6,6)
+                        ),
+                        ui.input_numeric("joint_cov", "δ²H-δ¹⁸O covariance (‰², optional)", value = 0),
+                        ui.input_checkbox("joint_interannual", "Include interannual variability", value = False),
                     ),
 
                     # define the search type. If the user wants a particular search period: define it!
@@ -321,13 +741,11 @@ app_ui = ui.page_fluid(
                                            selected = "Long-term mean"),
                     ui.panel_conditional("input.search_type === 'Mean over time period'",
                         ui.layout_columns(
-                            ui.input_numeric("year_start", "Start year", value=1962, min=1962, max=2023),
-                            ui.input_numeric("year_end", "End year", value=2023, min=1962, max=2023),
+                            ui.input_numeric("year_start", "Start year", value=year_first, min=year_first, max=year_last),
+                            ui.input_numeric("year_end", "End year", value=year_last, min=year_first, max=year_last),
                             col_widths = (6,6)
                         ),
-                        ui.input_checkbox_group("months_spatial", "Months", choices={"1": "Jan", "2": "Feb", "3": "Mar", "4": "Apr",
-                                                                             "5": "May", "6": "Jun", "7": "Jul", "8": "Aug",
-                                                                             "9": "Sep", "10": "Oct", "11": "Nov", "12": "Dec"},
+                        ui.input_checkbox_group("months_spatial", "Months", choices=month_choices,
                                                                              selected=[str(i) for i in range(1, 13)],inline=True)
                         )  
                 ),
@@ -337,8 +755,61 @@ app_ui = ui.page_fluid(
                     ui.card_header(
                         ui.tags.h3("Optional inputs", style="font-weight: bold; font-size: 20px;")
                     ),
-                    ui.input_numeric("offset", "Offset (‰)", value=0),
-                    ui.input_numeric("input_range", "Range (+/- ‰)", value=2),
+                    # search only part of the continent
+                    ui.input_radio_buttons("region_type", "Search region:",
+                                           choices = {"all": "Australia", "bbox": "Box", "state": "State/territory", "file": "Polygon (GeoJSON)"},
+                                           selected = "all", inline=True),
+                    ui.panel_conditional("input.region_type === 'bbox'",
+                        ui.layout_columns(
+                            ui.input_numeric("region_lat_min", "South (°)", value=-35),
+                            ui.input_numeric("region_lat_max", "North (°)", value=-25),
+                            ui.input_numeric("region_lon_min", "West (°)", value=140),
+                            ui.input_numeric("region_lon_max", "East (°)", value=150),
+                            col_widths = (6,6,6,6)
+                        ),
+                    ),
+                    ui.panel_conditional("input.region_type === 'state'",
+                        ui.input_select("region_state", "State/territory", choices=sorted(get_states()[0])),
+                    ),
+                    ui.panel_conditional("input.region_type === 'file'",
+                        ui.input_file("region_file", "Region polygon (GeoJSON)", accept=[".geojson", ".json"]),
+                    ),
+                    # the offset can also vary in space: uploaded as a netcdf (lat, lon) surface, or modelled as a
+                    # linear function of mean annual precipitation
+                    ui.panel_conditional("input.search_mode === 'band' || input.search_mode === 'prob' || input.search_mode === 'years'",
+                        ui.input_radio_buttons("offset_type", "Offset:",
+                                               choices = {"constant": "Constant", "prec": "Linear in precipitation amount", "file": "Surface (netcdf)"},
+                                               selected = "constant", inline=True),
+                    ),
+                    ui.panel_conditional("input.search_mode === 'batch' || (input.search_mode !== 'joint' && input.offset_type === 'constant')",
+                        ui.input_numeric("offset", "Offset (‰)", value=0),
+                    ),
+                    ui.panel_conditional("input.search_mode !== 'joint' && input.search_mode !== 'batch' && input.offset_type === 'prec'",
+                        ui.layout_columns(
+                            ui.input_numeric("offset_intercept", "Offset at 0 mm (‰)", value=0),
+                            ui.input_numeric("offset_slope", "Change per 100 mm/yr (‰)", value=0),
+                            col_widths = (6,6)
+                        ),
+                    ),
+                    ui.panel_conditional("input.search_mode !== 'joint' && input.search_mode !== 'batch' && input.offset_type === 'file'",
+                        ui.input_file("offset_file", "Offset surface (netcdf)", accept=[".nc"]),
+                    ),
+                    ui.panel_conditional("input.search_mode === 'band' || input.search_mode === 'batch' || input.search_mode === 'years'",
+                        ui.input_numeric("input_range", "Range (+/- ‰)", value=2),
+                    ),
+                    ui.panel_conditional("input.search_mode === 'band'",
+                        ui.input_numeric("n_closest", "Closest locations to list", value=10, min=0),
+                    ),
+                    ui.panel_conditional("input.search_mode === 'prob'",
+                        ui.input_numeric("prob_sd", "Measurement uncertainty (1σ, ‰)", value=1, min=0),
+                    ),
+                    ui.panel_conditional("input.search_mode === 'joint'",
+                        ui.layout_columns(
+                            ui.input_numeric("joint_offset_d2H", "δ²H offset (‰)", value=0),
+                            ui.input_numeric("joint_offset_d18O", "δ¹⁸O offset (‰)", value=0),
+                            col_widths = (6,6)
+                        ),
+                    ),
                 ),
     
                 # button to extract and plot the values
@@ -404,13 +875,41 @@ app_ui = ui.page_fluid(
                         # card header
                         ui.card_header("Matching locations",
                                     style="text-align: center; font-size: 20px; font-weight: bold;"),  
-                        ui.output_plot("plot_matches"),
+                        ui.output_plot("plot_matches", click=True),
+                        # years matched by a clicked location
+                        ui.panel_conditional("input.search_mode === 'years'",
+                            ui.output_ui("year_list"),
+                        ),
+                        # matched area by state/territory
+                        ui.output_table("match_summary"),
+                        # the locations closest to the sample value
+                        ui.panel_conditional("input.search_mode === 'band'",
+                            ui.output_table("closest_table"),
+                            ui.download_button("download_closest", "Download closest locations", class_="btn btn-secondary"),
+                        ),
+                        # the map, for GIS
+                        ui.layout_columns(
+                            ui.input_radio_buttons("map_format", None,
+                                                   choices = {"netcdf": "NetCDF", "geotiff": "GeoTIFF", "geojson": "GeoJSON polygons"},
+                                                   selected = "netcdf", inline=True),
+                            ui.download_button("download_map", "Download map", class_="btn btn-secondary"),
+                            col_widths = (6,6)
+                        ),
+                        ui.panel_conditional("input.search_mode === 'batch'",
+                            ui.layout_columns(
+                                ui.input_radio_buttons("batch_format", None,
+                                                       choices = {"netcdf": "NetCDF", "csv": "Table (csv)"},
+                                                       selected = "netcdf", inline=True),
+                                ui.download_button("download_batch", "Download batch results", class_="btn btn-secondary"),
+                                col_widths = (6,6)
+                            ),
+                        ),
                         style="margin-top: 0px; width: 100%"
                     ),
                 col_widths=(12, 12)
             ),
         )),
-        ui.nav_panel("Long-term mean isoscapes", ui.layout_sidebar(
+        ui.nav_panel("Isoscapes", ui.layout_sidebar(
             ui.sidebar(
                 ui.card(
                     ui.card_header(
@@ -423,7 +922,56 @@ app_ui = ui.page_fluid(
                     ui.input_select("cmap_isoscape", "Colormap", 
                                     choices = {"bone":"Blues", "viridis":"Viridis", "copper":"Copper"},
                                     selected = "bone"
-                    )
+                    ),
+                    ui.input_radio_buttons("isoscape_period", "Period:",
+                                           choices = {"ltm": "Long-term mean", "period": "Years and months", "diff": "Difference between two periods",
+                                              "anomaly": "Anomaly at one time"},
+                                           selected = "ltm"),
+                    ui.panel_conditional("input.isoscape_period === 'period' || input.isoscape_period === 'diff'",
+                        ui.layout_columns(
+                            ui.input_numeric("year_start_scape", "Start year", value=year_first, min=year_first, max=year_last),
+                            ui.input_numeric("year_end_scape", "End year", value=year_last, min=year_first, max=year_last),
+                            col_widths = (6,6)
+                        ),
+                        ui.input_checkbox_group("months_scape", "Months", choices=month_choices,
+                                                selected=[str(i) for i in range(1, 13)], inline=True)
+                    ),
+                    # the period subtracted from the one above
+                    ui.panel_conditional("input.isoscape_period === 'diff'",
+                        ui.tags.b("minus"),
+                        ui.layout_columns(
+                            ui.input_numeric("year_start_scape2", "Start year", value=year_first, min=year_first, max=year_last),
+                            ui.input_numeric("year_end_scape2", "End year", value=1990, min=year_first, max=year_last),
+                            col_widths = (6,6)
+                        ),
+                        ui.input_checkbox_group("months_scape2", "Months", choices=month_choices,
+                                                selected=[str(i) for i in range(1, 13)], inline=True)
+                    ),
+                    # one time step at any of the timeseries resolutions
+                    ui.panel_conditional("input.isoscape_period === 'anomaly'",
+                        ui.input_select("anomaly_res", "Temporal resolution", choices = TIME_RES, selected="monthly"),
+                        ui.panel_conditional("input.anomaly_res === 'custom'",
+                            ui.input_radio_buttons("anomaly_kind", "Custom window",
+                                                   choices = {"running": "Running mean", "season": "Season"},
+                                                   selected = "running", inline=True),
+                            ui.layout_columns(
+                                ui.input_numeric("anomaly_length", "Length (months)", value=9, min=1, max=120),
+                                ui.panel_conditional("input.anomaly_kind === 'season'",
+                                    ui.input_select("anomaly_start", "First month", choices=month_choices, selected="11")
+                                ),
+                                col_widths = (6,6)
+                            )
+                        ),
+                        ui.layout_columns(
+                            ui.input_numeric("anomaly_year", "Year", value=year_last, min=year_first, max=year_last),
+                            # (running means are labelled by their last month; values stored by year need no month)
+                            ui.panel_conditional(f"!{json.dumps(ANNUAL_RES)}.includes(input.anomaly_res) && "
+                                                 "!(input.anomaly_res === 'custom' && input.anomaly_kind === 'season')",
+                                ui.input_select("anomaly_month", "Month", choices=month_choices, selected="1")
+                            ),
+                            col_widths = (6,6)
+                        ),
+                    ),
                 ),
                 # card describing/linking to the original publication, disclaimer etc
                 ui.card(
@@ -458,9 +1006,254 @@ app_ui = ui.page_fluid(
             ui.layout_columns(
                 ui.card(
                     # card header
-                    ui.card_header("Long-term mean isoscapes",
+                    ui.card_header("Isoscapes",
                                    style="text-align: center; font-size: 20px; font-weight: bold;"),
-                        ui.output_plot("plot_isoscapes"),style="margin-top: 0px; width: 100%"
+                        ui.output_image("plot_isoscapes", height="auto"),style="margin-top: 0px; width: 100%"
+                    ),
+                col_widths=(12, 12)
+            ),
+
+        )),
+        ui.nav_panel("LMWL parameters", ui.layout_sidebar(
+            ui.sidebar(
+                ui.card(
+                    ui.card_header(
+                        ui.tags.h3("Inputs", style="font-weight: bold; font-size: 20px;")
+                        ),
+                    ui.input_select("lmwl_map_method", "Fit", choices = LMWL_METHODS, selected = "ols"),
+                    ui.input_radio_buttons("lmwl_map_param", "",
+                                    choices = {"slope": "Slope   ", "intercept": "Intercept   ", "r2": "r²   "},
+                                    selected = "slope", inline=True
+                    ),
+                    ui.input_select("cmap_lmwl", "Colormap",
+                                    choices = {"bone":"Blues", "viridis":"Viridis", "copper":"Copper"},
+                                    selected = "viridis"
+                    )
+                ),
+                # card describing/linking to the original publication, disclaimer etc
+                ui.card(
+                    ui.card_header(
+                    ui.tags.h3("Dataset details", style="font-weight: bold; font-size: 20px;") 
+                    ),
+                    ui.markdown("""Please read the below-linked publication for all details as to how these precipitation 
+                                δ²H, δ¹⁸O, and <i>dxs</i> values 
+                                were produced. If you use data from this calculator, 
+                                please cite the paper below.
+                                """),
+                    ui.a("Go to publication", href="https://egusphere.copernicus.org/preprints/2025/egusphere-2025-2458/", target="_blank", class_="btn btn-secondary")
+                ),
+
+                # link to zenodo repo for users to download the netcdfs
+                ui.card(
+                    ui.card_header(
+                        ui.tags.h3("Download netcdf files", style="font-weight: bold; font-size: 20px;")
+                        ),
+                    ui.markdown(
+                        """<a href="https://doi.org/10.5281/zenodo.15486277" target="_blank">This Zenodo repository</a> holds netcdf files 
+                        with monthly precipitation isotope data across the Australian continent, at 0.25° spatial resolution. 
+                        The data are available at monthly and annual temporal resolution.
+                """
+                    )
+                ),
+                # match sidebar display features to the timeseries tab
+                width = 350,
+                open = "always",
+                ),
+
+            ui.layout_columns(
+                ui.card(
+                    # card header
+                    ui.card_header("Local meteoric water line parameters",
+                                   style="text-align: center; font-size: 20px; font-weight: bold;"),
+                        ui.output_plot("plot_lmwl_params"),style="margin-top: 0px; width: 100%"
+                    ),
+                col_widths=(12, 12)
+            ),
+
+        )),
+        ui.nav_panel("Seasonality", ui.layout_sidebar(
+            ui.sidebar(
+                ui.card(
+                    ui.card_header(
+                        ui.tags.h3("Inputs", style="font-weight: bold; font-size: 20px;")
+                        ),
+                    ui.input_radio_buttons("isotope_season", "",
+                                    choices = {"d2H": "δ²H   ", "d18O": "δ¹⁸O   ", "dxs":"dxs   "},
+                                    selected = "d18O", inline=True
+                    ),
+                    ui.input_radio_buttons("season_param", "",
+                                    choices = {"amplitude": "Amplitude   ", "depleted_month": "Most depleted month   "},
+                                    selected = "amplitude", inline=True
+                    ),
+                    ui.input_radio_buttons("season_fit", "Fit",
+                                    choices = {"harmonic": "Annual harmonic", "range": "Monthly range"},
+                                    selected = "harmonic", inline=True
+                    ),
+                ),
+                # card describing/linking to the original publication, disclaimer etc
+                ui.card(
+                    ui.card_header(
+                    ui.tags.h3("Dataset details", style="font-weight: bold; font-size: 20px;") 
+                    ),
+                    ui.markdown("""Please read the below-linked publication for all details as to how these precipitation 
+                                δ²H, δ¹⁸O, and <i>dxs</i> values 
+                                were produced. If you use data from this calculator, 
+                                please cite the paper below.
+                                """),
+                    ui.a("Go to publication", href="https://egusphere.copernicus.org/preprints/2025/egusphere-2025-2458/", target="_blank", class_="btn btn-secondary")
+                ),
+
+                # link to zenodo repo for users to download the netcdfs
+                ui.card(
+                    ui.card_header(
+                        ui.tags.h3("Download netcdf files", style="font-weight: bold; font-size: 20px;")
+                        ),
+                    ui.markdown(
+                        """<a href="https://doi.org/10.5281/zenodo.15486277" target="_blank">This Zenodo repository</a> holds netcdf files 
+                        with monthly precipitation isotope data across the Australian continent, at 0.25° spatial resolution. 
+                        The data are available at monthly and annual temporal resolution.
+                """
+                    )
+                ),
+                # match sidebar display features to the timeseries tab
+                width = 350,
+                open = "always",
+                ),
+
+            ui.layout_columns(
+                ui.card(
+                    # card header
+                    ui.card_header("Seasonality",
+                                   style="text-align: center; font-size: 20px; font-weight: bold;"),
+                        ui.output_plot("plot_seasonality"),style="margin-top: 0px; width: 100%"
+                    ),
+                col_widths=(12, 12)
+            ),
+
+        )),
+        ui.nav_panel("Index correlations", ui.layout_sidebar(
+            ui.sidebar(
+                ui.card(
+                    ui.card_header(
+                        ui.tags.h3("Inputs", style="font-weight: bold; font-size: 20px;")
+                        ),
+                    # a csv with a date (or year, and optionally month) column and the index values
+                    ui.input_file("index_file", "Index series (csv)", accept=[".csv", ".txt"]),
+                    ui.input_radio_buttons("isotope_corr", "",
+                                    choices = {"d2H": "δ²H   ", "d18O": "δ¹⁸O   ", "dxs":"dxs   "},
+                                    selected = "d18O", inline=True
+                    ),
+                    ui.input_select("corr_res", "Values", choices = {res: label for res, label in TIME_RES.items() if res != "custom"}, selected = "monthly"),
+                    ui.input_slider("corr_lag", "Lag (index leading, in time steps)", min=0, max=12, value=0, step=1),
+                    # cells without a significant correlation are greyed out
+                    ui.input_select("corr_alpha", "Significance",
+                                    choices = {"1": "Show all", "0.1": "p < 0.1", "0.05": "p < 0.05", "0.01": "p < 0.01"},
+                                    selected = "0.05"
+                    ),
+                ),
+                # card describing/linking to the original publication, disclaimer etc
+                ui.card(
+                    ui.card_header(
+                    ui.tags.h3("Dataset details", style="font-weight: bold; font-size: 20px;") 
+                    ),
+                    ui.markdown("""Please read the below-linked publication for all details as to how these precipitation 
+                                δ²H, δ¹⁸O, and <i>dxs</i> values 
+                                were produced. If you use data from this calculator, 
+                                please cite the paper below.
+                                """),
+                    ui.a("Go to publication", href="https://egusphere.copernicus.org/preprints/2025/egusphere-2025-2458/", target="_blank", class_="btn btn-secondary")
+                ),
+
+                # link to zenodo repo for users to download the netcdfs
+                ui.card(
+                    ui.card_header(
+                        ui.tags.h3("Download netcdf files", style="font-weight: bold; font-size: 20px;")
+                        ),
+                    ui.markdown(
+                        """<a href="https://doi.org/10.5281/zenodo.15486277" target="_blank">This Zenodo repository</a> holds netcdf files 
+                        with monthly precipitation isotope data across the Australian continent, at 0.25° spatial resolution. 
+                        The data are available at monthly and annual temporal resolution.
+                """
+                    )
+                ),
+                # match sidebar display features to the timeseries tab
+                width = 350,
+                open = "always",
+                ),
+
+            ui.layout_columns(
+                ui.card(
+                    # card header
+                    ui.card_header("Index correlations",
+                                   style="text-align: center; font-size: 20px; font-weight: bold;"),
+                        ui.output_plot("plot_correlation"),style="margin-top: 0px; width: 100%"
+                    ),
+                col_widths=(12, 12)
+            ),
+
+        )),
+        ui.nav_panel("Trends", ui.layout_sidebar(
+            ui.sidebar(
+                ui.card(
+                    ui.card_header(
+                        ui.tags.h3("Inputs", style="font-weight: bold; font-size: 20px;")
+                        ),
+                    ui.input_radio_buttons("isotope_trend", "",
+                                    choices = {"d2H": "δ²H   ", "d18O": "δ¹⁸O   ", "dxs":"dxs   "},
+                                    selected = "d18O", inline=True
+                    ),
+                    ui.input_select("trend_res", "Values", choices = {res: TIME_RES[res] for res in ANNUAL_RES}, selected = "ann"),
+                    ui.layout_columns(
+                        ui.input_numeric("trend_year_start", "Start year", value=year_first, min=year_first, max=year_last),
+                        ui.input_numeric("trend_year_end", "End year", value=year_last, min=year_first, max=year_last),
+                        col_widths = (6,6)
+                    ),
+                    ui.input_radio_buttons("trend_method", "Trend",
+                                    choices = {"sen_slope": "Theil-Sen slope", "ols_slope": "OLS slope"},
+                                    selected = "sen_slope", inline=True
+                    ),
+                    # cells without a significant Mann-Kendall trend are greyed out
+                    ui.input_select("trend_alpha", "Mann-Kendall significance",
+                                    choices = {"1": "Show all", "0.1": "p < 0.1", "0.05": "p < 0.05", "0.01": "p < 0.01"},
+                                    selected = "0.05"
+                    ),
+                ),
+                # card describing/linking to the original publication, disclaimer etc
+                ui.card(
+                    ui.card_header(
+                    ui.tags.h3("Dataset details", style="font-weight: bold; font-size: 20px;") 
+                    ),
+                    ui.markdown("""Please read the below-linked publication for all details as to how these precipitation 
+                                δ²H, δ¹⁸O, and <i>dxs</i> values 
+                                were produced. If you use data from this calculator, 
+                                please cite the paper below.
+                                """),
+                    ui.a("Go to publication", href="https://egusphere.copernicus.org/preprints/2025/egusphere-2025-2458/", target="_blank", class_="btn btn-secondary")
+                ),
+
+                # link to zenodo repo for users to download the netcdfs
+                ui.card(
+                    ui.card_header(
+                        ui.tags.h3("Download netcdf files", style="font-weight: bold; font-size: 20px;")
+                        ),
+                    ui.markdown(
+                        """<a href="https://doi.org/10.5281/zenodo.15486277" target="_blank">This Zenodo repository</a> holds netcdf files 
+                        with monthly precipitation isotope data across the Australian continent, at 0.25° spatial resolution. 
+                        The data are available at monthly and annual temporal resolution.
+                """
+                    )
+                ),
+                # match sidebar display features to the timeseries tab
+                width = 350,
+                open = "always",
+                ),
+
+            ui.layout_columns(
+                ui.card(
+                    # card header
+                    ui.card_header("Trends",
+                                   style="text-align: center; font-size: 20px; font-weight: bold;"),
+                        ui.output_plot("plot_trends"),style="margin-top: 0px; width: 100%"
                     ),
                 col_widths=(12, 12)
             ),
@@ -473,6 +1266,129 @@ app_ui = ui.page_fluid(
 )
     
 
+# file extensions of the download formats
+download_ext = {"csv": ".csv", "zip": ".zip", "parquet": ".parquet", "arrow": ".arrow",
+                "netcdf": ".nc", "geotiff": ".tif", "geojson": ".geojson"}
+
+# names of the mapped variable in the spatial search downloads
+map_names = {"band": "matched_value", "prob": "probability", "joint": "probability", "batch": "match_frequency", "years": "n_matching_years"}
+
+# MAPS
+# the isotope systems in plot titles, and as precipitation values (subscript p)
+ISO_LABELS = {"d2H": r"$\delta^{2}\mathrm{H}$", "d18O": r"$\delta^{18}\mathrm{O}$", "dxs": r"$\mathit{dxs}$"}
+ISO_P_LABELS = {"d2H": r"$\delta^{2}\mathrm{H}_{\mathrm{p}}$", "d18O": r"$\delta^{18}\mathrm{O}_{\mathrm{p}}$", "dxs": r"$\mathit{dxs}$"}
+
+# a map of one gridded field over Australia, with the state outlines (isoscapes and LMWL parameters)
+def plot_isoscape_maps(fig, ax, dat, dat_proj, new_proj, title,vmin, vmax, cmap, cbar_lab):
+    im = dat.plot(ax=ax,transform=dat_proj,cmap=cmap,add_colorbar=False,vmin=vmin,vmax=vmax)
+
+    ax.set_extent([110, 155, -45, -10], crs=ccrs.PlateCarree())
+
+    # Australia outline
+    shpfilename = natural_earth(resolution="10m",category="cultural",name="admin_0_countries")
+    reader = Reader(shpfilename)
+    australia_geom = [
+        rec.geometry for rec in reader.records()
+        if rec.attributes["NAME_LONG"] == "Australia"
+    ]
+
+    states_shp = natural_earth(resolution='10m',category='cultural',name='admin_1_states_provinces')
+    states_reader = Reader(states_shp)
+    aus_states = [
+        rec.geometry for rec in states_reader.records()
+        if rec.attributes.get('admin') == 'Australia'
+    ]
+
+    ax.add_geometries(aus_states,crs=ccrs.PlateCarree(),edgecolor='black',facecolor='none',linewidth=0.5, zorder=3)
+    ax.add_geometries(australia_geom, crs=ccrs.PlateCarree(),edgecolor='black', facecolor='none', linewidth=0.8, zorder=4)
+
+    #ax.set_title(title, fontsize=14)
+
+    ax.axis("off")
+
+    cbar = fig.colorbar(im,ax=ax,orientation="vertical",shrink=0.4,pad=0.02, extend = "both")
+    cbar.set_label(cbar_lab, fontsize=11)
+
+    return im
+
+# a new figure with a map of (cell,) values over the land cells, titled. Where `significant` is given,
+# the other cells are drawn in grey; a `footnote` is written at the lower left of the map. Returns the
+# figure and the mapped image
+def plot_cell_map(values, title, vmin, vmax, cmap, cbar_lab, significant=None, footnote=None, figsize=(10, 7)):
+    mpl.rcParams['font.family'] = 'Arial'
+    mpl.rcParams['text.color'] = 'black'
+    mpl.rcParams['axes.labelcolor'] = 'black'
+    mpl.rcParams['xtick.color'] = 'black'
+    mpl.rcParams['ytick.color'] = 'black'
+
+    dat_proj = new_proj = ccrs.PlateCarree()
+
+    fig, ax = plt.subplots(figsize=figsize,subplot_kw={"projection": ccrs.PlateCarree()})
+
+    values = np.asarray(values, dtype=np.float64)
+    if significant is not None:
+        not_significant = np.where(np.isfinite(values) & ~significant, 0., np.nan)
+        unpack(not_significant, cells).plot(ax=ax, transform=dat_proj, cmap=mpl.colors.ListedColormap(["lightgrey"]),
+                                           add_colorbar=False, add_labels=False)
+        values = np.where(significant, values, np.nan)
+    im = plot_isoscape_maps(fig, ax, unpack(values, cells), dat_proj, new_proj, "", vmin, vmax, cmap=cmap, cbar_lab=cbar_lab)
+
+    fig.suptitle(title, fontsize=14, y=0.98)
+    if footnote:
+        ax.text(0, 0.01, footnote, ha='left', va='bottom', transform=ax.transAxes, fontname='Arial', color='black', fontsize=10)
+    fig.tight_layout()
+    return fig, im
+
+# upper colour limit of a map of changes or anomalies on a symmetric diverging colour map: most of the
+# values, ignoring the most extreme cells
+def symmetric_vmax(values):
+    values = np.asarray(values, dtype=np.float64)
+    vmax = float(np.nanpercentile(np.abs(values), 98)) if np.isfinite(values).any() else 1.
+    return vmax if vmax > 0 else 1.
+
+# a period (year_start, year_end, months) as text, e.g. "1991–2023, Dec, Jan, Feb"
+def period_label(year_start, year_end, months):
+    label = f"{year_start}–{year_end}" if year_start != year_end else f"{year_start}"
+    if len(months) < 12:
+        label += ", " + ", ".join(calendar.month_abbr[m] for m in months)
+    return label
+
+# the rendered isoscape maps (png), cached by everything drawn on them. `period` is None for the
+# long-term mean, otherwise (year_start, year_end, months); with a `base` period too, the map is
+# the difference period - base (each period's mean surface is cached on its own, shared with the
+# spatial search). With `anomaly` (time_res, custom, year, month), the map is the anomaly at that
+# time step instead (see get_anomaly_surface). Both are drawn on RdBu_r, so `cmap` is then None
+@lru_cache_bytes(image_cache_mb * 2**20)
+def get_isoscape_png(iso, cmap, period, base, anomaly, width, pixelratio):
+    lims = {"d18O": (-7, -3, "δ¹⁸O (‰ VSMOW)"), "d2H": (-45, -5, "δ²H (‰ VSMOW)"), "dxs": (5, 16, r"$\mathit{dxs}$")}
+    system = ISO_P_LABELS[iso]
+    vmin, vmax, lab = lims[iso]
+    if anomaly is not None:
+        da = get_anomaly_surface(iso, *anomaly)
+        time_res, custom, year, month = anomaly
+        res = window_label(*custom) if time_res == "custom" else TIME_RES[time_res]
+        when = f"{year}" if is_annual(time_res, custom) else f"{calendar.month_abbr[month]} {year}"
+        title = system + f" anomaly, {when} ({res}; from the {year_first}–{year_last} " + ("monthly climatology)" if time_res == "monthly" else "mean)")
+    elif period is None:
+        da = decode(mean_pk[iso])
+        title = ("Long-term mean annual " if iso == "dxs" else "Long-term mean ") + system + f" isoscape ({year_first}–{year_last})"
+    elif base is None:
+        da = get_mean_surface(iso, "Mean over time period", *period, None)
+        title = "Amount-weighted mean " + system + f" isoscape ({period_label(*period)})"
+    else:
+        da = get_mean_surface(iso, "Mean over time period", *period, None) - get_mean_surface(iso, "Mean over time period", *base, None)
+        title = "Change in amount-weighted mean " + system + f": ({period_label(*period)}) minus ({period_label(*base)})"
+    if anomaly is not None or base is not None:
+        # symmetric limits, on a diverging colour map
+        vmax = symmetric_vmax(da)
+        vmin, lab, cmap = -vmax, "Difference (‰)" if anomaly is None else "Anomaly (‰)", "RdBu_r"
+
+    fig, _ = plot_cell_map(da, title, vmin, vmax, cmap, lab, figsize=(width / 100, width * 0.7 / 100))
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=100 * pixelratio)
+    plt.close(fig)
+    return buf.getvalue()
+
 # NOW THE SERVER
 def server(input, output, session):
     # reset site name when lat or lon are changed
@@ -488,23 +1404,23 @@ def server(input, output, session):
             ui.modal_show(modal_ts)
         elif input.active_tab() == "Spatial search":
             ui.modal_show(modal_spatial)
-        elif input.active_tab() == "Long-term mean isoscapes":
+        elif input.active_tab() == "Isoscapes":
             ui.modal_show(modal_isoscape)
+        elif input.active_tab() == "LMWL parameters":
+            ui.modal_show(modal_lmwl)
+        elif input.active_tab() == "Seasonality":
+            ui.modal_show(modal_seasonality)
+        elif input.active_tab() == "Trends":
+            ui.modal_show(modal_trends)
+        elif input.active_tab() == "Index correlations":
+            ui.modal_show(modal_correlation)
     
     # when the app is first opened, show info window for the timeseries
     @session.on_flush
     def show_modal_on_load():
         ui.modal_show(modal_ts)
     
-    # helper function to check lats/lons
-    def is_valid_point(ds, lat, lon):
-        try:
-            da = ds.sel(lat=lat, lon=lon, method="nearest")
-        except Exception:
-            return False
-
-        return not np.all(np.isnan(da.to_array()))
-    # and one to show a modal
+    # and a helper function to show a modal
     def show_error_modal(message):
         ui.modal_show(
             ui.modal(
@@ -515,282 +1431,179 @@ def server(input, output, session):
             )
         )
 
-    def plot_isoscape_maps(fig, ax, dat, dat_proj, new_proj, title,vmin, vmax, cmap, cbar_lab):
-        im = dat.plot(ax=ax,transform=dat_proj,cmap=cmap,add_colorbar=False,vmin=vmin,vmax=vmax)
-
-        ax.set_extent([110, 155, -45, -10], crs=ccrs.PlateCarree())
-
-        # Australia outline
-        shpfilename = natural_earth(resolution="10m",category="cultural",name="admin_0_countries")
-        reader = Reader(shpfilename)
-        australia_geom = [
-            rec.geometry for rec in reader.records()
-            if rec.attributes["NAME_LONG"] == "Australia"
-        ]
-
-        states_shp = natural_earth(resolution='10m',category='cultural',name='admin_1_states_provinces')
-        states_reader = Reader(states_shp)
-        aus_states = [
-            rec.geometry for rec in states_reader.records()
-            if rec.attributes.get('admin') == 'Australia'
-        ]
-
-        ax.add_geometries(aus_states,crs=ccrs.PlateCarree(),edgecolor='black',facecolor='none',linewidth=0.5, zorder=3)
-        ax.add_geometries(australia_geom, crs=ccrs.PlateCarree(),edgecolor='black', facecolor='none', linewidth=0.8, zorder=4)
-
-        #ax.set_title(title, fontsize=14)
-
-        ax.axis("off")
-
-        cbar = fig.colorbar(im,ax=ax,orientation="vertical",shrink=0.4,pad=0.02, extend = "both")
-        cbar.set_label(cbar_lab, fontsize=11)
-
-        return im
-
-    # the easy one (just show long-term mean maps; not reactive in any way)
+    # isoscapes: the long-term mean maps, the amount-weighted mean of any years and months, the
+    # difference between two such periods, or the anomaly at one time step. The rendered image is
+    # cached, so returning to a map already drawn (by any session) costs nothing
     @output
-    @render.plot
+    @render.image(delete_file=True)
     def plot_isoscapes():
+        def chosen_period(year_start, year_end, months):
+            months = tuple(sorted(int(m) for m in months))
+            req(year_start is not None and year_end is not None and year_start <= year_end and months)
+            return year_start, year_end, months
+
+        period = base = anomaly = None
+        if input.isoscape_period() in ("period", "diff"):
+            period = chosen_period(input.year_start_scape(), input.year_end_scape(), input.months_scape())
+        if input.isoscape_period() == "diff":
+            base = chosen_period(input.year_start_scape2(), input.year_end_scape2(), input.months_scape2())
+        if input.isoscape_period() == "anomaly":
+            req(input.anomaly_year() is not None and year_first <= input.anomaly_year() <= year_last)
+            time_res, custom = input.anomaly_res(), None
+            if time_res == "custom":
+                req(input.anomaly_length() is not None and input.anomaly_length() >= 1)
+                # (the start month only matters for seasons)
+                start = int(input.anomaly_start()) if input.anomaly_kind() == "season" else 1
+                custom = (input.anomaly_kind(), int(input.anomaly_length()), start)
+            # (values stored by year need no month, so they share one cache entry)
+            month = 1 if is_annual(time_res, custom) else int(input.anomaly_month())
+            anomaly = (time_res, custom, int(input.anomaly_year()), month)
+        # (the width is rounded so that slightly different windows share a cached image)
+        width = int(math.ceil((session.clientdata.output_width("plot_isoscapes") or 1000) / 100) * 100)
+        pixelratio = session.clientdata.pixelratio() or 1
+        # (differences and anomalies are always on a diverging colour map, so the choice is left out of their cache key)
+        cmap = None if base is not None or anomaly is not None else input.cmap_isoscape()
+        png = get_isoscape_png(input.isotope_scape(), cmap, period, base, anomaly, width, float(pixelratio))
+        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
+            f.write(png)
+        return {"src": f.name, "width": f"{width}px", "height": f"{int(width * 0.7)}px", "alt": "Isoscape map"}
+
+    # LMWL PARAMETERS: maps of the per-cell local meteoric water line fits
+    @output
+    @render.plot
+    def plot_lmwl_params():
 
-        which_iso = input.isotope_scape()
-        this_cmap = input.cmap_isoscape()
-
-        if which_iso == "d18O":
-            da, vmin, vmax, lab = (d18O_mean.d18Op, -7, -3, "δ¹⁸O (‰ VSMOW)")
-            title = r"Long-term mean $\delta^{18}\mathrm{O}_{\mathrm{p}}$ isoscape (1962–2023)"
-
-        elif which_iso == "d2H":
-            da, vmin, vmax, lab = (d2H_mean.d2Hp, -45, -5, "δ²H (‰ VSMOW)")
-            title = r"Long-term mean $\delta^{2}\mathrm{H}_{\mathrm{p}}$ isoscape (1962–2023)"
-
-        elif which_iso == "dxs":
-            da, vmin, vmax, lab = (dxs_mean.dxsp, 5, 16, r"$\mathit{dxs}$")
-            title = r"Long-term mean annual $\mathit{dxs}$ isoscape (1962–2023)"
-
-        mpl.rcParams['font.family'] = 'Arial'
-        mpl.rcParams['text.color'] = 'black'
-        mpl.rcParams['axes.labelcolor'] = 'black'
-        mpl.rcParams['xtick.color'] = 'black'
-        mpl.rcParams['ytick.color'] = 'black'
-
-        dat_proj = new_proj = ccrs.PlateCarree()
+        method = input.lmwl_map_method()
+        param = input.lmwl_map_param()
+        vals = get_lmwl_fits()[param].sel(fit=method).values
 
-        fig, ax = plt.subplots(figsize=(10, 7),subplot_kw={"projection": ccrs.PlateCarree()})
+        if param == "slope":
+            name, lab = "slope", "LMWL slope"
+        elif param == "intercept":
+            name, lab = "intercept", "LMWL intercept (‰ VSMOW)"
+        else:
+            name, lab = r"$r^{2}$", r"LMWL $r^{2}$"
+        # colour limits from the data, ignoring the most extreme cells
+        vmin, vmax = np.nanpercentile(vals, [2, 98])
+        title = f"LMWL {name} ({LMWL_METHODS[method]} fit to monthly values, {year_first}–{year_last})"
 
-        plot_isoscape_maps(fig, ax, da, dat_proj, new_proj, "",vmin, vmax, cmap=this_cmap, cbar_lab=lab)
+        return plot_cell_map(vals, title, vmin, vmax, input.cmap_lmwl(), lab)[0]
+    
+    # SEASONALITY: maps of the per-cell seasonal amplitude, or of the month of the most depleted
+    # values (on a cyclic colour map, so December and January are neighbours)
+    @output
+    @render.plot
+    def plot_seasonality():
+        iso, param, fit = input.isotope_season(), input.season_param(), input.season_fit()
+        vals = get_seasonality(iso)[param].sel(fit=fit).values
+
+        system = ISO_P_LABELS[iso]
+        how = "annual harmonic" if fit == "harmonic" else "monthly range"
+        if param == "amplitude":
+            title = f"Seasonal amplitude of {system} ({how}, {year_first}–{year_last})"
+            # colour limits from the data, ignoring the most extreme cells
+            vmin, vmax = 0, float(np.nanpercentile(vals, 98)) if np.isfinite(vals).any() else 1.
+            cmap, lab = "viridis", "Amplitude (‰)"
+        else:
+            title = f"Month of most depleted {system} ({how}, {year_first}–{year_last})"
+            vmin, vmax, cmap, lab = 0.5, 12.5, "twilight", "Month"
+            if fit == "harmonic":
+                # (the harmonic's trough is fractional: after mid-December it wraps to January)
+                vals = np.where(vals < 12.5, vals, vals - 12)
+
+        fig, im = plot_cell_map(vals, title, vmin, vmax, cmap, lab)
+        if param == "depleted_month":
+            cbar = im.colorbar
+            cbar.set_ticks(range(1, 13))
+            cbar.set_ticklabels([calendar.month_abbr[m] for m in range(1, 13)])
+        return fig
 
+    # TRENDS: maps of the per-cell trends (per decade), with the cells without a significant
+    # Mann-Kendall trend in grey
+    @output
+    @render.plot
+    def plot_trends():
+        iso, time_res = input.isotope_trend(), input.trend_res()
+        year_start, year_end = input.trend_year_start(), input.trend_year_end()
+        req(year_start is not None and year_end is not None and year_end - year_start >= 2)
+        trends = get_trends(iso, time_res, year_start, year_end)
+        slope = 10 * trends[input.trend_method()].values
+        alpha = float(input.trend_alpha())
+        significant = trends["mk_p"].values < alpha if alpha < 1 else np.isfinite(slope)
+
+        system = ISO_P_LABELS[iso]
+        method = "Theil-Sen" if input.trend_method() == "sen_slope" else "OLS"
+        title = f"{method} trend in {system} ({TIME_RES[time_res]}), {year_start}–{year_end}"
+        vmax = symmetric_vmax(slope)
+        footnote = f"Grey: no significant Mann-Kendall trend (p ≥ {alpha:g})" if alpha < 1 else None
+
+        return plot_cell_map(slope, title, -vmax, vmax, "RdBu_r", "Trend (‰ per decade)", significant, footnote)[0]
+
+    # INDEX CORRELATIONS: maps of the correlation with an uploaded index at the chosen lag, with the
+    # cells without a significant correlation in grey
+    @output
+    @render.plot
+    def plot_correlation():
+        file = input.index_file()
+        req(file)
+        iso, time_res, lag = input.isotope_corr(), input.corr_res(), input.corr_lag()
+        try:
+            corr = get_index_correlation(file[0]["datapath"], iso, time_res, 12).sel(lag=lag)
+        except Exception as err:
+            ui.notification_show(f"Index correlation: {err}", type="error", duration=None)
+            req(False)
+        r = corr["r"].values
+        alpha = float(input.corr_alpha())
+        significant = corr["p"].values < alpha if alpha < 1 else np.isfinite(r)
+
+        system = ISO_P_LABELS[iso]
+        title = f"Correlation of {system} ({TIME_RES[time_res]}) with {file[0]['name']}" + (f", index leading by {lag}" if lag else "")
+        # (rounded up to a tenth)
+        vmax = max(float(np.ceil(symmetric_vmax(r) * 10) / 10), 0.1)
+        footnote = f"n = {int(np.nanmax(corr['n'].values))}" + (f"; grey: not significant (p ≥ {alpha:g})" if alpha < 1 else "")
+
+        return plot_cell_map(r, title, -vmax, vmax, "RdBu_r", "Correlation (r)", significant, footnote)[0]
+
+    # TIMESERIES: custom window definition
+    def get_custom_inputs():
+        length = input.custom_length()
+        req(length is not None and length >= 1)
+        # (the start month only matters for seasons)
+        start = int(input.custom_start()) if input.custom_kind() == "season" else 1
+        return input.custom_kind(), int(length), start
+
+    # TIMESERIES: is the selected resolution one value per year (rather than per month)?
+    def annual_resolution():
+        return is_annual(input.time_res(), (input.custom_kind(),))
 
-        fig.suptitle(title, fontsize=14, y=0.98)
-        fig.tight_layout()
-        return fig
-    
     # TIMESERIES: function to get data at selected point
     def extract_timeseries(lat, lon):
-        # extract relevant timeseries
-        if input.time_res() == "ann":
-
-            # annual data (Jan-Dec)
-            d2H_ann = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_1962-2023_ann_median.nc")
-            d18O_ann = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_1962-2023_ann_median.nc")
-            dxs_ann = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_1962-2023_ann_median.nc")
-
-            site_name = input.site_name() if input.site_name() else "site"
-            site_name = site_name.replace(" ", "_")
-            d2H_vals = d2H_ann.sel(lat=lat, lon=lon, method="nearest").d2Hp.values
-            d18O_vals = d18O_ann.sel(lat=lat, lon=lon, method="nearest").d18Op.values
-            dxs_vals = dxs_ann.sel(lat=lat, lon=lon, method="nearest").dxsp.values
-            time = d18O_ann.time.values
-
-            return pd.DataFrame({'site': site_name, 'year': time, 'lat': lat, 'lon': lon, 'd2H': d2H_vals, 'd18O': d18O_vals, 'dxs': dxs_vals})
-        elif input.time_res() == "ann_trop":
-
-            # annual (Jul-Jun)
-            H_ann_trop = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_1962-2022_ann-trop.nc")
-            O_ann_trop = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_1962-2022_ann-trop.nc")
-            d_ann_trop = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_1962-2022_ann-trop.nc")
-
-            H_ann_trop = H_ann_trop.rename({'year': 'time'})
-            O_ann_trop = O_ann_trop.rename({'year': 'time'})
-            d_ann_trop = d_ann_trop.rename({'year': 'time'})
-
-            new_time_trop = [pd.Timestamp(year=year, month=7, day=1) for year in years_cal]
-            new_time_trop = new_time_trop[:-1]
-
-            
-            H_ann_trop = H_ann_trop.assign_coords(time=("time", new_time_trop))
-            O_ann_trop = O_ann_trop.assign_coords(time=("time", new_time_trop))
-            d_ann_trop = d_ann_trop.assign_coords(time=("time", new_time_trop))
-
-            site_name = input.site_name() if input.site_name() else "site"
-            site_name = site_name.replace(" ", "_")
-            d2H_vals = H_ann_trop.sel(lat=lat, lon=lon, method="nearest").d2Hp.values
-            d18O_vals = O_ann_trop.sel(lat=lat, lon=lon, method="nearest").d18Op.values
-            dxs_vals = d_ann_trop.sel(lat=lat, lon=lon, method="nearest").dxsp.values
-            time = H_ann_trop.time.values
-
-            return pd.DataFrame({'site': site_name, 'year': time, 'lat': lat, 'lon': lon, 'd2H': d2H_vals, 'd18O': d18O_vals, 'dxs': dxs_vals})
-        elif input.time_res() == "DJF":
-
-            # annual (DJF)
-            H_djf = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_1962-2022_ann-djf.nc")
-            O_djf = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_1962-2022_ann-djf.nc")
-            d_djf = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_1962-2022_ann-djf.nc")
-     
-            H_djf = H_djf.rename({'year': 'time'})
-            O_djf = O_djf.rename({'year': 'time'})
-            d_djf = d_djf.rename({'year': 'time'})
-
-            new_time_djf = [pd.Timestamp(year=year, month=12, day=1) for year in years_cal]
-            new_time_djf = new_time_djf[:-1]
-
-            H_djf = H_djf.assign_coords(time=("time", new_time_djf))
-            O_djf = O_djf.assign_coords(time=("time", new_time_djf))
-            d_djf = d_djf.assign_coords(time=("time", new_time_djf))
-
-            site_name = input.site_name() if input.site_name() else "site"
-            site_name = site_name.replace(" ", "_")
-            d2H_vals = H_djf.sel(lat=lat, lon=lon, method="nearest").d2Hp.values
-            d18O_vals = O_djf.sel(lat=lat, lon=lon, method="nearest").d18Op.values
-            dxs_vals = d_djf.sel(lat=lat, lon=lon, method="nearest").dxsp.values
-            time = H_djf.time.values
-
-            return pd.DataFrame({'site': site_name, 'year': time, 'lat': lat, 'lon': lon, 'd2H': d2H_vals, 'd18O': d18O_vals, 'dxs': dxs_vals})
-        elif input.time_res() == "MAM":
-
-            # annual (MAM)
-            H_mam = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_1962-2023_ann-mam.nc")
-            O_mam = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_1962-2023_ann-mam.nc")
-            d_mam = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_1962-2023_ann-mam.nc")
-            
-            H_mam = H_mam.rename({'year': 'time'})
-            O_mam = O_mam.rename({'year': 'time'})
-            d_mam = d_mam.rename({'year': 'time'})
-
-            new_time_mam = [pd.Timestamp(year=year, month=5, day=31) for year in years_cal]
-
-            
-            H_mam = H_mam.assign_coords(time=("time", new_time_mam))
-            O_mam = O_mam.assign_coords(time=("time", new_time_mam))
-            d_mam = d_mam.assign_coords(time=("time", new_time_mam))
-
-            site_name = input.site_name() if input.site_name() else "site"
-            site_name = site_name.replace(" ", "_")
-            d2H_vals = H_mam.sel(lat=lat, lon=lon, method="nearest").d2Hp.values
-            d18O_vals = O_mam.sel(lat=lat, lon=lon, method="nearest").d18Op.values
-            dxs_vals = d_mam.sel(lat=lat, lon=lon, method="nearest").dxsp.values
-            time = H_mam.time.values
-
-            return pd.DataFrame({'site': site_name, 'year': time, 'lat': lat, 'lon': lon, 'd2H': d2H_vals, 'd18O': d18O_vals, 'dxs': dxs_vals})
-        elif input.time_res() == "JJA":
-
-            # annual (JJA)
-            H_jja = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_1962-2023_ann-jja.nc")
-            O_jja = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_1962-2023_ann-jja.nc")
-            d_jja = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_1962-2023_ann-jja.nc")
-
-            new_time_jja = [pd.Timestamp(year=year, month=8, day=31) for year in years_cal]
-
-            H_jja = H_jja.rename({'year': 'time'})
-            O_jja = O_jja.rename({'year': 'time'})
-            d_jja = d_jja.rename({'year': 'time'})
-
-            H_jja = H_jja.assign_coords(time=("time", new_time_jja))
-            O_jja = O_jja.assign_coords(time=("time", new_time_jja))
-            d_jja = d_jja.assign_coords(time=("time", new_time_jja))
-
-            site_name = input.site_name() if input.site_name() else "site"
-            site_name = site_name.replace(" ", "_")
-            d2H_vals = H_jja.sel(lat=lat, lon=lon, method="nearest").d2Hp.values
-            d18O_vals = O_jja.sel(lat=lat, lon=lon, method="nearest").d18Op.values
-            dxs_vals = d_jja.sel(lat=lat, lon=lon, method="nearest").dxsp.values
-            time = H_jja.time.values
-
-            return pd.DataFrame({'site': site_name, 'year': time, 'lat': lat, 'lon': lon, 'd2H': d2H_vals, 'd18O': d18O_vals, 'dxs': dxs_vals})
-        elif input.time_res() == "SON":
-
-            # annual (SON)
-            H_son = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_1962-2023_ann-son.nc")
-            O_son = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_1962-2023_ann-son.nc")
-            d_son = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_1962-2023_ann-son.nc")
-
-            H_son = H_son.rename({'year': 'time'})
-            O_son = O_son.rename({'year': 'time'})
-            d_son = d_son.rename({'year': 'time'})  
-
-            new_time_son = [pd.Timestamp(year=year, month=11, day=30) for year in years_cal]
-
-            H_son = H_son.assign_coords(time=("time", new_time_son))
-            O_son = O_son.assign_coords(time=("time", new_time_son))
-            d_son = d_son.assign_coords(time=("time", new_time_son))
-
-            site_name = input.site_name() if input.site_name() else "site"
-            site_name = site_name.replace(" ", "_")
-            d2H_vals = H_son.sel(lat=lat, lon=lon, method="nearest").d2Hp.values
-            d18O_vals = O_son.sel(lat=lat, lon=lon, method="nearest").d18Op.values
-            dxs_vals = d_son.sel(lat=lat, lon=lon, method="nearest").dxsp.values
-            time = H_son.time.values
-
-            return pd.DataFrame({'site': site_name, 'year': time, 'lat': lat, 'lon': lon, 'd2H': d2H_vals, 'd18O': d18O_vals, 'dxs': dxs_vals})
-        elif input.time_res() == "3mrm":
-
-            # three-month running mean
-            H_3m = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_1962-2023_3-month-running-mean.nc")
-            O_3m = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_1962-2023_3-month-running-mean.nc")
-            d_3m = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_1962-2023_3-month-running-mean.nc")
-
-            site_name = input.site_name() if input.site_name() else "site"
-            site_name = site_name.replace(" ", "_")
-            d2H_vals = H_3m.sel(lat=lat, lon=lon, method="nearest").d2Hp.values
-            d18O_vals = O_3m.sel(lat=lat, lon=lon, method="nearest").d18Op.values
-            dxs_vals = d_3m.sel(lat=lat, lon=lon, method="nearest").dxsp.values
-            time = H_3m.time.values
-
-            return pd.DataFrame({'site': site_name, 'date': time, 'lat': lat, 'lon': lon, 'd2H': d2H_vals, 'd18O': d18O_vals, 'dxs': dxs_vals})
-        elif input.time_res() == "6mrm":
-
-            # six-month running mean
-            H_6m = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_1962-2023_6-month-running-mean.nc")
-            O_6m = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_1962-2023_6-month-running-mean.nc")
-            d_6m = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_1962-2023_6-month-running-mean.nc")
-
-            site_name = input.site_name() if input.site_name() else "site"
-            site_name = site_name.replace(" ", "_")
-            d2H_vals = H_6m.sel(lat=lat, lon=lon, method="nearest").d2Hp.values
-            d18O_vals = O_6m.sel(lat=lat, lon=lon, method="nearest").d18Op.values
-            dxs_vals = d_6m.sel(lat=lat, lon=lon, method="nearest").dxsp.values
-            time = H_6m.time.values
-
-            return pd.DataFrame({'site': site_name, 'date': time, 'lat': lat, 'lon': lon, 'd2H': d2H_vals, 'd18O': d18O_vals, 'dxs': dxs_vals})
-        elif input.time_res() == "12mrm":
-
-            # twelve-month running mean
-            H_12m = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_1962-2023_12-month-running-mean.nc")
-            O_12m = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_1962-2023_12-month-running-mean.nc")
-            d_12m = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_1962-2023_12-month-running-mean.nc")
-
-            site_name = input.site_name() if input.site_name() else "site"
-            site_name = site_name.replace(" ", "_")
-            d2H_vals = H_12m.sel(lat=lat, lon=lon, method="nearest").d2Hp.values
-            d18O_vals = O_12m.sel(lat=lat, lon=lon, method="nearest").d18Op.values
-            dxs_vals = d_12m.sel(lat=lat, lon=lon, method="nearest").dxsp.values
-            time = H_12m.time.values
-
-            return pd.DataFrame({'site': site_name, 'date': time, 'lat': lat, 'lon': lon, 'd2H': d2H_vals, 'd18O': d18O_vals, 'dxs': dxs_vals})
+        site_name = input.site_name()
+        cell = nearest_cell(cells, lat, lon)
+        if input.time_res() == "monthly":
+
+            # monthly data (already in memory, packed to land cells)
+            d2H_vals = decode(d2H.isel(cell=cell)).values
+            d18O_vals = decode(d18O.isel(cell=cell)).values
+            dxs_vals = decode(dxs.isel(cell=cell)).values
+            data = point_frame("monthly", site_name, lat, lon, d18O.time.values, d2H_vals, d18O_vals, dxs_vals)
+        elif input.time_res() == "custom":
+
+            # custom running mean or season, from the running sums of this cell's monthly data
+            custom = get_custom_inputs()
+            time, vals = custom_point(cell, *custom)
+            data = point_frame("custom", site_name, lat, lon, time, vals["d2H"], vals["d18O"], vals["dxs"], custom)
         else:
 
-            # monthly data
-            d2H = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d2H_v1_196201-202312_monthly_median.nc")
-            d18O = xr.open_dataset(f"{fpath}netcdfs/aus_prec.d18O_v1_196201-202312_monthly_median.nc")
-            dxs = xr.open_dataset(f"{fpath}netcdfs/aus_prec.dxs_v1_196201-202312_monthly_median.nc")
-
-            site_name = input.site_name() if input.site_name() else "site"
-            site_name = site_name.replace(" ", "_")
-            d2H_vals = d2H.sel(lat=lat, lon=lon, method="nearest").d2Hp.values
-            d18O_vals = d18O.sel(lat=lat, lon=lon, method="nearest").d18Op.values
-            dxs_vals = dxs.sel(lat=lat, lon=lon, method="nearest").dxsp.values
-            time = d18O.time.values
-            
-            return pd.DataFrame({'site_name': site_name, 'date': time, 'lat': lat, 'lon': lon, 'd2H': d2H_vals, 'd18O': d18O_vals, 'dxs': dxs_vals})
+            # annual, seasonal and running-mean products, read from file
+            data = extract_point(lat, lon, input.time_res(), fpath, site_name)
+
+        # anomalies over the whole record (before any date filtering): monthly values from the cached
+        # amount-weighted climatology, other resolutions from the mean of each calendar month
+        if input.anomalies():
+            climatology = {iso: get_climatology(iso)[:, cell] for iso in monthly_pk} if input.time_res() == "monthly" else None
+            data = with_anomalies(data, climatology)
+        return data
 
     # TIMESERIES: we only want to run the actions when the button is clicked
     @reactive.event(input.run_calcs)
@@ -800,21 +1613,14 @@ def server(input, output, session):
         lon = input.lon()
 
         # check ther lat/lon choice is valid
-        ds_check = d18O_ann
-        if not is_valid_point(ds_check, lat, lon):
+        if not is_valid_point(cells, lat, lon):
             ui.notification_show(f"Lat/lon ({lat}, {lon}) is outside the grid area. Please check your coordinates and try again",type="error",duration=None)
             return pd.DataFrame()
 
         data = extract_timeseries(lat, lon)
 
         if input.date_range():
-            start_date = pd.Timestamp(input.date_range()[0])
-            end_date = pd.Timestamp(input.date_range()[1])
-
-            if input.time_res() in ["ann", "ann_trop", "DJF", "MAM", "JJA", "SON"]:
-                data = data[(data['year'] >= start_date) & (data['year'] <= end_date)]
-            else:
-                data = data[(data['date'] >= start_date) & (data['date'] <= end_date)]
+            data = filter_dates(data, *input.date_range())
 
         return data
 
@@ -825,8 +1631,8 @@ def server(input, output, session):
     def plot_ts():
         data = selected_location_data()
         
-        time_ax = "year" if input.time_res() in ["ann", "ann_trop", "DJF", "MAM", "JJA", "SON"] else "date"
-        time_ax_title = "Year" if input.time_res() in ["ann", "ann_trop", "DJF", "MAM", "JJA", "SON"] else "Date"
+        time_ax = "year" if annual_resolution() else "date"
+        time_ax_title = "Year" if annual_resolution() else "Date"
 
         # plotly/shiny together are weird about dates...
         if np.issubdtype(data[time_ax].dtype, np.datetime64):
@@ -839,9 +1645,11 @@ def server(input, output, session):
         d18O_col = "#3e91c7"
         dxs_col = "#729a7e"
 
-        fig.add_trace(go.Scatter(x=data[time_ax], y=data['d2H'], mode='lines+markers',name="δ²H", line=dict(color=d2H_col), yaxis="y1"))
-        fig.add_trace(go.Scatter(x=data[time_ax], y=data['d18O'], mode='lines+markers', name="δ¹⁸O", line=dict(color=d18O_col), yaxis="y2"))
-        fig.add_trace(go.Scatter(x=data[time_ax], y=data['dxs'], mode='lines+markers', name="dxs", line=dict(color=dxs_col), yaxis="y3"))
+        # (the anomaly columns, if they were asked for)
+        col, anom = ("{}_anomaly", r"\Delta ") if "d2H_anomaly" in data else ("{}", "")
+        fig.add_trace(go.Scatter(x=data[time_ax], y=data[col.format('d2H')], mode='lines+markers',name="δ²H", line=dict(color=d2H_col), yaxis="y1"))
+        fig.add_trace(go.Scatter(x=data[time_ax], y=data[col.format('d18O')], mode='lines+markers', name="δ¹⁸O", line=dict(color=d18O_col), yaxis="y2"))
+        fig.add_trace(go.Scatter(x=data[time_ax], y=data[col.format('dxs')], mode='lines+markers', name="dxs", line=dict(color=dxs_col), yaxis="y3"))
 
         fig.update_layout(
             title=None,
@@ -849,11 +1657,11 @@ def server(input, output, session):
             showlegend=False, 
             xaxis=dict(
                 anchor='y3',
-                tickformat="%Y" if input.time_res() in ["ann", "ann_trop", "DJF", "MAM", "JJA", "SON"] else "%Y-%m"
+                tickformat="%Y" if annual_resolution() else "%Y-%m"
             ),
             yaxis=dict(
                 title=dict(
-                    text=r"$\delta^{2}\mathrm{H}\ (\text{‰}_{\text{VSMOW}})$",
+                    text=r"$" + anom + r"\delta^{2}\mathrm{H}\ (\text{‰}_{\text{VSMOW}})$",
                     font=dict(color=d2H_col)
             ),
             domain=[0.7, 1],
@@ -861,7 +1669,7 @@ def server(input, output, session):
 ),
             yaxis2=dict(
                 title=dict(
-                    text=r"$\delta^{18}\mathrm{O}\ (\text{‰}_{\text{VSMOW}})$",
+                    text=r"$" + anom + r"\delta^{18}\mathrm{O}\ (\text{‰}_{\text{VSMOW}})$",
                     font=dict(color=d18O_col) 
                 ),
             domain=[0.35, 0.7],
@@ -869,7 +1677,7 @@ def server(input, output, session):
             ),
             yaxis3=dict(
                 title=dict(
-                    text=r"$\mathit{dxs}\ (\text{‰}_{\text{VSMOW}})$",
+                    text=r"$" + anom + r"\mathit{dxs}\ (\text{‰}_{\text{VSMOW}})$",
                     font=dict(color=dxs_col)
                 ),
             domain=[0, 0.35],
@@ -908,13 +1716,15 @@ def server(input, output, session):
     @reactive.event(input.run_calcs)
     def lmwl():
         data = selected_location_data()
-        if input.time_res() in ["ann", "ann_trop", "DJF", "MAM", "JJA", "SON"]:
+        if annual_resolution():
             resolution = "annual"
+        elif input.time_res() == "custom":
+            resolution = custom_label()
         else:
             resolution = input.time_res()
         site_label = input.site_name() or f"[{input.lat()}, {input.lon()}]"
 
-        if resolution in ["monthly", "3mrm", "6mrm", "12mrm"]:
+        if not annual_resolution():
             months = data['date'].dt.month
             colours = months
             hover_text = data['date'].dt.strftime("%b %Y")
@@ -939,6 +1749,27 @@ def server(input, output, session):
             showlegend=False
         ))
 
+        # local meteoric water line for the selected cell (fitted to the monthly values)
+        cell = nearest_cell(cells, input.lat(), input.lon())
+        if cell >= 0:
+            fit = get_lmwl_fits().isel(cell=cell).sel(fit=input.lmwl_method())
+            slope, intercept, r2 = float(fit.slope), float(fit.intercept), float(fit.r2)
+            if np.isfinite(slope):
+                fig.add_trace(go.Scatter(
+                    x=x_line,
+                    y=[slope * x + intercept for x in x_line],
+                    mode="lines",
+                    line=dict(color="#3e91c7", width = 1.5, dash = "dash"),
+                    name="",
+                    hoverinfo="skip",
+                    showlegend=False
+                ))
+                fig.add_annotation(
+                    text=f"LMWL ({LMWL_METHODS[input.lmwl_method()]}, monthly): δ²H = {slope:.2f} δ¹⁸O + {intercept:.2f}, r² = {r2:.2f}<br>GMWL: δ²H = 8 δ¹⁸O + 10",
+                    xref="paper", yref="paper", x=0, y=1, xanchor="left", yanchor="top",
+                    showarrow=False, align="left", font=dict(size=10)
+                )
+
         fig.add_trace(go.Scatter(
             x = data["d18O"],
             y = data["d2H"],
@@ -968,61 +1799,56 @@ def server(input, output, session):
 
         return fig  
 
-    # TIMESERIES: download a csv with values for the selected location
+    # TIMESERIES: download the values for the selected location as csv, or as parquet/arrow with the
+    # dataset details in the file metadata
     @output
-    @render.download(filename=lambda: generate_csv_fname())
+    @render.download(filename=lambda: generate_csv_fname(ext=download_ext[input.download_format()]))
     def download_csv():
-
-        # metadata for the csv header
-        metadata = [
-          f"# Data downloaded {datetime.now().strftime('%Y-%m-%d')}",
-          "# Please see Falster et al 2025 (HESS) for reference and data details"
-        ]
-
-        if input.time_res() in ["ann", "ann_trop", "DJF", "MAM", "JJA", "SON"]:
-            data = selected_location_data()
-            data['year'] = pd.to_datetime(data['year'], format='%Y').dt.year
+        if input.download_format() == "csv":
+            yield from csv_chunks(selected_location_data(), input.site_name())
         else:
-            data = selected_location_data() 
-
-        if not input.site_name():
-            data['site_name'] = 'no_sitename_specified'
+            data = download_frame(selected_location_data(), input.site_name())
+            yield from table_stream([data], input.download_format(), download_metadata())
 
-        for line in metadata:
-            yield line + "\n"
-            
-        yield data.to_csv(index=False)
-    
-    # function to generate the csv filename
-    def generate_csv_fname():
-        site_name = f"{input.site_name()}_" if input.site_name() else ""
+    # TIMESERIES: download every resolution for the selected location, read one resolution at a time
+    # and streamed out as a zip of csv files or one long-format parquet file
+    @output
+    @render.download(filename=lambda: generate_csv_fname("all", download_ext[input.export_format()]))
+    def download_all():
         lat = input.lat()
         lon = input.lon()
-        start_date = input.date_range()[0] if input.date_range() else "1962-01-01"
-        end_date = input.date_range()[1] if input.date_range() else "2023-12-31"
-
-        start_date = start_date.strftime("%Y%m%d")
-        end_date = end_date.strftime("%Y%m%d")
-
-        resolution = input.time_res()
-
-        # update to add a readme tab
-        filename = f"{site_name}lat{lat}_lon{lon}_{resolution}_{start_date}-{end_date}.csv"
-        filename = filename.replace("/", "_").replace("\\", "_").replace(" ", "")
+        if not is_valid_point(cells, lat, lon):
+            ui.notification_show(f"Lat/lon ({lat}, {lon}) is outside the grid area. Please check your coordinates and try again",type="error",duration=None)
+            return
 
-        return filename
+        custom = get_custom_inputs() if input.time_res() == "custom" else None
+        items = extract_all(lat, lon, fpath, input.site_name(), input.date_range(), custom)
+        if input.export_format() == "zip":
+            yield from zip_stream(items, input.site_name())
+        else:
+            frames = (long_frame(data, label) for label, data in items)
+            yield from table_stream(frames, input.export_format(), download_metadata("all"))
+
+    # dataset details stored in parquet/arrow downloads
+    def download_metadata(resolution=None):
+        if resolution is None:
+            resolution = input.time_res() if input.time_res() != "custom" else custom_label()
+        date_range = "/".join(str(d) for d in input.date_range()) if input.date_range() else None
+        return dataset_metadata(site_name=input.site_name() or None, lat=input.lat(), lon=input.lon(),
+                                resolution=resolution, date_range=date_range)
     
-    # SPATIAL SEARCH: a function to select the appropriate dataset
-
-    @reactive.calc
-    def get_chosen_system():
-        if input.isotope() == "d2H":
-            return d2H.d2Hp, d2H_ann.d2Hp, d2H_mean.d2Hp
-        if input.isotope() == 'd18O':
-            return d18O.d18Op, d18O_ann.d18Op, d18O_mean.d18Op
-        if input.isotope() == 'dxs':
-            return dxs.dxsp, dxs_ann.dxsp, dxs_mean.dxsp
+    # short label for a custom window, e.g. "9mrm" or "Nov-Mar"
+    def custom_label():
+        return window_label(*get_custom_inputs())
 
+    # function to generate the csv filename
+    def generate_csv_fname(resolution=None, ext=".csv"):
+        start_date = input.date_range()[0] if input.date_range() else pd.Timestamp(f"{year_first}-01-01")
+        end_date = input.date_range()[1] if input.date_range() else pd.Timestamp(f"{year_last}-12-31")
+        if resolution is None:
+            resolution = input.time_res() if input.time_res() != "custom" else custom_label()
+        return csv_filename(input.site_name(), input.lat(), input.lon(), resolution, start_date, end_date, ext)
+    
     # SPATIAL SEARCH: a function to update the time inputs
     @reactive.calc
     def get_time_inputs():
@@ -1033,47 +1859,319 @@ def server(input, output, session):
 
         return months, year_start, year_end
         
+    # SPATIAL SEARCH: mean surface of one isotope system (over the land cells) for the chosen search type
+    def mean_surface(iso):
+        if input.search_type() =="Long-term mean":
+            return get_mean_surface(iso, "Long-term mean", year_first, year_last, tuple(range(1, 13)), search_region())
+        months, year_start, year_end = get_time_inputs()
+        return get_mean_surface(iso, "Mean over time period", year_start, year_end, tuple(sorted(months)), search_region())
+
+    # SPATIAL SEARCH: interannual standard deviation of one isotope system for the chosen search type.
+    # Cells with fewer than two valid years have no spread (zero), so only the measurement sd is used there
+    def spread_surface(iso):
+        if input.search_type() =="Long-term mean":
+            return np.nan_to_num(get_interannual_sd(iso, tuple(range(1, 13)), year_first, year_last, search_region()))
+        months, year_start, year_end = get_time_inputs()
+        if year_start == year_end:
+            ui.notification_show("A single year has no interannual variability: only the measurement standard deviation is used",
+                                 type="warning", duration=8)
+        return np.nan_to_num(get_interannual_sd(iso, tuple(sorted(months)), year_start, year_end, search_region()))
+
+    # SPATIAL SEARCH: the search region, as a key for get_region_cells (None for the whole continent)
+    @reactive.calc
+    def search_region():
+        kind = input.region_type()
+        if kind == "all":
+            return None
+        if kind == "bbox":
+            lats, lons = (input.region_lat_min(), input.region_lat_max()), (input.region_lon_min(), input.region_lon_max())
+            req(all(x is not None for x in lats + lons))
+            region = ("bbox", (min(lats), max(lats), min(lons), max(lons)))
+        elif kind == "state":
+            region = ("state", input.region_state())
+        else:
+            file = input.region_file()
+            req(file)
+            region = ("file", file[0]["datapath"])
+        try:
+            n_cells = len(get_region_cells(*region))
+        except Exception as err:
+            ui.notification_show(f"Search region: {err}", type="error", duration=None)
+            req(False)
+        if n_cells == 0:
+            ui.notification_show("Search region: there are no land cells in this region", type="error", duration=None)
+            req(False)
+        return region
+
+    # SPATIAL SEARCH: the offset subtracted from the sample value: a number, or a surface over the land
+    # cells applied cell by cell
+    def offset_varies():
+        return input.search_mode() in ("band", "prob", "years") and input.offset_type() != "constant"
+
+    @reactive.calc
+    def offset_surface():
+        if not offset_varies():
+            return input.offset()
+        if input.offset_type() == "prec":
+            return input.offset_intercept() + input.offset_slope() * get_mean_annual_prec() / 100
+        file = input.offset_file()
+        req(file)
+        try:
+            return get_offset_upload(file[0]["datapath"])
+        except Exception as err:
+            ui.notification_show(f"Offset surface: {err}", type="error", duration=None)
+            req(False)
+
+    # SPATIAL SEARCH: the offset, described for titles and downloads
+    def offset_description():
+        if not offset_varies():
+            return input.offset()
+        if input.offset_type() == "prec":
+            return f"{input.offset_intercept():g}‰ {input.offset_slope():+g}‰ per 100 mm/yr of mean annual precipitation"
+        return f"surface from {input.offset_file()[0]['name']}"
+
     # SPATIAL SEARCH: perform the spatial search
     @reactive.calc
     def get_mapdata():
-        dat_mth, dat_ann, dat_mean = get_chosen_system()
-
         input_val = input.input_val()
         input_range = input.input_range()
-        offset = input.offset()
+        offset = offset_surface()
 
         input_val_adj = input_val-offset
         input_lwr = input_val_adj-input_range
         input_upr = input_val_adj+input_range
 
-        # do we need to to any calculations:
-        if input.search_type() =="Long-term mean":
-            exact_match = dat_mean.where((dat_mean >= input_lwr) & (dat_mean <= input_upr))
-            return exact_match
+        dat_mean = mean_surface(input.isotope())
+
+        # find matches, and put them back on the grid for plotting
+        with np.errstate(invalid="ignore"):
+            exact_match = np.where((dat_mean >= input_lwr) & (dat_mean <= input_upr), dat_mean, np.nan)
+
+        # and list the locations closest to the sample value, whether or not they are in range
+        nearest = closest_cells(dat_mean, input_val_adj, input.n_closest() or 0)
+        names, index = get_state_index()
+        closest = pd.DataFrame({"Rank": np.arange(1, len(nearest) + 1), "Latitude": cells.lat[nearest], "Longitude": cells.lon[nearest],
+                                "Value (‰)": dat_mean[nearest], "Misfit (‰)": dat_mean[nearest] - np.broadcast_to(input_val_adj, dat_mean.shape)[nearest],
+                                "State/territory": np.asarray(names, dtype=object)[index[nearest]]})
+        return unpack(exact_match, cells), closest
+    
+    # SPATIAL SEARCH: joint d2H/d18O search, scoring every cell with a bivariate Gaussian likelihood
+    @reactive.calc
+    def get_joint_probability():
+        x = input.joint_d18O() - input.joint_offset_d18O()
+        y = input.joint_d2H() - input.joint_offset_d2H()
+        sx, sy = input.joint_d18O_sd(), input.joint_d2H_sd()
+        try:
+            if input.joint_interannual():
+                # add each cell's interannual variance to the measurement variances
+                sx = np.sqrt(sx**2 + spread_surface("d18O")**2)
+                sy = np.sqrt(sy**2 + spread_surface("d2H")**2)
+            prob = bivariate_probability(mean_surface("d18O"), mean_surface("d2H"), x, y, sx, sy, input.joint_cov() or 0.)
+        except (ValueError, TypeError) as err:
+            ui.notification_show(f"Joint search: {err}", type="error", duration=None)
+            req(False)
+        return unpack(prob, cells)
+
+    # SPATIAL SEARCH: probability search for one isotope system, with each cell's spread the measurement
+    # and interannual variances combined
+    @reactive.calc
+    def get_probability():
+        iso = input.isotope()
+        try:
+            sd = np.sqrt(input.prob_sd()**2 + spread_surface(iso)**2)
+            prob = gaussian_probability(mean_surface(iso), input.input_val() - offset_surface(), sd)
+        except (ValueError, TypeError) as err:
+            ui.notification_show(f"Probability search: {err}", type="error", duration=None)
+            req(False)
+        return unpack(prob, cells)
+
+    # SPATIAL SEARCH: matching years search. Each year's amount-weighted mean of the chosen months is
+    # compared with the band, and the years matched by each cell are kept as packed bits
+    @reactive.calc
+    def get_year_matches():
+        if input.search_type() == "Long-term mean":
+            months, year_start, year_end = list(range(1, 13)), year_first, year_last
         else:
             months, year_start, year_end = get_time_inputs()
+        # (only the search region's cells are compared, then scattered back to all the land cells)
+        region = search_region()
+        sel = slice(None) if region is None else get_region_cells(*region)
+        years, vals = get_annual_values(input.isotope(), tuple(sorted(months)), region)
+        keep = (years >= year_start) & (years <= year_end)
+        centre = input.input_val() - offset_surface()
+        if np.ndim(centre):
+            centre = centre[sel]
+        region_bits = year_match_bits(vals[keep], centre - input.input_range(), centre + input.input_range())
+        valid = np.zeros(len(cells.index), dtype=bool)
+        valid[sel] = np.isfinite(vals[keep]).any(axis=0)
+        bits = np.zeros((len(cells.index), region_bits.shape[1]), dtype=np.uint8)
+        bits[sel] = region_bits
+        bits[~valid] = 0
+        return years[keep], bits, valid
+
+    # SPATIAL SEARCH: the years matched by the location clicked on the map
+    @output
+    @render.ui
+    def year_list():
+        result = last_search.get()
+        click = input.plot_matches_click()
+        req(result is not None and result["mode"] == "years")
+        if click is None:
+            return ui.markdown("Click a location on the map to list the years in which it matches.")
+        # (clicks off the map, e.g. on the colour bar, are outside the grid)
+        inside = (cells.grid_lat.min() <= click["y"] <= cells.grid_lat.max()) and (cells.grid_lon.min() <= click["x"] <= cells.grid_lon.max())
+        cell = nearest_cell(cells, click["y"], click["x"]) if inside else -1
+        if cell < 0:
+            return ui.markdown("No data at this location (ocean or outside the model domain).")
+        years, bits = result["years"]
+        matched = matching_years(bits[cell], years)
+        text = ", ".join(str(y) for y in matched) if len(matched) else "none"
+        return ui.markdown(f"**{cells.lat[cell]:.2f}°, {cells.lon[cell]:.2f}°** matches in {len(matched)} of {len(years)} years: {text}")
+
+    # SPATIAL SEARCH: batch search of an uploaded sample table. Each isotope's mean surface is computed
+    # once and all samples are matched against it together
+    @reactive.calc
+    def get_batch_samples():
+        file = input.batch_file()
+        req(file)
+        try:
+            return sample_table(pd.read_csv(file[0]["datapath"], comment="#"), input.isotope(), input.offset() or 0., input.input_range() or 0.)
+        except Exception as err:
+            ui.notification_show(f"Batch search: {err}", type="error", duration=None)
+            req(False)
 
+    @reactive.calc
+    def get_batch_matches():
+        samples = get_batch_samples()
+        means = {iso: mean_surface(iso) for iso in samples["isotope"].unique()}
+        matches = batch_matches(means, samples)
+        valid = np.all([np.isfinite(mean) for mean in means.values()], axis=0)
+        return samples, matches, match_frequency(matches, valid)
+
+    # SPATIAL SEARCH: batch results on the grid, per sample and as the fraction of samples matching
+    def batch_dataset():
+        samples, matches, freq = get_batch_matches()
+        match_grid = unpack(np.where(np.isfinite(freq), matches, np.nan), cells)
+        ds = xr.Dataset({
+            "match": (("sample", "lat", "lon"), match_grid.values),
+            "match_frequency": unpack(freq, cells),
+            "n_matching_cells": ("sample", matches.sum(axis=1)),
+        }, coords={"sample": samples["sample"].values, "isotope": ("sample", samples["isotope"].values),
+                   "value": ("sample", samples["value"].values), "offset": ("sample", samples["offset"].values),
+                   "range": ("sample", samples["range"].values)})
+        ds["match"].attrs["description"] = "1 where the location's mean is within range of the sample value (after offset), 0 otherwise"
+        ds["match_frequency"].attrs["description"] = "fraction of samples matching the location"
+        ds.attrs.update(dataset_metadata(search_type=input.search_type(), **search_period()))
+        return ds
+
+    # SPATIAL SEARCH: years and months behind the mean surfaces, for the batch download metadata
+    def search_period():
+        if input.search_type() == "Long-term mean":
+            return {"years": f"{year_first}-{year_last}", "months": "1-12"}
+        months, year_start, year_end = get_time_inputs()
+        return {"years": f"{year_start}-{year_end}", "months": ",".join(str(m) for m in months)}
+
+    @output
+    @render.download(filename=lambda: f"batch_search_{len(get_batch_samples())}samples" + (".nc" if input.batch_format() == "netcdf" else ".csv"))
+    def download_batch():
+        ds = batch_dataset()
+        if input.batch_format() == "netcdf":
+            yield from netcdf_stream(ds, encoding={"match": {"dtype": "int8", "_FillValue": -1, "zlib": True},
+                                                   "match_frequency": {"dtype": "float32", "zlib": True}})
+        else:
+            # one row per land cell: the match frequency then a 0/1 column per sample
+            samples, matches, freq = get_batch_matches()
+            table = pd.DataFrame({"lat": cells.lat, "lon": cells.lon, "match_frequency": freq})
+            table = pd.concat([table, pd.DataFrame(matches.T.astype(np.int8), columns=samples["sample"].values)], axis=1)
+            for line in csv_metadata():
+                yield line + "\n"
+            for r0 in range(0, len(table), ROW_GROUP):
+                yield table.iloc[r0:r0 + ROW_GROUP].to_csv(index=False, header=r0 == 0)
+
+    # SPATIAL SEARCH: the last search shown, for the map downloads (so they never re-run the search)
+    last_search = reactive.value(None)
+
+    # SPATIAL SEARCH: the search settings, stored with the downloads
+    def search_parameters():
+        mode = input.search_mode()
+        params = {"search_mode": mode, "search_type": input.search_type(), **search_period()}
+        if search_region() is not None:
+            kind, key = search_region()
+            params.update(search_region=input.region_file()[0]["name"] if kind == "file" else str(key))
+        if mode == "joint":
+            params.update(d2H=input.joint_d2H(), d2H_sd=input.joint_d2H_sd(), d18O=input.joint_d18O(), d18O_sd=input.joint_d18O_sd(),
+                          covariance=input.joint_cov() or 0., d2H_offset=input.joint_offset_d2H(), d18O_offset=input.joint_offset_d18O(),
+                          interannual_variability=input.joint_interannual())
+        elif mode == "batch":
+            params.update(n_samples=len(get_batch_samples()))
+        else:
+            params.update(isotope=input.isotope(), value=input.input_val(), offset=offset_description())
+            if mode in ("band", "years"):
+                params.update(range=input.input_range())
+            else:
+                params.update(measurement_sd=input.prob_sd())
+        return dataset_metadata(**params)
+
+    # SPATIAL SEARCH: download the last search as a netcdf subset, a GeoTIFF or GeoJSON polygons of the
+    # matching cells
+    @output
+    @render.download(filename=lambda: f"spatial_search_{(last_search.get() or {}).get('mode', 'none')}{download_ext[input.map_format()]}")
+    def download_map():
+        result = last_search.get()
+        if result is None:
+            ui.notification_show("Please run a search first", type="warning")
+            return
+        if input.map_format() == "netcdf":
+            # cropped to the box around the matching cells
+            matched = result["matched"]
+            rows, cols = np.flatnonzero(matched.any("lon")), np.flatnonzero(matched.any("lat"))
+            ds = xr.Dataset({result["map"].name: result["map"], "matched": matched.astype(np.int8)})
+            if len(rows):
+                ds = ds.isel(lat=slice(rows[0], rows[-1] + 1), lon=slice(cols[0], cols[-1] + 1))
+            ds.attrs.update(result["parameters"])
+            yield from netcdf_stream(ds, encoding={result["map"].name: {"dtype": "float32", "zlib": True},
+                                                   "matched": {"zlib": True}})
+        elif input.map_format() == "geotiff":
+            yield from geotiff_stream(result["map"])
+        else:
+            lat, lon = result["matched"].lat.values, result["matched"].lon.values
+            polygons = mask_polygons(result["matched"].values, lat, lon)
+            cell_area = abs((lat[1] - lat[0]) * (lon[1] - lon[0]))
+            yield from geojson_stream(polygons, cell_area, {"search_mode": result["mode"]})
+
+    # SPATIAL SEARCH: matched area of the last search, in total and by state/territory
+    @output
+    @render.table
+    def match_summary():
+        result = last_search.get()
+        req(result is not None)
+        matched = result["matched"].values.ravel()[cells.index]
+        names, index = get_state_index()
+        table = region_summary(matched, cell_area_km2, index, names, total_name="Australia")
+        table = table.rename(columns={"Region": "State/territory"})
+        return (table.style.hide(axis="index")
+                .format({"Matched area (km²)": "{:,.0f}", "Region matched (%)": "{:.1f}", "Share of matched area (%)": "{:.1f}"}))
+
+    # SPATIAL SEARCH: the locations of the last search closest to the sample value
+    @output
+    @render.table
+    def closest_table():
+        result = last_search.get()
+        req(result is not None and "closest" in result and len(result["closest"]))
+        return (result["closest"].style.hide(axis="index")
+                .format({"Latitude": "{:.2f}", "Longitude": "{:.2f}", "Value (‰)": "{:.2f}", "Misfit (‰)": "{:+.2f}"}))
+
+    @output
+    @render.download(filename=lambda: f"spatial_search_closest_{len((last_search.get() or {}).get('closest', []))}.csv")
+    def download_closest():
+        result = last_search.get()
+        if result is None or "closest" not in result:
+            ui.notification_show("Please run a search first", type="warning")
+            return
+        for line in csv_metadata():
+            yield line + "\n"
+        yield result["closest"].to_csv(index=False)
 
-            dat_red = dat_mth.where(
-                ((dat_mth['time.year'] >= year_start) & (dat_mth['time.year'] <= year_end)) &
-                (dat_mth['time'].dt.month.isin(months)), drop=True)
-            
-            prec_red = prec.where(
-                ((prec['time.year'] >= year_start) & (prec['time.year'] <= year_end)) &
-                (prec['time'].dt.month.isin(months)), drop=True)
-            
-            # amount-weight the values
-            PREC_mth = prec_red.groupby('time.year')
-            PREC_ann = prec_red.groupby('time.year').sum()
-                
-            dat_wtd = (dat_red*(PREC_mth/PREC_ann)).resample(time='YE').sum()
-            dat_wtd = dat_wtd.where(dat_wtd != 0.)
-            dat_wtd_mean = dat_wtd.mean(dim="time") 
-
-            # find matches
-            exact_match = dat_wtd_mean.where((dat_wtd_mean >= input_lwr) & (dat_wtd_mean <= input_upr)) 
-            return exact_match
-    
     # SPATIAL SEARCH: make the plot
     @output
     @render.plot
@@ -1120,11 +2218,10 @@ def server(input, output, session):
         
             return vmin, vmax, extend_type, cmap
     
-        map_dat = get_mapdata()
-
         input_val = input.input_val()
         input_range = input.input_range()
-        offset = input.offset()
+        # (an offset surface is applied cell by cell, so the titles give the sample value itself)
+        offset = 0 if offset_varies() else input.offset()
 
         input_val_adj = input_val-offset
         input_lwr = input_val_adj-input_range
@@ -1149,13 +2246,75 @@ def server(input, output, session):
 
         vmin, vmax, extend_type, cmap = get_value_lims(input.search_type(), input_lwr, input_upr)
 
+        if input.search_mode() == "joint":
+            # relative probability map of the joint search
+            map_dat = get_joint_probability()
+            title = (r"Relative probability of origin for $\delta^{2}\mathrm{H}$" + f" = {input.joint_d2H():.1f} ± {input.joint_d2H_sd():.1f}‰ and "
+                     + r"$\delta^{18}\mathrm{O}$" + f" = {input.joint_d18O():.2f} ± {input.joint_d18O_sd():.2f}‰")
+            label = "Probability (per grid cell)"
+            vmin, vmax, extend_type, cmap = 0, float(map_dat.max()), "neither", "viridis"
+        elif input.search_mode() == "batch":
+            # fraction of the uploaded samples matching each location
+            samples, matches, freq = get_batch_matches()
+            map_dat = unpack(freq, cells)
+            title = f"Fraction of the {len(samples)} samples matching each location"
+            label = "Fraction of samples"
+            vmin, vmax, extend_type, cmap = 0, 1, "neither", "viridis"
+        elif input.search_mode() == "prob":
+            # relative probability map of the single-isotope search
+            map_dat = get_probability()
+            system_str = ISO_LABELS[input.isotope()]
+            title = "Relative probability of origin for precipitation " + system_str + f" = {input_val_adj:.2f} ± {input.prob_sd():.2f}‰"
+            subtitle = subtitle + " (measurement uncertainty and interannual variability combined)"
+            label = "Probability (per grid cell)"
+            vmin, vmax, extend_type, cmap = 0, float(map_dat.max()), "neither", "viridis"
+        elif input.search_mode() == "years":
+            # number of years in which each location matches
+            years, bits, valid = get_year_matches()
+            map_dat = unpack(np.where(valid, match_count(bits), np.nan), cells)
+            system_str = ISO_LABELS[input.isotope()]
+            title = f"Number of years in which precipitation {system_str} is between {input_lwr:.2f}‰ and {input_upr:.2f}‰"
+            subtitle = f"{years[0]} to {years[-1]}" + ("" if input.search_type() == "Long-term mean" else f", amount-weighted mean of months {', '.join(these_months)}")
+            label = "Matching years"
+            vmin, vmax, extend_type, cmap = 0, len(years), "neither", "viridis"
+        else:
+            map_dat, closest = get_mapdata()
+            if offset_varies() and bool(map_dat.notnull().any()):
+                # the matched values vary with the offset
+                vmin, vmax = float(map_dat.min()), float(map_dat.max())
+
+        if offset_varies():
+            title = title.replace(" is between", " + offset is between").replace(" = ", " + offset = ", 1)
+
+        # keep the result for the downloads, with the cells counted as matches: inside the band, matched
+        # by at least one sample, or within the 95% highest-probability region
+        if input.search_mode() == "band":
+            matched = map_dat.notnull()
+        elif input.search_mode() in ("batch", "years"):
+            matched = map_dat > 0
+        else:
+            matched = map_dat.copy(data=credible_region(map_dat.values, 0.95))
+        result = {"mode": input.search_mode(), "map": map_dat.rename(map_names[input.search_mode()]),
+                  "matched": matched, "parameters": search_parameters()}
+        if input.search_mode() == "years":
+            # the packed matches, for listing a clicked location's years
+            result["years"] = (years, bits)
+        elif input.search_mode() == "band":
+            result["closest"] = closest
+        last_search.set(result)
+
         # now make the graphic
         fig, ax = plt.subplots(figsize=(10, 6), subplot_kw={'projection': new_proj})
         
         im = map_dat.plot(ax=ax, transform=dat_proj, cmap=cmap,
                          add_colorbar=False, vmin=vmin, vmax=vmax, add_labels=False)
         
-        ax.set_extent([110, 155, -45, -10], crs=ccrs.PlateCarree())
+        # zoomed to the search region, if there is one
+        extent = [110, 155, -45, -10]
+        if search_region() is not None:
+            sel = get_region_cells(*search_region())
+            extent = [cells.lon[sel].min() - 1, cells.lon[sel].max() + 1, cells.lat[sel].min() - 1, cells.lat[sel].max() + 1]
+        ax.set_extent(extent, crs=ccrs.PlateCarree())
 
         shpfilename = natural_earth(resolution='10m',category='cultural',name='admin_0_countries')
         reader = Reader(shpfilename)
@@ -1175,6 +2334,9 @@ def server(input, output, session):
         ax.set_title(title, fontname='Arial', color='black', fontsize=12, loc="left", pad=20)
         ax.text(0, 0.99, subtitle, ha='left', va='bottom', transform=ax.transAxes,
                 fontname='Arial', color='black', fontsize=10)
+        if offset_varies():
+            ax.text(0, -0.01, f"Offset: {offset_description()}", ha='left', va='top', transform=ax.transAxes,
+                    fontname='Arial', color='black', fontsize=9)
 
         ax.axis('off')
 
@@ -0,0 +1,329 @@
+"""Loading helpers shared by the web app and the offline tools."""
+import functools
+import threading
+import warnings
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# compact storage: isotope values in 0.01 permil steps as int16, precipitation as float32
+ISO_SCALE = 0.01
+INT16_FILL = np.int16(-32768)
+
+
+# encoding for one variable in compact storage. int16 packing centres the data range on add_offset;
+# variables whose range does not fit in int16 at 0.01 permil fall back to float32
+def compact_encoding(da, dtype="int16"):
+    if da.name == "prec" or dtype == "float32":
+        return {"dtype": "float32", "_FillValue": np.float32(np.nan)}
+    if not np.isfinite(da.values).any():
+        return {"dtype": "float32", "_FillValue": np.float32(np.nan)}
+    vmin, vmax = float(np.nanmin(da.values)), float(np.nanmax(da.values))
+    offset = float(np.round((vmin + vmax) / 2))
+    if (vmax - vmin) / ISO_SCALE >= 2 * 32767:
+        return {"dtype": "float32", "_FillValue": np.float32(np.nan)}
+    return {"dtype": "int16", "scale_factor": ISO_SCALE, "add_offset": offset, "_FillValue": INT16_FILL}
+
+# the values a variable will have after a round trip through `encoding`
+def quantise(vals, encoding):
+    if encoding["dtype"] == "float32":
+        return vals.astype(np.float32).astype(np.float64)
+    scale, offset = encoding["scale_factor"], encoding["add_offset"]
+    return np.round((vals - offset) / scale) * scale + offset
+
+# quantisation error between original and stored values (NaNs must match)
+def quantisation_error(orig, stored):
+    orig, stored = np.asarray(orig, dtype=np.float64), np.asarray(stored, dtype=np.float64)
+    both = np.isfinite(orig) & np.isfinite(stored)
+    diff = (stored - orig)[both]
+    return {
+        "max_abs_err": float(np.abs(diff).max()) if diff.size else np.nan,
+        "rmse": float(np.sqrt(np.mean(diff**2))) if diff.size else np.nan,
+        "nan_mismatch": int((np.isfinite(orig) != np.isfinite(stored)).sum()),
+    }
+
+
+# open a data file. In compact mode the values are read into memory as stored (int16 isotopes stay
+# int16, anything wider than float32 is narrowed to float32) and only turned back into physical
+# values by `decode`, which should be applied after subsetting, right before any arithmetic
+def open_cube(path, compact=False):
+    if not compact:
+        return xr.open_dataset(path)
+    ds = xr.open_dataset(path, mask_and_scale=False)
+    for var in ds.data_vars:
+        if ds[var].dtype.kind == "f" and ds[var].dtype.itemsize > 4:
+            ds[var] = ds[var].astype(np.float32)
+    return ds.load()
+
+# physical (float32, NaN-filled) values of a compact-stored DataArray or Dataset. Already decoded
+# data are returned unchanged
+def decode(dat):
+    if isinstance(dat, xr.Dataset):
+        return dat.map(decode, keep_attrs=True)
+    scale = dat.attrs.get("scale_factor")
+    offset = dat.attrs.get("add_offset")
+    fill = dat.attrs.get("_FillValue", dat.attrs.get("missing_value"))
+    if scale is None and offset is None and (fill is None or np.isnan(fill)):
+        return dat
+    raw = dat.values
+    vals = raw.astype(np.float32)
+    if fill is not None and not np.isnan(fill):
+        vals[raw == fill] = np.nan
+    if scale is not None:
+        vals *= np.float32(scale)
+    if offset is not None:
+        vals += np.float32(offset)
+    out = dat.copy(data=vals)
+    out.attrs = {k: v for k, v in dat.attrs.items() if k not in ("scale_factor", "add_offset", "_FillValue", "missing_value")}
+    return out
+
+
+# LAND CELLS
+# most of the lat/lon box is ocean, so calculations work on packed (..., cell) arrays of the land
+# cells only. `index` holds each land cell's position in the flattened (lat, lon) grid and `lookup`
+# maps a flattened grid position back to its cell (-1 for ocean)
+LandCells = namedtuple("LandCells", ["index", "lookup", "lat", "lon", "grid_lat", "grid_lon"])
+
+def land_cells(mask):
+    mask = mask.transpose("lat", "lon")
+    index = np.flatnonzero(mask.values)
+    lookup = np.full(mask.size, -1, dtype=np.int64)
+    lookup[index] = np.arange(len(index))
+    lat2d, lon2d = np.meshgrid(mask.lat.values, mask.lon.values, indexing="ij")
+    return LandCells(index, lookup, lat2d.ravel()[index], lon2d.ravel()[index], mask.lat, mask.lon)
+
+# pack a (..., lat, lon) DataArray into a contiguous (..., cell) DataArray, keeping the stored
+# values and attributes (so compact data can still be decoded)
+def pack(da, cells):
+    da = da.transpose(..., "lat", "lon")
+    if da.shape[-2:] != (len(cells.grid_lat), len(cells.grid_lon)):
+        raise ValueError(f"{da.name} is on a {da.shape[-2:]} grid, expected {(len(cells.grid_lat), len(cells.grid_lon))}")
+    lead = da.dims[:-2]
+    vals = np.ascontiguousarray(da.values.reshape(da.shape[:-2] + (-1,))[..., cells.index])
+    coords = {dim: da[dim] for dim in lead if dim in da.coords}
+    coords.update(lat=("cell", cells.lat), lon=("cell", cells.lon))
+    return xr.DataArray(vals, dims=lead + ("cell",), coords=coords, attrs=da.attrs, name=da.name)
+
+# scatter packed (..., cell) values back onto the 2-D grid (NaN over the ocean), e.g. for plotting
+def unpack(dat, cells, name=None):
+    vals = np.asarray(dat.values if isinstance(dat, xr.DataArray) else dat)
+    lead_shape = vals.shape[:-1]
+    out = np.full(lead_shape + (len(cells.grid_lat) * len(cells.grid_lon),), np.nan,
+                  dtype=np.result_type(vals.dtype, np.float32))
+    out[..., cells.index] = vals
+    out = out.reshape(lead_shape + (len(cells.grid_lat), len(cells.grid_lon)))
+    coords = {"lat": cells.grid_lat, "lon": cells.grid_lon}
+    if isinstance(dat, xr.DataArray):
+        lead = dat.dims[:-1]
+        coords.update({dim: dat[dim] for dim in lead if dim in dat.coords})
+        name = name or dat.name
+    else:
+        lead = tuple(f"dim_{i}" for i in range(len(lead_shape)))
+    return xr.DataArray(out, dims=lead + ("lat", "lon"), coords=coords, name=name)
+
+# packed index of the grid cell nearest to (lat, lon), as `.sel(method="nearest")` would pick it;
+# -1 if that cell is ocean
+def nearest_cell(cells, lat, lon):
+    i = int(np.abs(cells.grid_lat.values - lat).argmin())
+    j = int(np.abs(cells.grid_lon.values - lon).argmin())
+    return int(cells.lookup[i * len(cells.grid_lon) + j])
+
+# values of a 2-D (lat, lon) DataArray on any regular grid at the land cells, taking the nearest
+# point within half a grid spacing (NaN where the grid does not reach)
+def to_cells(da, cells):
+    da = da.rename({k: v for k, v in {"latitude": "lat", "longitude": "lon"}.items() if k in da.dims})
+    da = da.squeeze(drop=True)
+    if set(da.dims) != {"lat", "lon"}:
+        raise ValueError(f"expected a 2-D (lat, lon) variable, got dimensions {da.dims}")
+    da = da.sortby("lat").sortby("lon").transpose("lat", "lon")
+    tol = max(np.abs(np.diff(da.lat.values)).max(initial=0), np.abs(np.diff(da.lon.values)).max(initial=0)) / 2
+    lat = xr.DataArray(cells.lat, dims="cell")
+    lon = xr.DataArray(cells.lon, dims="cell")
+    # (nearest on each axis, then blank the points further than `tol` from the grid)
+    vals = da.sel(lat=lat, lon=lon, method="nearest")
+    far = (np.abs(vals.lat.values - cells.lat) > tol + 1e-9) | (np.abs(vals.lon.values - cells.lon) > tol + 1e-9)
+    return np.where(far, np.nan, vals.values.astype(np.float64))
+
+
+# AGGREGATION
+# running sum of prec along the first (time) axis, with a leading zero so that the sum over months
+# [a, b) is cs[b] - cs[a]. It does not depend on the isotope, so it can be shared by all three
+def prec_sums(prec):
+    pad = np.zeros((1,) + prec.shape[1:])
+    return np.concatenate([pad, np.cumsum(np.where(np.isfinite(prec), prec, 0.), axis=0)])
+
+# running sums of prec*value, prec and the number of valid months along the first (time) axis (see
+# prec_sums; `cs_p` is its result, if already known). Windows are only used where every month is
+# valid, so the prec sums need not skip the months with missing values
+def prefix_sums(dat, prec, cs_p=None):
+    valid = np.isfinite(dat) & np.isfinite(prec)
+    pad = np.zeros((1,) + dat.shape[1:])
+    cs_pd = np.concatenate([pad, np.cumsum(np.where(valid, prec*dat, 0.), axis=0)])
+    if cs_p is None:
+        cs_p = prec_sums(prec)
+    cs_n = np.concatenate([pad.astype(np.int32), np.cumsum(valid, axis=0, dtype=np.int32)])
+    return cs_pd, cs_p, cs_n
+
+# amount-weighted means over the windows [starts, starts+length). Windows with any missing month,
+# or with no precipitation at all, are NaN
+def window_means(sums, starts, length):
+    cs_pd, cs_p, cs_n = sums
+    starts = np.asarray(starts, dtype=int)
+    stops = starts + length
+    num = cs_pd[stops] - cs_pd[starts]
+    den = cs_p[stops] - cs_p[starts]
+    n = cs_n[stops] - cs_n[starts]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = num / den
+    return np.where((n == length) & (den > 0), out, np.nan)
+
+# start indices and labels of every complete window beginning in month `start`
+def window_starts(months, years, start, length):
+    idx = np.flatnonzero(months == start)
+    idx = idx[idx + length <= len(months)]
+    return idx, years[idx]
+
+# amount-weighted means over a user-defined window. kind "running": right-aligned running mean over
+# `length` months, labelled by its last month; kind "season": `length` consecutive months starting in
+# month `start` of each year, labelled by its first month. Returns (labels, values) with time first
+def custom_window(sums, times, kind, length, start=1):
+    times = pd.DatetimeIndex(times)
+    if kind == "running":
+        vals = np.full((len(times),) + sums[0].shape[1:], np.nan)
+        if length <= len(times):
+            vals[length - 1:] = window_means(sums, np.arange(len(times) - length + 1), length)
+        return times.values, vals
+    starts, years = window_starts(times.month.values, times.year.values, start, length)
+    labels = pd.to_datetime([pd.Timestamp(year=int(y), month=start, day=1) for y in years]).values
+    return labels, window_means(sums, starts, length)
+
+# amount-weighted mean of the selected months of each year (weighted by precipitation in those
+# months), for the years year_start..year_end. `dat` and `prec` are packed (time, cell) arrays on the
+# same time axis; returns the years and a (year, cell) array
+def annual_values(dat, prec, months, year_start=None, year_end=None):
+    times = pd.DatetimeIndex(dat.time.values)
+    keep = times.month.isin(months)
+    if year_start is not None:
+        keep &= times.year >= year_start
+    if year_end is not None:
+        keep &= times.year <= year_end
+    if not keep.any():
+        return np.array([], dtype=int), np.full((0, dat.shape[-1]), np.nan)
+    d = decode(dat.isel(time=keep)).values.astype(np.float64)
+    p = decode(prec.isel(time=keep)).values.astype(np.float64)
+    years = times.year.values[keep]
+    wts = np.where(np.isfinite(d) & np.isfinite(p), p, 0.)
+    starts = np.flatnonzero(np.r_[True, years[1:] != years[:-1]])
+    num = np.add.reduceat(np.where(wts > 0, d, 0.) * wts, starts, axis=0)
+    den = np.add.reduceat(wts, starts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return years[starts], np.where(den > 0, num / den, np.nan)
+
+# amount-weighted mean over a period: each year's selected months are weighted by their share of that
+# year's precipitation (in the selected months), then the annual values are averaged. Returns a
+# (cell,) array
+def period_mean(dat, prec, year_start, year_end, months):
+    years, ann = annual_values(dat, prec, months, year_start, year_end)
+    if not len(years):
+        return np.full(dat.shape[-1], np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmean(ann, axis=0)
+
+# amount-weighted mean of each calendar month over the years year_start..year_end (each year's
+# value weighted by its precipitation in that month), as a (12, cell) array
+def monthly_climatology(dat, prec, year_start=None, year_end=None):
+    times = pd.DatetimeIndex(dat.time.values)
+    keep = np.ones(len(times), dtype=bool)
+    if year_start is not None:
+        keep &= times.year >= year_start
+    if year_end is not None:
+        keep &= times.year <= year_end
+    d = decode(dat.isel(time=keep)).values.astype(np.float64)
+    p = decode(prec.isel(time=keep)).values.astype(np.float64)
+    month = times.month.values[keep] - 1
+    wts = np.where(np.isfinite(d) & np.isfinite(p), p, 0.)
+    num = np.zeros((12,) + d.shape[1:])
+    den = np.zeros((12,) + d.shape[1:])
+    for m in range(12):
+        rows = month == m
+        num[m] = (np.where(wts[rows] > 0, d[rows], 0.) * wts[rows]).sum(axis=0)
+        den[m] = wts[rows].sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(den > 0, num / den, np.nan)
+
+# anomalies of (time, ...) values from the mean of their calendar month: the (12, ...) `climatology`
+# given, or else the mean of the values themselves in each calendar month (so annual and seasonal
+# values, with one time stamp a year, become anomalies from their long-term mean)
+def calendar_anomalies(vals, times, climatology=None):
+    vals = np.asarray(vals, dtype=np.float64)
+    month = pd.DatetimeIndex(times).month.values - 1
+    if climatology is None:
+        climatology = np.full((12,) + vals.shape[1:], np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            for m in np.unique(month):
+                climatology[m] = np.nanmean(vals[month == m], axis=0)
+    return vals - np.asarray(climatology)[month]
+
+# interannual standard deviation of (year, cell) annual values; NaN where fewer than two years are valid
+def interannual_sd(ann):
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        sd = np.nanstd(ann, axis=0, ddof=1)
+    return np.where(np.isfinite(ann).sum(axis=0) >= 2, sd, np.nan)
+
+
+# CACHING
+# size in bytes of a cached value (arrays, and tuples/lists/dicts of them)
+def _nbytes(val):
+    if isinstance(val, (tuple, list)):
+        return sum(_nbytes(v) for v in val)
+    if isinstance(val, dict):
+        return sum(_nbytes(v) for v in val.values())
+    if isinstance(val, (bytes, bytearray)):
+        return len(val)
+    return getattr(val, "nbytes", 0)
+
+# least-recently-used cache bounded by the total size of the cached values, for results that are
+# expensive to compute and shared by all sessions (functools.lru_cache only bounds the number of
+# entries). Returned arrays are made read-only so that no caller can change a cached value in place;
+# this includes values too large to cache, so that callers behave the same whether a value fitted or not
+def lru_cache_bytes(max_bytes):
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+        stats = {"hits": 0, "misses": 0, "bytes": 0}
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            with lock:
+                if args in cache:
+                    cache.move_to_end(args)
+                    stats["hits"] += 1
+                    return cache[args]
+            val = func(*args)
+            for arr in (val if isinstance(val, (tuple, list)) else [val]):
+                if isinstance(arr, np.ndarray):
+                    arr.setflags(write=False)
+            size = _nbytes(val)
+            with lock:
+                stats["misses"] += 1
+                if args not in cache and size <= max_bytes:
+                    cache[args] = val
+                    stats["bytes"] += size
+                    while stats["bytes"] > max_bytes:
+                        stats["bytes"] -= _nbytes(cache.popitem(last=False)[1])
+            return val
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                stats.update(hits=0, misses=0, bytes=0)
+
+        wrapper.cache_info = lambda: dict(stats, entries=len(cache), max_bytes=max_bytes)
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
@@ -0,0 +1,450 @@
+"""Offline derivation of the APIC products from the monthly isotope and precipitation cubes.
+
+Rebuilds every derived product the web app serves (Jan-Dec and Jul-Jun annual means, the four
+standard seasons, the 3/6/12-month running means and the long-term annual mean) for d2H, d18O
+and dxs. All values are precipitation amount-weighted means, computed from running (prefix)
+sums of prec*value and prec along the time axis, so every averaging window costs the same.
+
+Examples:
+    python apic_derive.py build --out derived --nproc 4
+    python apic_derive.py build --out derived --format zarr
+    python apic_derive.py compare --out derived
+    python apic_derive.py quantise --out compact --dtype int16
+    python apic_derive.py update --src . --out . --new-d2H d2H_2024.nc --new-d18O d18O_2024.nc \
+        --new-dxs dxs_2024.nc --new-prec prec_2024.nc
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from apic_data import compact_encoding, quantise, quantisation_error, prefix_sums, window_means, window_starts
+
+ISOTOPES = ["d2H", "d18O", "dxs"]
+
+# first and last year of the isotope record
+YEAR_START = 1962
+YEAR_END = 2023
+
+# derived products, keyed by the same names as the `time_res` input in the app.
+# "window" products are amount-weighted means over `length` consecutive months starting in month `start`
+# of each year; "running" products are right-aligned running means over `length` months
+PRODUCTS = {
+    "ann":      dict(kind="window", start=1, length=12, dim="time", fname="{y0}-{y1}_ann_median"),
+    "ann_trop": dict(kind="window", start=7, length=12, dim="year", fname="{y0}-{y1}_ann-trop"),
+    "DJF":      dict(kind="window", start=12, length=3, dim="year", fname="{y0}-{y1}_ann-djf"),
+    "MAM":      dict(kind="window", start=3, length=3, dim="year", fname="{y0}-{y1}_ann-mam"),
+    "JJA":      dict(kind="window", start=6, length=3, dim="year", fname="{y0}-{y1}_ann-jja"),
+    "SON":      dict(kind="window", start=9, length=3, dim="year", fname="{y0}-{y1}_ann-son"),
+    "3mrm":     dict(kind="running", length=3, dim="time", fname="{y0}-{y1}_3-month-running-mean"),
+    "6mrm":     dict(kind="running", length=6, dim="time", fname="{y0}-{y1}_6-month-running-mean"),
+    "12mrm":    dict(kind="running", length=12, dim="time", fname="{y0}-{y1}_12-month-running-mean"),
+    "ltm":      dict(kind="long-term", dim=None, fname="{y0}-{y1}_long-term-annual-mean_median"),
+}
+
+
+# FILE NAMES
+def monthly_fname(iso, year_start=YEAR_START, year_end=YEAR_END):
+    return f"aus_prec.{iso}_v1_{year_start}01-{year_end}12_monthly_median.nc"
+
+def prec_fname(year_end=YEAR_END):
+    return f"prec/aus_prec_v1_195901-{year_end}12_monthly_1.nc"
+
+def product_fname(iso, product, year_start=YEAR_START, year_end=YEAR_END, ext=".nc"):
+    spec = PRODUCTS[product]
+    # windows that run into the following year (Jul-Jun, DJF) end one year early
+    if spec["kind"] == "window" and spec["start"] + spec["length"] > 13:
+        year_end = year_end - 1
+    return f"aus_prec.{iso}_v1_" + spec["fname"].format(y0=year_start, y1=year_end) + ext
+
+# last year of the record, from the newest monthly file in a netcdfs/ folder
+def find_year_end(nc_dir, year_start=YEAR_START):
+    paths = glob.glob(os.path.join(nc_dir, f"aus_prec.d2H_v1_{year_start}01-*12_monthly_median.nc"))
+    if not paths:
+        return YEAR_END
+    return max(int(os.path.basename(p).split("-")[1][:4]) for p in paths)
+
+
+# CALCULATIONS
+# derive every product for one block of the grid. `dat` and `prec` are (time, ...) arrays
+def derive_block(dat, prec, months, years):
+    sums = prefix_sums(dat, prec)
+    out = {}
+    for product, spec in PRODUCTS.items():
+        if spec["kind"] == "window":
+            starts, _ = window_starts(months, years, spec["start"], spec["length"])
+            out[product] = window_means(sums, starts, spec["length"])
+        elif spec["kind"] == "running":
+            n = spec["length"]
+            vals = np.full(dat.shape, np.nan)
+            vals[n - 1:] = window_means(sums, np.arange(len(months) - n + 1), n)
+            out[product] = vals
+    with np.errstate(invalid="ignore"):
+        # long-term mean: mean of the annual (Jan-Dec) amount-weighted values
+        count = np.isfinite(out["ann"]).sum(axis=0)
+        out["ltm"] = np.where(count > 0, np.nansum(out["ann"], axis=0) / np.maximum(count, 1), np.nan)
+    return out
+
+# output coordinates (time or year) for each product
+def product_coords(product, times):
+    times = pd.DatetimeIndex(times)
+    months, years = times.month.values, times.year.values
+    spec = PRODUCTS[product]
+    if spec["kind"] == "window":
+        _, labels = window_starts(months, years, spec["start"], spec["length"])
+        if spec["dim"] == "time":
+            return pd.to_datetime([f"{y}-12-31" for y in labels]).values
+        return labels
+    if spec["kind"] == "running":
+        return times.values
+    return None
+
+
+# INPUTS
+def open_inputs(src, year_start=YEAR_START, year_end=YEAR_END):
+    dats = {iso: xr.open_dataset(os.path.join(src, "netcdfs", monthly_fname(iso, year_start, year_end)))[f"{iso}p"]
+            for iso in ISOTOPES}
+    prec = xr.open_dataset(os.path.join(src, "netcdfs", prec_fname(year_end)))["prec"]
+    # precipitation starts in 1959: match it to the isotope months
+    times = pd.DatetimeIndex(dats["d2H"].time.values)
+    prec = prec.sel(time=slice(f"{times[0]:%Y-%m}", f"{times[-1]:%Y-%m}"))
+    if prec.sizes["time"] != len(times):
+        raise ValueError(f"precipitation has {prec.sizes['time']} months in the isotope period, expected {len(times)}")
+    return dats, prec
+
+# worker: derive all products for one band of latitudes
+def _derive_band(task):
+    src, year_start, year_end, lat0, lat1 = task
+    dats, prec = open_inputs(src, year_start, year_end)
+    times = pd.DatetimeIndex(dats["d2H"].time.values)
+    p = prec.isel(lat=slice(lat0, lat1)).values.astype(np.float64)
+    out = {}
+    for iso, da in dats.items():
+        d = da.isel(lat=slice(lat0, lat1)).values.astype(np.float64)
+        out[iso] = derive_block(d, p, times.month.values, times.year.values)
+        da.close()
+    prec.close()
+    return lat0, lat1, out
+
+
+# OUTPUTS
+def product_dataset(iso, product, vals, template):
+    spec = PRODUCTS[product]
+    coords = {"lat": template.lat, "lon": template.lon}
+    dims = ("lat", "lon")
+    if spec["dim"] is not None:
+        coords = {spec["dim"]: product_coords(product, template.time.values), **coords}
+        dims = (spec["dim"],) + dims
+    da = xr.DataArray(vals, coords=coords, dims=dims, name=f"{iso}p", attrs=template.attrs)
+    da.attrs["long_name"] = f"precipitation amount-weighted {iso} ({product})"
+    ds = da.to_dataset()
+    ds.attrs["history"] = f"{datetime_now()}: derived with apic_derive.py from the monthly {iso} and prec cubes"
+    return ds
+
+def datetime_now():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+# compression, chunking and storage type. Default chunks hold the full time axis for small spatial
+# tiles, which is the read pattern of point extraction; map-style reads can pass --chunk-time 1.
+# dtype "int16" stores the isotope values in 0.01 permil steps (see apic_data.compact_encoding)
+def product_encoding(ds, fmt, chunk_time, chunk_space, complevel, dtype="float32"):
+    encoding = {}
+    for var in ds.data_vars:
+        chunks = tuple(
+            (ds.sizes[dim] if chunk_time <= 0 else min(chunk_time, ds.sizes[dim])) if dim in ("time", "year")
+            else min(chunk_space, ds.sizes[dim])
+            for dim in ds[var].dims)
+        enc = compact_encoding(ds[var], dtype)
+        if fmt == "zarr":
+            encoding[var] = {"chunks": chunks, **enc}
+        else:
+            encoding[var] = {"zlib": True, "complevel": complevel, "shuffle": True, "chunksizes": chunks, **enc}
+    return encoding
+
+def write_product(ds, path, fmt, encoding):
+    if fmt == "zarr":
+        try:
+            import zarr  # noqa: F401
+        except ImportError:
+            sys.exit("writing zarr output needs the zarr package (pip install zarr)")
+        ds.to_zarr(path, mode="w", encoding=encoding)
+    else:
+        ds.to_netcdf(path, encoding=encoding)
+
+
+# COMMANDS
+def build(args):
+    dats, prec = open_inputs(args.src, args.year_start, args.year_end)
+    template = dats["d2H"]
+    nlat = template.sizes["lat"]
+    times = template.time.values
+
+    # preallocate the outputs then fill them band by band as the workers finish
+    shapes = {}
+    for product, spec in PRODUCTS.items():
+        coord = product_coords(product, times)
+        shapes[product] = (template.sizes["lat"], template.sizes["lon"]) if coord is None else \
+            (len(coord), template.sizes["lat"], template.sizes["lon"])
+    results = {iso: {product: np.full(shape, np.nan, dtype=np.float32) for product, shape in shapes.items()}
+               for iso in ISOTOPES}
+
+    tasks = [(args.src, args.year_start, args.year_end, i, min(i + args.band, nlat))
+             for i in range(0, nlat, args.band)]
+    t0 = time.time()
+    if args.nproc > 1:
+        with Pool(args.nproc) as pool:
+            bands = pool.imap_unordered(_derive_band, tasks)
+            for n_done, (lat0, lat1, out) in enumerate(bands, 1):
+                for iso in ISOTOPES:
+                    for product in PRODUCTS:
+                        results[iso][product][..., lat0:lat1, :] = out[iso][product]
+                print(f"  band {n_done}/{len(tasks)} done ({time.time() - t0:.1f}s)")
+    else:
+        for n_done, task in enumerate(tasks, 1):
+            lat0, lat1, out = _derive_band(task)
+            for iso in ISOTOPES:
+                for product in PRODUCTS:
+                    results[iso][product][..., lat0:lat1, :] = out[iso][product]
+            print(f"  band {n_done}/{len(tasks)} done ({time.time() - t0:.1f}s)")
+
+    out_dir = os.path.join(args.out, "netcdfs")
+    os.makedirs(out_dir, exist_ok=True)
+    ext = ".zarr" if args.format == "zarr" else ".nc"
+    rows = []
+    for iso in ISOTOPES:
+        for product in PRODUCTS:
+            ds = product_dataset(iso, product, results[iso][product], template)
+            path = os.path.join(out_dir, product_fname(iso, product, args.year_start, args.year_end, ext))
+            encoding = product_encoding(ds, args.format, args.chunk_time, args.chunk_space, args.complevel, args.dtype)
+            write_product(ds, path, args.format, encoding)
+            print(f"wrote {path}")
+            if args.dtype == "int16":
+                vals = results[iso][product].astype(np.float64)
+                rows.append({"isotope": iso, "product": product, "dtype": encoding[f"{iso}p"]["dtype"],
+                             **quantisation_error(vals, quantise(vals, encoding[f"{iso}p"]))})
+    if rows:
+        print(pd.DataFrame(rows).to_string(index=False))
+
+# append new months to the record and recompute only the product entries they affect
+def update(args):
+    year_end = args.year_end or find_year_end(os.path.join(args.src, "netcdfs"), args.year_start)
+    dats, prec = open_inputs(args.src, args.year_start, year_end)
+    times = pd.DatetimeIndex(dats["d2H"].time.values)
+
+    new_dats = {iso: xr.open_dataset(getattr(args, f"new_{iso}"))[f"{iso}p"] for iso in ISOTOPES}
+    new_times = pd.DatetimeIndex(new_dats["d2H"].time.values)
+    if (new_times[0].year, new_times[0].month) != ((times[-1] + pd.DateOffset(months=1)).year,
+                                                   (times[-1] + pd.DateOffset(months=1)).month):
+        sys.exit(f"new data start in {new_times[0]:%Y-%m}, but the record ends in {times[-1]:%Y-%m}")
+    if new_times[-1].month != 12 or len(new_times) % 12 != 0:
+        sys.exit("new data must cover whole calendar years (January to December)")
+    for iso, da in new_dats.items():
+        if da.sizes["time"] != len(new_times):
+            sys.exit(f"new {iso} slice has {da.sizes['time']} months, expected {len(new_times)}")
+    new_prec = xr.open_dataset(args.new_prec)["prec"].sel(time=slice(f"{new_times[0]:%Y-%m}", f"{new_times[-1]:%Y-%m}"))
+    if new_prec.sizes["time"] != len(new_times):
+        sys.exit(f"new prec slice has {new_prec.sizes['time']} months, expected {len(new_times)}")
+    new_end = new_times[-1].year
+
+    out_dir = os.path.join(args.out, "netcdfs")
+    os.makedirs(os.path.join(out_dir, "prec"), exist_ok=True)
+    ext = ".zarr" if args.format == "zarr" else ".nc"
+
+    # extended monthly cubes and precipitation (the prec file keeps its 1959 start)
+    for iso in ISOTOPES:
+        full = xr.concat([dats[iso].load(), new_dats[iso].load()], dim="time")
+        full.to_dataset().to_netcdf(os.path.join(out_dir, monthly_fname(iso, args.year_start, new_end)))
+    prec_all = xr.open_dataset(os.path.join(args.src, "netcdfs", prec_fname(year_end)))["prec"].load()
+    xr.concat([prec_all, new_prec.load()], dim="time").to_dataset().to_netcdf(os.path.join(out_dir, prec_fname(new_end)))
+    print(f"appended {len(new_times)} months ({new_times[0]:%Y-%m} to {new_times[-1]:%Y-%m})")
+
+    # only the last (longest window - 1) months of the old record are needed as context
+    ctx = min(max(spec.get("length", 1) for spec in PRODUCTS.values()) - 1, len(times))
+    t_ctx = times[len(times) - ctx:].append(new_times)
+    p_ctx = np.concatenate([prec.isel(time=slice(len(times) - ctx, None)).values, new_prec.values]).astype(np.float64)
+
+    for iso in ISOTOPES:
+        d_ctx = np.concatenate([dats[iso].isel(time=slice(len(times) - ctx, None)).values,
+                                new_dats[iso].values]).astype(np.float64)
+        sums = prefix_sums(d_ctx, p_ctx)
+        old = {product: open_product(os.path.join(args.src, "netcdfs",
+                                                  product_fname(iso, product, args.year_start, year_end)))[f"{iso}p"].load()
+               for product in PRODUCTS}
+        new = {}
+        for product, spec in PRODUCTS.items():
+            if spec["kind"] == "window":
+                starts, labels = window_starts(t_ctx.month.values, t_ctx.year.values, spec["start"], spec["length"])
+                # windows that reach into the new months (all others are unchanged)
+                keep = starts + spec["length"] > ctx
+                vals = window_means(sums, starts[keep], spec["length"])
+                coord = labels[keep]
+                if spec["dim"] == "time":
+                    # match the day-of-year convention of the existing labels
+                    last = pd.Timestamp(old[product].time.values[-1])
+                    coord = pd.to_datetime([pd.Timestamp(year=int(y), month=last.month, day=last.day) for y in coord]).values
+            elif spec["kind"] == "running":
+                n = spec["length"]
+                vals = window_means(sums, np.arange(ctx - n + 1, len(t_ctx) - n + 1), n)
+                coord = new_times.values
+            else:
+                continue
+            added = xr.DataArray(vals, coords={spec["dim"]: coord, "lat": old[product].lat, "lon": old[product].lon},
+                                 dims=(spec["dim"], "lat", "lon"))
+            new[product] = xr.concat([old[product], added.astype(old[product].dtype)], dim=spec["dim"])
+
+        # long-term mean from running totals: old mean * old count + the new annual values
+        old_ann = old["ann"].values
+        new_ann = new["ann"].values[old_ann.shape[0]:]
+        count_old = np.isfinite(old_ann).sum(axis=0)
+        count_new = np.isfinite(new_ann).sum(axis=0)
+        total = np.where(count_old > 0, np.squeeze(old["ltm"].values) * count_old, 0.) + np.nansum(new_ann, axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ltm = np.where(count_old + count_new > 0, total / (count_old + count_new), np.nan)
+        new["ltm"] = xr.DataArray(ltm.reshape(old["ltm"].shape), coords=old["ltm"].coords, dims=old["ltm"].dims)
+
+        for product in PRODUCTS:
+            ds = new[product].rename(f"{iso}p").to_dataset()
+            ds[f"{iso}p"].attrs = old[product].attrs
+            ds.attrs["history"] = f"{datetime_now()}: extended to {new_end} with apic_derive.py update"
+            path = os.path.join(out_dir, product_fname(iso, product, args.year_start, new_end, ext))
+            write_product(ds, path, args.format,
+                          product_encoding(ds, args.format, args.chunk_time, args.chunk_space, args.complevel, args.dtype))
+            print(f"wrote {path}")
+
+# write compact (int16 or float32) copies of every netcdf file in <src>/netcdfs and report the
+# quantisation error against the originals
+def quantise_files(args):
+    src_dir = os.path.join(args.src, "netcdfs")
+    paths = sorted(glob.glob(os.path.join(src_dir, "*.nc")) + glob.glob(os.path.join(src_dir, "prec", "*.nc")))
+    rows = []
+    for path in paths:
+        rel = os.path.relpath(path, src_dir)
+        out_path = os.path.join(args.out, "netcdfs", rel)
+        if os.path.abspath(out_path) == os.path.abspath(path):
+            sys.exit("--out must differ from --src when quantising")
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        ds = xr.open_dataset(path).load()
+        encoding = product_encoding(ds, "netcdf", args.chunk_time, args.chunk_space, args.complevel, args.dtype)
+        ds.to_netcdf(out_path, encoding=encoding)
+        stored = xr.open_dataset(out_path)
+        for var in ds.data_vars:
+            rows.append({"file": rel, "variable": var, "dtype": encoding[var]["dtype"],
+                         "memory_MB": round(ds[var].nbytes / 1e6, 1),
+                         "compact_MB": round(ds[var].size * np.dtype(encoding[var]["dtype"]).itemsize / 1e6, 1),
+                         **quantisation_error(ds[var].values, stored[var].values)})
+        stored.close()
+        print(f"wrote {out_path}")
+
+    report = pd.DataFrame(rows)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(report.to_string(index=False))
+    if args.report:
+        report.to_csv(args.report, index=False)
+
+# open a product file, whatever format it was written in
+def open_product(path):
+    if path.endswith(".zarr"):
+        return xr.open_zarr(path)
+    return xr.open_dataset(path)
+
+# compare derived products against the shipped (or any other reference) files
+def compare(args):
+    ext = ".zarr" if args.format == "zarr" else ".nc"
+    rows = []
+    for iso in ISOTOPES:
+        for product in PRODUCTS:
+            ref_path = os.path.join(args.src, "netcdfs", product_fname(iso, product, args.year_start, args.year_end))
+            new_path = os.path.join(args.out, "netcdfs", product_fname(iso, product, args.year_start, args.year_end, ext))
+            row = {"isotope": iso, "product": product}
+            if not (os.path.exists(ref_path) and os.path.exists(new_path)):
+                row["status"] = "missing"
+                rows.append(row)
+                continue
+            ref = np.squeeze(open_product(ref_path)[f"{iso}p"].values)
+            new = np.squeeze(open_product(new_path)[f"{iso}p"].values)
+            if ref.shape != new.shape:
+                row["status"] = f"shape {new.shape} != {ref.shape}"
+                rows.append(row)
+                continue
+            both = np.isfinite(ref) & np.isfinite(new)
+            diff = (new - ref)[both]
+            row.update(
+                max_abs_diff=float(np.abs(diff).max()) if diff.size else np.nan,
+                rmse=float(np.sqrt(np.mean(diff**2))) if diff.size else np.nan,
+                nan_mismatch=int((np.isfinite(ref) != np.isfinite(new)).sum()),
+            )
+            row["status"] = "ok" if (row["nan_mismatch"] == 0 and not row["max_abs_diff"] > args.tol) else "differs"
+            rows.append(row)
+
+    report = pd.DataFrame(rows)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(report.to_string(index=False))
+    if args.report:
+        report.to_csv(args.report, index=False)
+    return 0 if (report["status"] == "ok").all() else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def common(p):
+        p.add_argument("--src", default="", help="directory holding the netcdfs/ folder with the monthly and prec files")
+        p.add_argument("--out", default="derived", help="output directory (products go in <out>/netcdfs/)")
+        p.add_argument("--format", choices=["netcdf", "zarr"], default="netcdf")
+        p.add_argument("--year-start", type=int, default=YEAR_START)
+        p.add_argument("--year-end", type=int, default=YEAR_END)
+
+    p_build = sub.add_parser("build", help="derive every product from the monthly cubes")
+    common(p_build)
+    p_build.add_argument("--nproc", type=int, default=1, help="number of worker processes")
+    p_build.add_argument("--band", type=int, default=16, help="latitude rows per block of the grid")
+    p_build.add_argument("--chunk-time", type=int, default=0, help="time chunk length (0 = whole record)")
+    p_build.add_argument("--chunk-space", type=int, default=32, help="lat/lon chunk size")
+    p_build.add_argument("--complevel", type=int, default=4, help="netcdf zlib compression level")
+    p_build.add_argument("--dtype", choices=["float32", "int16"], default="float32",
+                         help="storage type of the isotope values (int16 = 0.01 permil steps)")
+    p_build.set_defaults(func=build)
+
+    p_compare = sub.add_parser("compare", help="compare derived products against the shipped files")
+    common(p_compare)
+    p_compare.add_argument("--tol", type=float, default=0.01, help="maximum absolute difference (permil)")
+    p_compare.add_argument("--report", help="also write the comparison table to this csv")
+    p_compare.set_defaults(func=compare)
+
+    p_update = sub.add_parser("update", help="append new whole years and update the affected products")
+    common(p_update)
+    p_update.set_defaults(out=".", year_end=None)
+    for iso in ISOTOPES:
+        p_update.add_argument(f"--new-{iso}", dest=f"new_{iso}", required=True, help=f"new monthly {iso} slice")
+    p_update.add_argument("--new-prec", required=True, help="new monthly precipitation slice")
+    p_update.add_argument("--chunk-time", type=int, default=0, help="time chunk length (0 = whole record)")
+    p_update.add_argument("--chunk-space", type=int, default=32, help="lat/lon chunk size")
+    p_update.add_argument("--complevel", type=int, default=4, help="netcdf zlib compression level")
+    p_update.add_argument("--dtype", choices=["float32", "int16"], default="float32",
+                          help="storage type of the isotope values (int16 = 0.01 permil steps)")
+    p_update.set_defaults(func=update)
+
+    p_quantise = sub.add_parser("quantise", help="write compact copies of all files and report the quantisation error")
+    common(p_quantise)
+    p_quantise.set_defaults(out="compact")
+    p_quantise.add_argument("--dtype", choices=["float32", "int16"], default="int16",
+                            help="storage type of the isotope values (precipitation is always float32)")
+    p_quantise.add_argument("--chunk-time", type=int, default=0, help="time chunk length (0 = whole record)")
+    p_quantise.add_argument("--chunk-space", type=int, default=32, help="lat/lon chunk size")
+    p_quantise.add_argument("--complevel", type=int, default=4, help="netcdf zlib compression level")
+    p_quantise.add_argument("--report", help="also write the error table to this csv")
+    p_quantise.set_defaults(func=quantise_files)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,404 @@
+"""Point extraction of the APIC timeseries without the web app.
+
+The same extraction, validation and csv formatting the `Extract timeseries` tab uses, importable from
+scripts, plus a command-line entry point that takes many sites and temporal resolutions and writes
+the values as a stream (one long-format csv, written batch by batch).
+
+Examples:
+    python apic_extract.py --lat -28 --lon 134 --res monthly ann
+    python apic_extract.py --points sites.csv --res ann DJF 12mrm --out values.csv
+    python apic_extract.py --points sites.csv --res custom --custom-kind season --custom-length 5 --custom-start 11
+    python apic_extract.py --lat -28 --lon 134 --res all --format parquet --out site.parquet
+
+`sites.csv` needs `lat` and `lon` columns and may have a `site_name` column.
+"""
+import argparse
+import calendar
+import io
+import os
+import sys
+import tempfile
+import zipfile
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from apic_derive import ISOTOPES, YEAR_START, monthly_fname, prec_fname, product_fname, find_year_end
+from apic_data import land_cells, nearest_cell, prefix_sums, custom_window, calendar_anomalies
+
+# temporal resolutions, as offered in the app
+TIME_RES = {"monthly": "Monthly", "ann": "Annual (Jan-Dec)", "ann_trop": "Annual (Jul-Jun)",
+            "DJF": "Annual (DJF)", "MAM": "Annual (MAM)", "JJA": "Annual (JJA)",
+            "SON": "Annual (SON)", "3mrm": "3-month running mean", "6mrm": "6-month running mean",
+            "12mrm": "12-month running mean", "custom": "Custom window"}
+ANNUAL_RES = ["ann", "ann_trop", "DJF", "MAM", "JJA", "SON"]
+
+# time stamps given to the products stored by year: (month, day) in the year at the start of the period
+YEAR_LABELS = {"ann_trop": (7, 1), "DJF": (12, 1), "MAM": (5, 31), "JJA": (8, 31), "SON": (11, 30)}
+
+
+# DATA
+@lru_cache(maxsize=None)
+def record_years(fpath=""):
+    return YEAR_START, find_year_end(f"{fpath}netcdfs", YEAR_START)
+
+# open the file behind one isotope and resolution (kept open for later requests), with the products
+# stored by year relabelled onto a time axis
+@lru_cache(maxsize=64)
+def open_resolution(fpath, iso, time_res):
+    year_first, year_last = record_years(fpath)
+    if time_res == "monthly":
+        ds = xr.open_dataset(f"{fpath}netcdfs/{monthly_fname(iso, year_first, year_last)}")
+    else:
+        ds = xr.open_dataset(f"{fpath}netcdfs/{product_fname(iso, time_res, year_first, year_last)}")
+    if "year" in ds.dims:
+        month, day = YEAR_LABELS[time_res]
+        ds = ds.rename({"year": "time"})
+        ds = ds.assign_coords(time=("time", [pd.Timestamp(year=int(year), month=month, day=day) for year in ds.time.values]))
+    return ds
+
+@lru_cache(maxsize=None)
+def open_prec(fpath=""):
+    year_first, year_last = record_years(fpath)
+    prec = xr.open_dataset(f"{fpath}netcdfs/{prec_fname(year_last)}")["prec"]
+    return prec.sel(time=slice(f"{year_first}-01-01", None))
+
+# land cells of the grid (cells with a long-term mean value)
+@lru_cache(maxsize=None)
+def get_cells(fpath=""):
+    return land_cells(open_resolution(fpath, "d2H", "ltm").d2Hp.notnull())
+
+
+# VALIDATION
+# a point is valid if its nearest grid cell is a land cell
+def is_valid_point(cells, lat, lon):
+    try:
+        return nearest_cell(cells, lat, lon) >= 0
+    except Exception:
+        return False
+
+# is this resolution one value per year (rather than per month)?
+def is_annual(time_res, custom=None):
+    if time_res == "custom":
+        return custom[0] == "season"
+    return time_res in ANNUAL_RES
+
+
+# short label for a custom window, e.g. "9mrm" or "Nov-Mar"
+def window_label(kind, length, start=1):
+    if kind == "running":
+        return f"{length}mrm"
+    end = (start + length - 2) % 12 + 1
+    label = f"{calendar.month_abbr[start]}-{calendar.month_abbr[end]}"
+    return label if length <= 12 else f"{label}_{length}m"
+
+
+# EXTRACTION
+# grid indices nearest to each coordinate, as `.sel(method="nearest")` would pick them
+def nearest_index(coord, vals):
+    return np.abs(np.asarray(coord)[:, None] - np.atleast_1d(vals)[None, :]).argmin(axis=0)
+
+# (lat, lon) grid indices of a batch of points. All files share the grid of the long-term means, so
+# points are resolved once and the indices reused for every file
+def grid_index(lats, lons, fpath=""):
+    cells = get_cells(fpath)
+    return nearest_index(cells.grid_lat, lats), nearest_index(cells.grid_lon, lons)
+
+# values of every isotope at a batch of points in one read per file. Returns the time labels and
+# {isotope: (time, point) array}. `custom` is (kind, length, start), see apic_data.custom_window;
+# `index` is the output of `grid_index`, if already known
+def read_points(lats, lons, time_res, fpath="", custom=None, index=None):
+    if index is None:
+        index = grid_index(lats, lons, fpath)
+    i, j = (xr.DataArray(ind, dims="point") for ind in index)
+    if time_res == "custom":
+        times, monthly = read_points(lats, lons, "monthly", fpath, index=index)
+        p = open_prec(fpath).isel(lat=i, lon=j).values.astype(np.float64)
+        out = {}
+        for iso in ISOTOPES:
+            labels, vals = custom_window(prefix_sums(monthly[iso].astype(np.float64), p), times, *custom)
+            out[iso] = vals.astype(np.float32)
+        return labels, out
+
+    out = {}
+    for iso in ISOTOPES:
+        ds = open_resolution(fpath, iso, time_res)
+        out[iso] = ds[f"{iso}p"].isel(lat=i, lon=j).values
+    return ds.time.values, out
+
+# data frame for one point, laid out as in the app
+def point_frame(time_res, site_name, lat, lon, time, d2H_vals, d18O_vals, dxs_vals, custom=None):
+    site_name = site_name if site_name else "site"
+    site_name = site_name.replace(" ", "_")
+    site_col = "site_name" if time_res == "monthly" else "site"
+    time_col = "year" if is_annual(time_res, custom) else "date"
+    return pd.DataFrame({site_col: site_name, time_col: time, 'lat': lat, 'lon': lon, 'd2H': d2H_vals, 'd18O': d18O_vals, 'dxs': dxs_vals})
+
+# a point frame with `<iso>_anomaly` columns added: departures from the mean of each calendar month,
+# which is `climatology[iso]` (12 values) where given, or else the mean of the frame's own values
+def with_anomalies(data, climatology=None):
+    data = data.copy()
+    times = data["year" if "year" in data else "date"]
+    for iso in ISOTOPES:
+        clim = None if climatology is None else climatology[iso]
+        data[f"{iso}_anomaly"] = calendar_anomalies(data[iso].values, times, clim)
+    return data
+
+# keep the rows within [start_date, end_date]
+def filter_dates(data, start_date, end_date):
+    col = "year" if "year" in data else "date"
+    return data[(data[col] >= pd.Timestamp(start_date)) & (data[col] <= pd.Timestamp(end_date))]
+
+# timeseries at one point (the point should be checked with `is_valid_point` first)
+def extract_point(lat, lon, time_res, fpath="", site_name=None, date_range=None, custom=None, index=None):
+    time, vals = read_points([lat], [lon], time_res, fpath, custom, index)
+    data = point_frame(time_res, site_name, lat, lon, time, vals["d2H"][:, 0], vals["d18O"][:, 0], vals["dxs"][:, 0], custom)
+    if date_range:
+        data = filter_dates(data, *date_range)
+    return data
+
+# every resolution at one point, one at a time: yields (label, data) with data laid out as from
+# `extract_point`. The custom window is included if one is given
+def extract_all(lat, lon, fpath="", site_name=None, date_range=None, custom=None):
+    index = grid_index([lat], [lon], fpath)
+    for time_res in TIME_RES:
+        if time_res == "custom" and custom is None:
+            continue
+        label = time_res if time_res != "custom" else window_label(*custom)
+        yield label, extract_point(lat, lon, time_res, fpath, site_name, date_range, custom, index)
+
+# a single-point frame in the long format of `extract_many`
+def long_frame(data, label):
+    annual = "year" in data
+    time = pd.DatetimeIndex(data["year" if annual else "date"])
+    return pd.DataFrame({
+        "site_name": data.iloc[:, 0].values,
+        "resolution": label,
+        "time": time.strftime("%Y" if annual else "%Y-%m-%d"),
+        "lat": data["lat"].values,
+        "lon": data["lon"].values,
+        **{iso: data[iso].values for iso in ISOTOPES},
+    })
+
+
+# FILE OUTPUT
+# rows written per csv chunk / parquet row group / arrow record batch, so that no download is ever
+# held as one large string or buffer
+ROW_GROUP = 10_000
+
+# dataset metadata: written as `#` lines at the top of csv files and as file metadata in parquet and
+# arrow files. `extra` adds details of the extraction (site, resolution, ...)
+def dataset_metadata(**extra):
+    meta = {
+        "downloaded": datetime.now().strftime('%Y-%m-%d'),
+        "reference": "Please see Falster et al 2025 (HESS) for reference and data details",
+        "units": "d2H, d18O, dxs: permil VSMOW, precipitation amount-weighted",
+    }
+    meta.update({key: str(val) for key, val in extra.items() if val is not None})
+    return meta
+
+def csv_metadata():
+    meta = dataset_metadata()
+    return [
+        f"# Data downloaded {meta['downloaded']}",
+        f"# {meta['reference']}"
+    ]
+
+# the single-point table as downloaded: integer years, and a placeholder site name if none was given
+def download_frame(data, site_name=None):
+    data = data.copy()
+    if "year" in data:
+        data['year'] = pd.to_datetime(data['year'], format='%Y').dt.year
+    if not site_name:
+        data['site_name'] = 'no_sitename_specified'
+    return data
+
+# the csv download, as a sequence of strings: the metadata lines then the data, ROW_GROUP rows at a time
+def csv_chunks(data, site_name=None):
+    data = download_frame(data, site_name)
+
+    for line in csv_metadata():
+        yield line + "\n"
+
+    for r0 in range(0, max(len(data), 1), ROW_GROUP):
+        yield data.iloc[r0:r0 + ROW_GROUP].to_csv(index=False, header=r0 == 0)
+
+def csv_filename(site_name, lat, lon, resolution, start_date, end_date, ext=".csv"):
+    site_name = f"{site_name}_" if site_name else ""
+    filename = f"{site_name}lat{lat}_lon{lon}_{resolution}_{start_date.strftime('%Y%m%d')}-{end_date.strftime('%Y%m%d')}{ext}"
+    return filename.replace("/", "_").replace("\\", "_").replace(" ", "")
+
+
+# BATCH EXTRACTION
+# long-format frames (site_name, resolution, time, lat, lon, d2H, d18O, dxs) for many points and
+# resolutions, one batch of points at a time. Points off the land grid are reported and skipped
+def extract_many(points, resolutions, fpath="", custom=None, date_range=None, batch=500):
+    cells = get_cells(fpath)
+    valid = np.array([is_valid_point(cells, lat, lon) for lat, lon in zip(points["lat"], points["lon"])], dtype=bool)
+    for lat, lon in zip(points["lat"][~valid], points["lon"][~valid]):
+        print(f"skipping ({lat}, {lon}): outside the grid area", file=sys.stderr)
+    points = points[valid].reset_index(drop=True)
+    names = points["site_name"].fillna("site") if "site_name" in points else pd.Series(["site"] * len(points))
+
+    for time_res in resolutions:
+        label = time_res if time_res != "custom" else window_label(*custom)
+        for b0 in range(0, len(points), batch):
+            chunk = points.iloc[b0:b0 + batch]
+            time, vals = read_points(chunk["lat"].values, chunk["lon"].values, time_res, fpath, custom)
+            time = pd.DatetimeIndex(time)
+            time_str = time.strftime("%Y") if is_annual(time_res, custom) else time.strftime("%Y-%m-%d")
+            if date_range:
+                keep = (time >= pd.Timestamp(date_range[0])) & (time <= pd.Timestamp(date_range[1]))
+            else:
+                keep = np.ones(len(time), dtype=bool)
+            n = int(keep.sum())
+            frame = pd.DataFrame({
+                "site_name": np.repeat([str(name).replace(" ", "_") for name in names.iloc[b0:b0 + batch]], n),
+                "resolution": label,
+                "time": np.tile(np.asarray(time_str)[keep], len(chunk)),
+                "lat": np.repeat(chunk["lat"].values, n),
+                "lon": np.repeat(chunk["lon"].values, n),
+                **{iso: vals[iso][keep].T.ravel() for iso in ISOTOPES},
+            })
+            yield frame
+
+# STREAMED FILES
+# write-only file object whose contents are handed on (by `drain`) as soon as they are written,
+# so that zip and parquet files can be produced chunk by chunk
+class _Pipe(io.RawIOBase):
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.pos += len(b)
+        return len(b)
+
+    def drain(self):
+        out = b"".join(self.chunks)
+        self.chunks = []
+        return out
+
+# zip archive with one csv (as downloaded from the app) per resolution, as a sequence of bytes
+def zip_stream(items, site_name=None):
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for label, data in items:
+            with zf.open(f"{label}.csv", "w") as f:
+                for chunk in csv_chunks(data, site_name):
+                    f.write(chunk.encode())
+            yield pipe.drain()
+    yield pipe.drain()
+
+# frames written as one parquet file (fmt "parquet") or arrow IPC file (fmt "arrow", readable with
+# pandas.read_feather), as a sequence of bytes. `metadata` is stored in the file's schema metadata
+def table_stream(frames, fmt="parquet", metadata=None):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError(f"{fmt} output needs pyarrow (pip install pyarrow)")
+    pipe = _Pipe()
+    writer = None
+    for frame in frames:
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if writer is None:
+            schema = table.schema.with_metadata({**(table.schema.metadata or {}), **(metadata or {})})
+            if fmt == "parquet":
+                writer = pq.ParquetWriter(pipe, schema)
+            else:
+                writer = pa.ipc.new_file(pipe, schema)
+        table = table.cast(schema)
+        if fmt == "parquet":
+            writer.write_table(table, row_group_size=ROW_GROUP)
+        else:
+            writer.write_table(table, max_chunksize=ROW_GROUP)
+        yield pipe.drain()
+    if writer is not None:
+        writer.close()
+    yield pipe.drain()
+
+# a Dataset as a netcdf file, as a sequence of bytes (written to a temporary file, then read out in
+# chunks, as the netcdf library needs a real file)
+def netcdf_stream(ds, encoding=None, chunk_size=1 << 20):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "out.nc")
+        ds.to_netcdf(path, encoding=encoding)
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+def write_csv_stream(frames, out):
+    for line in csv_metadata():
+        out.write(line + "\n")
+    header = True
+    for frame in frames:
+        frame.to_csv(out, index=False, header=header)
+        header = False
+        out.flush()
+
+def write_table_stream(frames, fmt, meta, out):
+    for chunk in table_stream(frames, fmt, meta):
+        out.write(chunk)
+    out.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fpath", default="", help="prefix of the netcdfs/ folder (as `fpath` in the app)")
+    parser.add_argument("--points", help="csv with lat, lon (and optional site_name) columns")
+    parser.add_argument("--lat", type=float, nargs="*", default=[])
+    parser.add_argument("--lon", type=float, nargs="*", default=[])
+    parser.add_argument("--res", nargs="+", default=["monthly"], choices=list(TIME_RES) + ["all"],
+                        help="temporal resolutions ('all' for every fixed resolution)")
+    parser.add_argument("--custom-kind", choices=["running", "season"], default="running")
+    parser.add_argument("--custom-length", type=int, default=9, help="custom window length in months")
+    parser.add_argument("--custom-start", type=int, default=1, help="first month of a custom season")
+    parser.add_argument("--start", help="first date to keep (YYYY-MM-DD)")
+    parser.add_argument("--end", help="last date to keep (YYYY-MM-DD)")
+    parser.add_argument("--batch", type=int, default=500, help="points read per batch")
+    parser.add_argument("--format", choices=["csv", "parquet", "arrow"], default="csv")
+    parser.add_argument("--out", help="output file (default: standard output)")
+    args = parser.parse_args(argv)
+    if args.custom_length < 1:
+        parser.error("--custom-length must be at least 1 month")
+
+    if args.points:
+        points = pd.read_csv(args.points, comment="#")
+    else:
+        if len(args.lat) != len(args.lon) or not args.lat:
+            parser.error("give --points, or the same number of --lat and --lon values")
+        points = pd.DataFrame({"lat": args.lat, "lon": args.lon})
+
+    resolutions = [res for res in TIME_RES if res != "custom"] if "all" in args.res else args.res
+    custom = (args.custom_kind, args.custom_length, args.custom_start)
+    date_range = (args.start or "1900-01-01", args.end or "2100-12-31") if (args.start or args.end) else None
+    frames = extract_many(points, resolutions, args.fpath, custom, date_range, args.batch)
+
+    if args.format in ["parquet", "arrow"]:
+        meta = dataset_metadata(resolution=",".join(resolutions), date_range=date_range and "/".join(date_range))
+        if args.out:
+            with open(args.out, "wb") as out:
+                write_table_stream(frames, args.format, meta, out)
+        else:
+            write_table_stream(frames, args.format, meta, sys.stdout.buffer)
+    elif args.out:
+        with open(args.out, "w", newline="") as out:
+            write_csv_stream(frames, out)
+    else:
+        write_csv_stream(frames, sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
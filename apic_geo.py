@@ -0,0 +1,160 @@
+"""Spatial search results for GIS (GeoTIFF, written directly with no GDAL needed, and GeoJSON polygons),
+and areas of the matches by region."""
+import json
+import struct
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import mapping, shape
+
+
+# regular grid edges of a cell-centre coordinate, so neighbouring cells share exactly the same edge
+def cell_edges(coord):
+    coord = np.asarray(coord, dtype=np.float64)
+    step = (coord[-1] - coord[0]) / (len(coord) - 1) if len(coord) > 1 else 1.
+    return coord[0] - step / 2 + step * np.arange(len(coord) + 1)
+
+
+# GEOTIFF
+# TIFF field types: (type code, struct format)
+_TIFF_TYPES = {"ascii": (2, "s"), "short": (3, "H"), "long": (4, "I"), "double": (12, "d")}
+
+# the image file directory for `entries` [(tag, type, values)], with values that do not fit in an
+# entry written after it
+def _tiff_ifd(entries, offset):
+    entries = sorted(entries)
+    extra_offset = offset + 2 + 12 * len(entries) + 4
+    head, extra = [struct.pack("<H", len(entries))], b""
+    for tag, typ, vals in entries:
+        code, fmt = _TIFF_TYPES[typ]
+        data = vals if typ == "ascii" else struct.pack(f"<{len(vals)}{fmt}", *vals)
+        if len(data) <= 4:
+            head.append(struct.pack("<HHI", tag, code, len(vals)) + data.ljust(4, b"\0"))
+        else:
+            head.append(struct.pack("<HHII", tag, code, len(vals), extra_offset + len(extra)))
+            extra += data + b"\0" * (len(data) % 2)
+    head.append(struct.pack("<I", 0))
+    return b"".join(head) + extra
+
+# single-band float32 GeoTIFF (WGS84 lat/lon, NaN as nodata) of a 2-D (lat, lon) DataArray on a
+# regular grid, as a sequence of bytes: the header, then the image rows strip by strip
+def geotiff_stream(da, rows_per_strip=16):
+    da = da.transpose("lat", "lon")
+    vals = da.values.astype("<f4")
+    lat_edges, lon_edges = cell_edges(da.lat.values), cell_edges(da.lon.values)
+    # rows run north to south
+    if lat_edges[0] < lat_edges[-1]:
+        vals, lat_edges = vals[::-1], lat_edges[::-1]
+    ny, nx = vals.shape
+    starts = list(range(0, ny, rows_per_strip))
+    counts = [(min(r0 + rows_per_strip, ny) - r0) * nx * 4 for r0 in starts]
+
+    def entries(offsets):
+        return [
+            (256, "long", [nx]), (257, "long", [ny]), (258, "short", [32]), (259, "short", [1]),
+            (262, "short", [1]), (273, "long", offsets), (277, "short", [1]), (278, "long", [rows_per_strip]),
+            (279, "long", counts), (284, "short", [1]), (339, "short", [3]),
+            # ModelPixelScale, ModelTiepoint (top-left corner) and GeoKeyDirectory: geographic
+            # WGS84, pixels are areas
+            (33550, "double", [abs(lon_edges[1] - lon_edges[0]), abs(lat_edges[1] - lat_edges[0]), 0.]),
+            (33922, "double", [0., 0., 0., lon_edges[0], lat_edges[0], 0.]),
+            (34735, "short", [1, 1, 0, 3, 1024, 0, 1, 2, 1025, 0, 1, 1, 2048, 0, 1, 4326]),
+            (42113, "ascii", b"nan\0"),
+        ]
+
+    # the directory's size does not depend on the offsets, so lay it out once to find where the
+    # image data starts
+    data_start = 8 + len(_tiff_ifd(entries([0] * len(starts)), 8))
+    offsets = list(data_start + np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int))
+    yield b"II" + struct.pack("<HI", 42, 8) + _tiff_ifd(entries(offsets), 8)
+    for r0 in starts:
+        yield vals[r0:r0 + rows_per_strip].tobytes()
+
+
+# POLYGONS
+# polygons covering the True cells of a 2-D (lat, lon) mask, with contiguous cells merged. Each row
+# is first reduced to runs of consecutive cells, so only one rectangle per run is unioned
+def mask_polygons(mask, lat, lon):
+    mask = np.asarray(mask, dtype=bool)
+    lat_edges, lon_edges = cell_edges(lat), cell_edges(lon)
+    padded = np.pad(mask, ((0, 0), (1, 1))).astype(np.int8)
+    rows, starts = np.nonzero(np.diff(padded, axis=1) == 1)
+    _, stops = np.nonzero(np.diff(padded, axis=1) == -1)
+    if not len(rows):
+        return []
+    y0, y1 = lat_edges[rows], lat_edges[rows + 1]
+    boxes = shapely.box(lon_edges[starts], np.minimum(y0, y1), lon_edges[stops], np.maximum(y0, y1))
+    # (simplifying with zero tolerance drops the vertices left along straight edges)
+    merged = shapely.union_all(boxes).simplify(0)
+    return list(getattr(merged, "geoms", [merged]))
+
+# GeoJSON feature collection of polygons, as a sequence of strings (one feature at a time). Each
+# feature gets an id, its number of grid cells and any `properties` given
+def geojson_stream(polygons, cell_area, properties=None):
+    yield '{"type": "FeatureCollection", "features": [\n'
+    for i, poly in enumerate(polygons):
+        props = {"id": i + 1, "n_cells": int(round(poly.area / cell_area)), **(properties or {})}
+        feature = {"type": "Feature", "properties": props, "geometry": mapping(poly)}
+        yield ("" if i == 0 else ",\n") + json.dumps(feature)
+    yield "\n]}\n"
+
+
+# AREAS AND REGIONS
+EARTH_RADIUS_KM = 6371.0088
+
+# area (km2) of grid cells centred on `lat`, of size dlat x dlon degrees, on a spherical Earth
+def cell_areas(lat, dlat, dlon):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    half = np.radians(abs(dlat)) / 2
+    return EARTH_RADIUS_KM**2 * np.radians(abs(dlon)) * (np.sin(lat + half) - np.sin(lat - half))
+
+# index of the geometry containing each (lat, lon) point. Points inside none of them (e.g. coastal
+# cells whose centre is offshore) get the nearest geometry
+def region_index(lat, lon, geometries):
+    points = shapely.points(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    tree = shapely.STRtree(geometries)
+    index = np.full(len(points), -1, dtype=np.int64)
+    pt, geom = tree.query(points, predicate="within")
+    index[pt] = geom
+    outside = np.flatnonzero(index < 0)
+    if len(outside):
+        index[outside] = tree.query_nearest(points[outside], all_matches=False)[1]
+    return index
+
+# matched area by region in one weighted bincount. `matched` is a (cell,) boolean array; returns a
+# table with each region's matched area, the share of the region matched and the share of the total
+# matched area, then a total row
+def region_summary(matched, areas, index, names, total_name="Total"):
+    matched = np.asarray(matched, dtype=bool)
+    n = len(names)
+    region_area = np.bincount(index, weights=areas, minlength=n)
+    matched_area = np.bincount(index, weights=np.where(matched, areas, 0.), minlength=n)
+    total = matched_area.sum()
+    with np.errstate(invalid="ignore", divide="ignore"):
+        table = pd.DataFrame({
+            "Region": list(names) + [total_name],
+            "Matched area (km²)": np.r_[matched_area, total],
+            "Region matched (%)": 100 * np.r_[matched_area / region_area, total / region_area.sum()],
+            "Share of matched area (%)": 100 * np.r_[matched_area, total] / total if total > 0 else 0.,
+        })
+    return table
+
+# the geometries of a GeoJSON file (a feature collection, a feature or a bare geometry) merged into one
+def read_geojson(path):
+    with open(path) as f:
+        obj = json.load(f)
+    if obj.get("type") == "FeatureCollection":
+        geoms = [shape(feature["geometry"]) for feature in obj["features"] if feature.get("geometry")]
+    elif obj.get("type") == "Feature":
+        geoms = [shape(obj["geometry"])]
+    else:
+        geoms = [shape(obj)]
+    if not geoms:
+        raise ValueError("the file has no geometries")
+    return shapely.union_all(geoms)
+
+# which (lat, lon) points lie inside (or on the edge of) a geometry
+def points_inside(lat, lon, geometry):
+    shapely.prepare(geometry)
+    return shapely.intersects_xy(geometry, np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
@@ -0,0 +1,353 @@
+"""Continent-wide surfaces computed from the packed (time, cell) cubes (see apic_data.pack)."""
+import math
+import warnings
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from apic_data import decode
+from apic_derive import PRODUCTS
+
+# local meteoric water line fits: ordinary least squares, reduced major axis and
+# precipitation-weighted least squares (Hughes & Crawford 2012)
+LMWL_METHODS = {"ols": "OLS", "rma": "RMA", "pwlsr": "Precipitation-weighted"}
+
+# cells are processed in blocks to bound the size of the temporaries
+CELL_BLOCK = 4096
+
+
+# per-cell d2H = slope * d18O + intercept fits for every land cell, in one vectorised pass over the
+# monthly data. Returns a Dataset with slope, intercept, r2 and n (months used) over (fit, cell)
+def lmwl_fits(d18O, d2H, prec):
+    ncell = d18O.sizes["cell"]
+    out = {key: np.full((len(LMWL_METHODS), ncell), np.nan) for key in ["slope", "intercept", "r2"]}
+    out["n"] = np.zeros(ncell, dtype=np.int32)
+    for c0 in range(0, ncell, CELL_BLOCK):
+        block = slice(c0, min(c0 + CELL_BLOCK, ncell))
+        x = decode(d18O.isel(cell=block)).values.astype(np.float64)
+        y = decode(d2H.isel(cell=block)).values.astype(np.float64)
+        p = decode(prec.isel(cell=block)).values.astype(np.float64)
+        valid = np.isfinite(x) & np.isfinite(y)
+        out["n"][block] = valid.sum(axis=0)
+        wts = {
+            "ols": valid.astype(np.float64),
+            "pwlsr": np.where(valid & np.isfinite(p), np.maximum(p, 0.), 0.),
+        }
+        for i, method in enumerate(LMWL_METHODS):
+            w = wts["pwlsr" if method == "pwlsr" else "ols"]
+            slope, intercept, r2 = _weighted_line(np.where(valid, x, 0.), np.where(valid, y, 0.), w, rma=method == "rma")
+            out["slope"][i, block] = slope
+            out["intercept"][i, block] = intercept
+            out["r2"][i, block] = r2
+
+    coords = {"fit": list(LMWL_METHODS), "lat": ("cell", d18O.lat.values), "lon": ("cell", d18O.lon.values)}
+    return xr.Dataset({
+        "slope": (("fit", "cell"), out["slope"]),
+        "intercept": (("fit", "cell"), out["intercept"]),
+        "r2": (("fit", "cell"), out["r2"]),
+        "n": ("cell", out["n"]),
+    }, coords=coords)
+
+# weighted least-squares (or reduced major axis) line through the columns of x and y
+def _weighted_line(x, y, w, rma=False):
+    sw = w.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        xm = (w * x).sum(axis=0) / sw
+        ym = (w * y).sum(axis=0) / sw
+        dx, dy = x - xm, y - ym
+        sxx = (w * dx * dx).sum(axis=0)
+        syy = (w * dy * dy).sum(axis=0)
+        sxy = (w * dx * dy).sum(axis=0)
+        slope = np.sign(sxy) * np.sqrt(syy / sxx) if rma else sxy / sxx
+        r2 = sxy**2 / (sxx * syy)
+    # need at least three points (with weight) for a meaningful line
+    ok = ((w > 0).sum(axis=0) >= 3) & (sxx > 0)
+    slope = np.where(ok, slope, np.nan)
+    return slope, np.where(ok, ym - slope * xm, np.nan), np.where(ok, r2, np.nan)
+
+
+# TRENDS
+# per-cell linear trends (per year) of (year, cell) annual values: the OLS slope, the Theil-Sen slope
+# (median of the slopes between all pairs of years) and the Mann-Kendall test of a monotonic trend
+# (z score and two-sided p value; no correction for tied values). Returns a Dataset over cell
+def trend_fits(years, vals):
+    years = np.asarray(years, dtype=np.float64)
+    vals = np.asarray(vals, dtype=np.float64)
+    ncell = vals.shape[1]
+    out = {key: np.full(ncell, np.nan) for key in ["ols_slope", "sen_slope", "mk_z"]}
+    out["n"] = np.zeros(ncell, dtype=np.int32)
+    i, j = np.triu_indices(len(years), 1)
+    # the pairwise differences are (pair, cell) float64, so fewer cells are taken at a time: with 60
+    # years that is 1770 pairs x CELL_BLOCK // 8 cells, about 7 MB per temporary and 20-25 MB at peak
+    block_size = max(1, CELL_BLOCK // 8)
+    for c0 in range(0, ncell, block_size):
+        block = slice(c0, min(c0 + block_size, ncell))
+        v = vals[:, block]
+        valid = np.isfinite(v)
+        n = valid.sum(axis=0)
+        out["n"][block] = n
+        x = np.broadcast_to(years[:, None], v.shape)
+        out["ols_slope"][block] = _weighted_line(x, np.where(valid, v, 0.), valid.astype(np.float64))[0]
+
+        dv = v[j] - v[i]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            sen = np.nanmedian(dv / (years[j] - years[i])[:, None], axis=0)
+        s = np.where(np.isfinite(dv), np.sign(dv), 0.).sum(axis=0)
+        var = n * (n - 1.) * (2 * n + 5.) / 18
+        with np.errstate(invalid="ignore", divide="ignore"):
+            z = (s - np.sign(s)) / np.sqrt(var)
+        ok = n >= 3
+        out["sen_slope"][block] = np.where(ok, sen, np.nan)
+        out["mk_z"][block] = np.where(ok, z, np.nan)
+
+    mk_p = np.vectorize(math.erfc, otypes=[np.float64])(np.abs(out["mk_z"]) / math.sqrt(2))
+    return xr.Dataset({
+        "ols_slope": ("cell", out["ols_slope"]),
+        "sen_slope": ("cell", out["sen_slope"]),
+        "mk_z": ("cell", out["mk_z"]),
+        "mk_p": ("cell", np.where(np.isfinite(out["mk_z"]), mk_p, np.nan)),
+        "n": ("cell", out["n"]),
+    })
+
+
+# SEASONALITY
+# per-cell seasonal cycle of a (12, cell) monthly climatology, in one vectorised pass. The "range"
+# fit is the difference between the highest and lowest monthly values, with the month (1-12) of the
+# lowest (most depleted); the "harmonic" fit is the peak-to-trough amplitude of the first annual
+# harmonic, the month of its trough on the same scale (fractional, e.g. 4.5 is between April and
+# May) and the share of the variance between months it explains (cells missing any month are NaN).
+# Returns a Dataset over (fit, cell)
+def seasonal_cycle(clim):
+    clim = np.asarray(clim, dtype=np.float64)
+    valid = np.isfinite(clim)
+    any_valid = valid.any(axis=0)
+    filled_max = np.where(valid, clim, -np.inf)
+    filled_min = np.where(valid, clim, np.inf)
+    range_amp = np.where(any_valid, filled_max.max(axis=0) - filled_min.min(axis=0), np.nan)
+    range_month = np.where(any_valid, filled_min.argmin(axis=0) + 1., np.nan)
+
+    # first harmonic of month index t = 0..11 (Jan..Dec): x = mean + a cos(wt) + b sin(wt)
+    w = 2 * np.pi * np.arange(12) / 12
+    complete = valid.all(axis=0)
+    x = np.where(complete, clim, 0.)
+    a = 2 / 12 * np.cos(w) @ x
+    b = 2 / 12 * np.sin(w) @ x
+    amp = np.hypot(a, b)
+    var = x.var(axis=0)
+    trough = (np.arctan2(b, a) / (2 * np.pi) * 12 + 6) % 12
+    with np.errstate(invalid="ignore", divide="ignore"):
+        harm_r2 = np.where(var > 0, amp**2 / 2 / var, np.nan)
+    harm_amp = np.where(complete, 2 * amp, np.nan)
+    harm_month = np.where(complete, trough + 1, np.nan)
+    harm_r2 = np.where(complete, harm_r2, np.nan)
+
+    return xr.Dataset({
+        "amplitude": (("fit", "cell"), np.stack([harm_amp, range_amp])),
+        "depleted_month": (("fit", "cell"), np.stack([harm_month, range_month])),
+        "harmonic_r2": ("cell", harm_r2),
+    }, coords={"fit": ["harmonic", "range"]})
+
+
+# SOURCE PROBABILITY
+# relative probability that a sample with values (x, y) (e.g. d18O, d2H) formed in each cell, given
+# the cells' mean surfaces and a bivariate Gaussian error model with standard deviations sx, sy and
+# covariance cov. All arguments broadcast, so sx, sy and cov may also be per-cell arrays. Returns the
+# probabilities normalised to sum to one over the cells with both means (NaN elsewhere)
+def bivariate_probability(mean_x, mean_y, x, y, sx, sy, cov=0.):
+    sx, sy, cov = np.asarray(sx, dtype=np.float64), np.asarray(sy, dtype=np.float64), np.asarray(cov, dtype=np.float64)
+    det = sx**2 * sy**2 - cov**2
+    if np.any(sx <= 0) or np.any(sy <= 0) or np.any(det <= 0):
+        raise ValueError("Uncertainties must be positive, and the covariance smaller in size than their product")
+    dx = x - np.asarray(mean_x, dtype=np.float64)
+    dy = y - np.asarray(mean_y, dtype=np.float64)
+    # squared Mahalanobis distance; the Gaussian's constant factor cancels in the normalisation
+    m2 = (sy**2 * dx**2 - 2 * cov * dx * dy + sx**2 * dy**2) / det
+    return normalise_log_likelihood(-0.5 * m2 - 0.5 * np.log(det))
+
+# probabilities from log-likelihoods, normalised over the last (cell) axis. Shifting by the maximum
+# first keeps samples far from every cell from underflowing to an all-zero map
+def normalise_log_likelihood(loglik):
+    with np.errstate(invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        lik = np.exp(loglik - np.nanmax(loglik, axis=-1, keepdims=True))
+        return lik / np.nansum(lik, axis=-1, keepdims=True)
+
+# relative probability that a sample with value x formed in each cell, for a Gaussian error model
+# with standard deviation sd (a number or a per-cell array), normalised as in bivariate_probability
+def gaussian_probability(mean, x, sd):
+    sd = np.asarray(sd, dtype=np.float64)
+    if np.any(sd <= 0):
+        raise ValueError("Uncertainties must be positive")
+    z = (x - np.asarray(mean, dtype=np.float64)) / sd
+    return normalise_log_likelihood(-0.5 * z**2 - np.log(sd))
+
+
+# BATCH SEARCH
+ISOTOPE_NAMES = {"d2h": "d2H", "d18o": "d18O", "dxs": "dxs"}
+
+# tidy an uploaded sample table: a `value` column is required; `sample`, `isotope`, `offset` and
+# `range` columns are optional, with missing entries taken from the defaults given
+def sample_table(df, isotope="d18O", offset=0., value_range=2.):
+    cols = {str(col).strip().lower(): col for col in df.columns}
+    if "value" not in cols:
+        raise ValueError("the sample table needs a 'value' column")
+    n = len(df)
+
+    def numeric(name, default):
+        if name not in cols:
+            return np.full(n, default, dtype=np.float64)
+        return pd.to_numeric(df[cols[name]], errors="coerce").fillna(default).values
+
+    isotopes = df[cols["isotope"]].fillna(isotope) if "isotope" in cols else pd.Series([isotope] * n)
+    out = pd.DataFrame({
+        "sample": df[cols["sample"]].astype(str).values if "sample" in cols else [f"sample_{i + 1}" for i in range(n)],
+        "isotope": isotopes.astype(str).str.strip().str.lower().map(ISOTOPE_NAMES).values,
+        "value": pd.to_numeric(df[cols["value"]], errors="coerce").values,
+        "offset": numeric("offset", offset),
+        "range": numeric("range", value_range),
+    })
+    bad = out["isotope"].isna() | out["value"].isna() | (out["range"] < 0)
+    if bad.any():
+        raise ValueError(f"check rows {', '.join(str(i + 1) for i in np.flatnonzero(bad))} of the sample table "
+                         "(isotope must be d2H, d18O or dxs, value a number and range at least 0)")
+    return out
+
+# which cells match each sample (|mean - (value - offset)| <= range), in one broadcast over a
+# (sample, cell) array. `means` holds a (cell,) mean surface for each isotope in the table
+def batch_matches(means, samples):
+    isotopes = list(dict.fromkeys(samples["isotope"]))
+    surfaces = np.stack([np.asarray(means[iso], dtype=np.float64) for iso in isotopes])
+    rows = surfaces[[isotopes.index(iso) for iso in samples["isotope"]]]
+    centre = (samples["value"] - samples["offset"]).values[:, None]
+    with np.errstate(invalid="ignore"):
+        return np.abs(rows - centre) <= samples["range"].values[:, None]
+
+# fraction of the samples matching each cell (NaN where no sample's isotope has a mean value)
+def match_frequency(matches, valid):
+    return np.where(valid, matches.sum(axis=0) / matches.shape[0], np.nan)
+
+# indices of the n cells whose mean is closest to `target`, closest first. Only those n are sorted
+# (argpartition finds them without sorting every cell); cells with no mean are never chosen
+def closest_cells(mean, target, n):
+    misfit = np.abs(np.asarray(mean, dtype=np.float64) - target)
+    misfit = np.where(np.isfinite(misfit), misfit, np.inf)
+    n = int(min(n, np.isfinite(misfit).sum()))
+    if n <= 0:
+        return np.array([], dtype=np.int64)
+    nearest = np.argpartition(misfit, n - 1)[:n]
+    return nearest[np.argsort(misfit[nearest], kind="stable")]
+
+# smallest set of cells holding `level` of the probability (highest-probability cells first)
+def credible_region(prob, level=0.95):
+    prob = np.asarray(prob, dtype=np.float64)
+    flat = prob.ravel()
+    order = np.argsort(np.where(np.isfinite(flat), -flat, np.inf))
+    cum = np.cumsum(np.nan_to_num(flat[order]))
+    region = np.zeros(flat.shape, dtype=bool)
+    region[order[:np.searchsorted(cum, level * cum[-1]) + 1]] = True
+    return (region & np.isfinite(flat)).reshape(prob.shape)
+
+
+# SPACE-TIME SEARCH
+# which years each cell matches (lwr <= value <= upr) given its (year, cell) annual values, with the
+# years packed as bits: a (cell, ceil(year/8)) uint8 array, an eighth of the size of a boolean cube
+def year_match_bits(vals, lwr, upr):
+    with np.errstate(invalid="ignore"):
+        match = (vals >= lwr) & (vals <= upr)
+    return np.packbits(match.T, axis=1)
+
+# number of matching years in each cell
+def match_count(bits):
+    return np.bitwise_count(bits).sum(axis=1, dtype=np.int16)
+
+# the years matched by one cell's row of bits
+def matching_years(bits, years):
+    return np.asarray(years)[np.unpackbits(bits, count=len(years)).astype(bool)]
+
+
+# CLIMATE INDICES
+# an uploaded index series (e.g. ENSO, IOD, SAM) as a float Series: monthly with month-start time
+# stamps if the table has a `date` (or `time`) column, or `year` and `month` columns; annual, indexed
+# by year, if it has only a `year` column. The values are the `value` column, or else the last
+# numeric column
+def index_series(df):
+    cols = {c.lower().strip(): c for c in df.columns}
+    if "value" in cols:
+        values = df[cols["value"]]
+    else:
+        numeric = [c for c in df.columns if c.lower().strip() not in ("date", "time", "year", "month")
+                   and pd.api.types.is_numeric_dtype(df[c])]
+        if not numeric:
+            raise ValueError("the table needs a numeric `value` column")
+        values = df[numeric[-1]]
+    values = pd.to_numeric(values, errors="coerce").values.astype(np.float64)
+    if "date" in cols or "time" in cols:
+        times = pd.to_datetime(df[cols.get("date", cols.get("time"))])
+        index = pd.DatetimeIndex(times).to_period("M").to_timestamp()
+    elif "year" in cols and "month" in cols:
+        index = pd.to_datetime(pd.DataFrame({"year": df[cols["year"]], "month": df[cols["month"]], "day": 1}))
+    elif "year" in cols:
+        index = pd.Index(df[cols["year"]].astype(int).values, name="year")
+    else:
+        raise ValueError("the table needs a `date` column, or `year` (and `month`) columns")
+    series = pd.Series(values, index=index).dropna()
+    return series.groupby(level=0).mean().sort_index()
+
+# an index series at the time resolution of a product (see apic_derive.PRODUCTS): monthly series are
+# averaged over the same windows (labelled by their starting year) or right-aligned running means.
+# Annual series can only be used as they are, with the annual and seasonal products
+def index_at_resolution(series, product):
+    monthly = isinstance(series.index, pd.DatetimeIndex)
+    spec = PRODUCTS.get(product, {"kind": "monthly"})
+    if not monthly:
+        if spec["kind"] != "window":
+            raise ValueError("a monthly index is needed for monthly values and running means")
+        return series
+    # on a complete monthly axis, so that windows and lags count months
+    series = series.reindex(pd.date_range(series.index[0], series.index[-1], freq="MS"))
+    if spec["kind"] == "running":
+        return series.rolling(spec["length"]).mean()
+    if spec["kind"] != "window":
+        return series
+    # each month's window year is the year of the window's first month
+    shifted = series.index - pd.DateOffset(months=spec["start"] - 1)
+    in_window = ((series.index.month - spec["start"]) % 12) < spec["length"]
+    grouped = series[in_window].groupby(shifted.year[in_window])
+    return grouped.mean().where(grouped.count() == spec["length"])
+
+# correlation of every cell with one or more index series, from a handful of matrix products over
+# the (time, cell) values rather than a loop over cells. `x` is (time, lag): the index aligned with
+# the values' time axis at each lag. Missing values are left out pair by pair. The two-sided p
+# values use Fisher's z transform (no allowance for autocorrelation). Returns a Dataset over
+# (lag, cell)
+def index_correlation(x, vals, lags):
+    x = np.asarray(x, dtype=np.float64)
+    ncell = vals.shape[1]
+    vx = np.isfinite(x)
+    x0 = np.where(vx, x, 0.)
+    vx = vx.astype(np.float64)
+    r, n = np.full((x.shape[1], ncell), np.nan), np.zeros((x.shape[1], ncell))
+    for c0 in range(0, ncell, CELL_BLOCK):
+        block = slice(c0, min(c0 + CELL_BLOCK, ncell))
+        y = np.asarray(vals[:, block], dtype=np.float64)
+        vy = np.isfinite(y)
+        y0 = np.where(vy, y, 0.)
+        vy = vy.astype(np.float64)
+        nb = vx.T @ vy
+        sx, sxx = x0.T @ vy, (x0**2).T @ vy
+        sy, syy = vx.T @ y0, vx.T @ y0**2
+        sxy = x0.T @ y0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rb = (nb * sxy - sx * sy) / np.sqrt((nb * sxx - sx**2) * (nb * syy - sy**2))
+        r[:, block] = np.where(nb >= 4, np.clip(rb, -1, 1), np.nan)
+        n[:, block] = nb
+    with np.errstate(invalid="ignore", divide="ignore"):
+        z = np.arctanh(r) * np.sqrt(n - 3)
+    p = np.vectorize(math.erfc, otypes=[np.float64])(np.nan_to_num(np.abs(z), nan=0., posinf=40.) / math.sqrt(2))
+    return xr.Dataset({
+        "r": (("lag", "cell"), r),
+        "p": (("lag", "cell"), np.where(np.isfinite(r), p, np.nan)),
+        "n": (("lag", "cell"), n.astype(np.int32)),
+    }, coords={"lag": list(lags)})
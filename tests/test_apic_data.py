@@ -0,0 +1,179 @@
+"""Amount-weighted window means from prefix sums and their labels, and the size-bounded LRU cache:
+eviction order, oversized values and read-only results."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from apic_data import custom_window, lru_cache_bytes, prec_sums, prefix_sums, window_means
+
+
+# amount-weighted mean of each window, month by month: NaN if any month is missing or it never rained
+def reference_means(dat, prec, starts, length):
+    out = np.full((len(starts),) + dat.shape[1:], np.nan)
+    for k, s in enumerate(starts):
+        d, p = dat[s:s + length], prec[s:s + length]
+        ok = (np.isfinite(d) & np.isfinite(p)).all(axis=0) & (np.nansum(p, axis=0) > 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            out[k] = np.where(ok, (d * p).sum(axis=0) / p.sum(axis=0), np.nan)
+    return out
+
+
+@pytest.fixture
+def monthly():
+    rng = np.random.default_rng(2)
+    dat = rng.normal(-30, 10, size=(48, 5))
+    prec = rng.gamma(2., 30., size=(48, 5))
+    dat[7, 1] = np.nan
+    prec[20, 2] = np.nan
+    # no rain at all in months 30-35 of cell 3, and some dry months in cell 4
+    prec[30:36, 3] = 0.
+    prec[10:12, 4] = 0.
+    dat[::3, 0] = np.nan
+    return dat, prec
+
+
+@pytest.mark.parametrize("length", [1, 3, 6, 12])
+def test_window_means(monthly, length):
+    dat, prec = monthly
+    starts = np.arange(len(dat) - length + 1)
+    np.testing.assert_allclose(window_means(prefix_sums(dat, prec), starts, length),
+                               reference_means(dat, prec, starts, length), rtol=1e-12)
+
+
+def test_window_means_gaps(monthly):
+    dat, prec = monthly
+    vals = window_means(prefix_sums(dat, prec), np.arange(len(dat) - 2), 3)
+    # windows touching a missing value, or with no rain, are NaN
+    assert np.isnan(vals[5:8, 1]).all() and np.isfinite(vals[[4, 8], 1]).all()
+    assert np.isnan(vals[18:21, 2]).all()
+    assert np.isnan(vals[30:34, 3]).all() and np.isfinite(vals[[27, 34], 3]).all()
+    # some dry months are fine while the window has any rain
+    assert np.isfinite(vals[9:12, 4]).all()
+    # a gap every third month leaves no complete window
+    assert np.isnan(vals[:, 0]).all()
+
+
+def test_shared_prec_sums(monthly):
+    dat, prec = monthly
+    cs_p = prec_sums(prec)
+    assert cs_p.shape == (len(prec) + 1, 5) and (cs_p[0] == 0).all()
+    # the prec sums skip missing prec but not missing values: those windows are caught by the counts
+    for a, b in zip(prefix_sums(dat, prec, cs_p), prefix_sums(dat, prec)):
+        np.testing.assert_array_equal(a, b)
+
+
+def test_custom_season_across_year_end(monthly):
+    dat, prec = monthly
+    times = pd.date_range("1962-01-01", periods=48, freq="MS")
+    labels, vals = custom_window(prefix_sums(dat, prec), times, "season", 3, start=12)
+    # Dec-Feb seasons are labelled by their December; the last December has no Jan-Feb to follow
+    assert list(pd.DatetimeIndex(labels)) == [pd.Timestamp(y, 12, 1) for y in (1962, 1963, 1964)]
+    np.testing.assert_allclose(vals, reference_means(dat, prec, [11, 23, 35], 3))
+
+    # a 12-month season from July: Jul-Jun years
+    labels, vals = custom_window(prefix_sums(dat, prec), times, "season", 12, start=7)
+    assert list(pd.DatetimeIndex(labels).year) == [1962, 1963, 1964]
+    assert (pd.DatetimeIndex(labels).month == 7).all()
+    np.testing.assert_allclose(vals, reference_means(dat, prec, [6, 18, 30], 12))
+
+
+def test_custom_running_labels(monthly):
+    dat, prec = monthly
+    times = pd.date_range("1962-01-01", periods=48, freq="MS")
+    labels, vals = custom_window(prefix_sums(dat, prec), times, "running", 6)
+    # right-aligned: every month is a label, and the first five have no complete window
+    np.testing.assert_array_equal(labels, times.values)
+    assert vals.shape == dat.shape and np.isnan(vals[:5]).all()
+    np.testing.assert_allclose(vals[5:], reference_means(dat, prec, np.arange(43), 6))
+
+    # longer than the record: all NaN
+    labels, vals = custom_window(prefix_sums(dat[:4], prec[:4]), times[:4], "running", 6)
+    assert len(labels) == 4 and np.isnan(vals).all()
+
+
+# a cached function returning n float64 zeros (8n bytes), recording every call it computes
+def make_cached(max_bytes):
+    calls = []
+
+    @lru_cache_bytes(max_bytes)
+    def zeros(n, tag=0):
+        calls.append((n, tag))
+        return np.zeros(n)
+
+    return zeros, calls
+
+
+def test_eviction_order():
+    zeros, calls = make_cached(3 * 80)
+    for tag in range(3):
+        zeros(10, tag)
+    # a hit moves tag 0 to the most recently used end, so tag 1 is the first to go
+    zeros(10, 0)
+    zeros(10, 3)
+    assert zeros.cache_info()["entries"] == 3 and zeros.cache_info()["bytes"] == 240
+
+    calls.clear()
+    zeros(10, 0)
+    zeros(10, 2)
+    zeros(10, 3)
+    assert calls == []
+    zeros(10, 1)
+    assert calls == [(10, 1)]
+    # and the recomputed tag 1 pushed out the least recently used, tag 0
+    zeros(10, 0)
+    assert calls == [(10, 1), (10, 0)]
+
+
+def test_eviction_frees_enough_bytes():
+    zeros, calls = make_cached(100)
+    zeros(5, 0)
+    zeros(5, 1)
+    # 80 bytes need both 40-byte entries out
+    zeros(10)
+    info = zeros.cache_info()
+    assert info["entries"] == 1 and info["bytes"] == 80
+
+
+def test_oversized_values_not_stored():
+    zeros, calls = make_cached(100)
+    zeros(5)
+    big = zeros(20)
+    assert big.shape == (20,)
+    info = zeros.cache_info()
+    assert info["entries"] == 1 and info["bytes"] == 40 and info["misses"] == 2
+    # recomputed on every call, and the value already cached is kept
+    zeros(20)
+    zeros(5)
+    assert calls == [(5, 0), (20, 0), (20, 0)]
+    assert zeros.cache_info()["hits"] == 1
+
+
+def test_results_read_only():
+    zeros, _ = make_cached(100)
+    for n in (5, 20):
+        val = zeros(n)
+        assert not val.flags.writeable
+        with pytest.raises(ValueError):
+            val[0] = 1.
+    # so a hit returns the value as computed
+    assert (zeros(5) == 0).all()
+
+
+def test_tuples_counted_and_read_only():
+    @lru_cache_bytes(1000)
+    def pair(n):
+        return np.zeros(n), np.ones(n, dtype=np.float32)
+
+    a, b = pair(10)
+    assert not a.flags.writeable and not b.flags.writeable
+    assert pair.cache_info()["bytes"] == 120
+
+
+def test_cache_clear():
+    zeros, calls = make_cached(100)
+    zeros(5)
+    zeros(5)
+    zeros.cache_clear()
+    assert zeros.cache_info() == {"hits": 0, "misses": 0, "bytes": 0, "entries": 0, "max_bytes": 100}
+    zeros(5)
+    assert len(calls) == 2
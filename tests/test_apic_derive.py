@@ -0,0 +1,109 @@
+"""Offline derivation: appending whole years with `update` gives the same products as a full
+rebuild, and product file names follow the shipped year-end convention."""
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from apic_derive import ISOTOPES, PRODUCTS, main, monthly_fname, prec_fname, product_fname
+
+LAT = -30. + np.arange(3)
+LON = 140. + np.arange(4)
+
+
+def cube(name, times, vals):
+    return xr.DataArray(vals.astype(np.float32), coords={"time": times, "lat": LAT, "lon": LON},
+                        dims=("time", "lat", "lon"), name=name).to_dataset()
+
+
+# monthly isotope cubes for 1962 to year_end and prec from 1959, with gaps that matter at the seam
+def write_inputs(path, year_end, iso_vals, prec_vals):
+    (path / "netcdfs" / "prec").mkdir(parents=True)
+    n = (year_end - 1962 + 1) * 12
+    times = pd.date_range("1962-01-01", periods=n, freq="MS")
+    for iso in ISOTOPES:
+        cube(f"{iso}p", times, iso_vals[iso][:n]).to_netcdf(path / "netcdfs" / monthly_fname(iso, 1962, year_end))
+    prec_times = pd.date_range("1959-01-01", periods=n + 36, freq="MS")
+    cube("prec", prec_times, prec_vals[:n + 36]).to_netcdf(path / "netcdfs" / prec_fname(year_end))
+
+
+@pytest.fixture(scope="module")
+def records():
+    rng = np.random.default_rng(1)
+    n = (2024 - 1962 + 1) * 12
+    iso_vals = {iso: rng.normal(-30, 10, size=(n, 3, 4)) for iso in ISOTOPES}
+    prec_vals = rng.gamma(2., 30., size=(n + 36, 3, 4))
+    t = pd.date_range("1962-01-01", periods=n, freq="MS")
+    i = {f"{d:%Y-%m}": k for k, d in enumerate(t)}
+    for iso in ISOTOPES:
+        vals = iso_vals[iso]
+        # a gap in the old months kept as context (Jul-Jun 2023 and the 12-month means into 2024)
+        vals[i["2023-08"], 0, 0] = np.nan
+        # a gap in the new months, and a cell with no data at all
+        vals[i["2024-04"], 1, 2] = np.nan
+        vals[:, 2, 3] = np.nan
+    # a dry summer across the seam: DJF 2023 has no precipitation
+    for m in ("2023-12", "2024-01", "2024-02"):
+        prec_vals[i[m] + 36, 1, 1] = 0.
+    return iso_vals, prec_vals
+
+
+def test_update_matches_rebuild(tmp_path, records):
+    iso_vals, prec_vals = records
+    old, full, new = tmp_path / "old", tmp_path / "full", tmp_path / "new"
+    write_inputs(old, 2023, iso_vals, prec_vals)
+    write_inputs(full, 2024, iso_vals, prec_vals)
+    main(["build", "--src", str(old), "--out", str(old), "--year-end", "2023", "--band", "2"])
+    main(["build", "--src", str(full), "--out", str(full), "--year-end", "2024", "--band", "2"])
+
+    # the 2024 slices on their own
+    new.mkdir()
+    times = pd.date_range("2024-01-01", periods=12, freq="MS")
+    args = ["update", "--src", str(old), "--out", str(tmp_path / "updated")]
+    for iso in ISOTOPES:
+        cube(f"{iso}p", times, iso_vals[iso][-12:]).to_netcdf(new / f"{iso}.nc")
+        args += [f"--new-{iso}", str(new / f"{iso}.nc")]
+    cube("prec", times, prec_vals[-12:]).to_netcdf(new / "prec.nc")
+    main(args + ["--new-prec", str(new / "prec.nc")])
+
+    for iso in ISOTOPES:
+        for product, spec in PRODUCTS.items():
+            fname = product_fname(iso, product, 1962, 2024)
+            ref = xr.open_dataset(full / "netcdfs" / fname)[f"{iso}p"].load()
+            upd = xr.open_dataset(tmp_path / "updated" / "netcdfs" / fname)[f"{iso}p"].load()
+            assert upd.dims == ref.dims, (iso, product)
+            if spec["dim"] is not None:
+                np.testing.assert_array_equal(upd[spec["dim"]].values, ref[spec["dim"]].values)
+            np.testing.assert_allclose(upd.values, ref.values, rtol=1e-5, atol=1e-4, err_msg=f"{iso} {product}")
+
+    # the seam cases did come through as gaps
+    djf = xr.open_dataset(full / "netcdfs" / product_fname("d2H", "DJF", 1962, 2024))["d2Hp"]
+    trop = xr.open_dataset(full / "netcdfs" / product_fname("d2H", "ann_trop", 1962, 2024))["d2Hp"]
+    assert np.isnan(djf.sel(year=2023).values[1, 1]) and np.isfinite(djf.sel(year=2022).values[1, 1])
+    assert np.isnan(trop.sel(year=2023).values[0, 0]) and np.isfinite(trop.sel(year=2023).values[1, 1])
+    assert np.isnan(trop.values[:, 2, 3]).all()
+
+
+def test_update_rejects_a_gap(tmp_path, records):
+    iso_vals, prec_vals = records
+    write_inputs(tmp_path, 2022, iso_vals, prec_vals)
+    # 2024 data cannot follow a record ending in 2022
+    times = pd.date_range("2024-01-01", periods=12, freq="MS")
+    args = ["update", "--src", str(tmp_path), "--out", str(tmp_path / "out")]
+    for iso in ISOTOPES:
+        cube(f"{iso}p", times, iso_vals[iso][-12:]).to_netcdf(tmp_path / f"{iso}.nc")
+        args += [f"--new-{iso}", str(tmp_path / f"{iso}.nc")]
+    cube("prec", times, prec_vals[-12:]).to_netcdf(tmp_path / "prec.nc")
+    with pytest.raises(SystemExit, match="record ends in 2022-12"):
+        main(args + ["--new-prec", str(tmp_path / "prec.nc")])
+
+
+def test_product_fname_year_end():
+    # windows running into the next year (Jul-Jun, Dec-Feb) end a year before the record
+    assert product_fname("d18O", "DJF") == "aus_prec.d18O_v1_1962-2022_ann-djf.nc"
+    assert product_fname("d18O", "ann_trop", 1962, 2024) == "aus_prec.d18O_v1_1962-2023_ann-trop.nc"
+    assert product_fname("dxs", "MAM", 1962, 2024) == "aus_prec.dxs_v1_1962-2024_ann-mam.nc"
+    assert product_fname("dxs", "SON") == "aus_prec.dxs_v1_1962-2023_ann-son.nc"
+    assert product_fname("d2H", "ann") == "aus_prec.d2H_v1_1962-2023_ann_median.nc"
+    assert product_fname("d2H", "12mrm", ext=".zarr") == "aus_prec.d2H_v1_1962-2023_12-month-running-mean.zarr"
+    assert product_fname("d2H", "ltm") == "aus_prec.d2H_v1_1962-2023_long-term-annual-mean_median.nc"
@@ -0,0 +1,126 @@
+"""Round trip of the GeoTIFF writer: parse the file's image file directory back and check the
+georeferencing and pixel data. Also region selection of the packed land cells by polygon and by
+state."""
+import json
+import struct
+
+import numpy as np
+import xarray as xr
+
+from shapely.geometry import box
+
+from apic_data import land_cells
+from apic_geo import geotiff_stream, points_inside, read_geojson, region_index
+
+# TIFF field types: code -> (struct format, size in bytes)
+TYPES = {2: ("s", 1), 3: ("H", 2), 4: ("I", 4), 12: ("d", 8)}
+
+
+# {tag: values} of the first image file directory of a little-endian TIFF
+def read_ifd(data):
+    assert data[:4] == b"II*\0"
+    offset = struct.unpack_from("<I", data, 4)[0]
+    n = struct.unpack_from("<H", data, offset)[0]
+    tags = {}
+    for i in range(n):
+        tag, code, count = struct.unpack_from("<HHI", data, offset + 2 + 12 * i)
+        fmt, size = TYPES[code]
+        pos = offset + 2 + 12 * i + 8
+        if count * size > 4:
+            pos = struct.unpack_from("<I", data, pos)[0]
+        if code == 2:
+            tags[tag] = data[pos:pos + count]
+        else:
+            tags[tag] = list(struct.unpack_from(f"<{count}{fmt}", data, pos))
+    return tags
+
+
+def grid(lat, lon):
+    rng = np.random.default_rng(0)
+    vals = rng.normal(size=(len(lat), len(lon))).astype(np.float32)
+    vals[1, 2] = np.nan
+    return xr.DataArray(vals, coords={"lat": lat, "lon": lon}, dims=("lat", "lon"))
+
+
+def test_geotiff_round_trip():
+    # latitude ascending (south to north), so the writer has to flip the rows; 7 rows in strips of 3
+    lat = -40 + 0.25 * np.arange(7)
+    lon = 130 + 0.25 * np.arange(5)
+    da = grid(lat, lon)
+    data = b"".join(geotiff_stream(da, rows_per_strip=3))
+    tags = read_ifd(data)
+
+    assert tags[256] == [5] and tags[257] == [7]
+    assert tags[258] == [32] and tags[339] == [3]
+    # pixel scale, and the tiepoint at the top-left (north-west) corner of the grid
+    assert np.allclose(tags[33550], [0.25, 0.25, 0.])
+    assert np.allclose(tags[33922], [0., 0., 0., 130 - 0.125, lat[-1] + 0.125, 0.])
+    # geographic WGS84
+    assert tags[34735][-4:] == [2048, 0, 1, 4326]
+    assert tags[42113] == b"nan\0"
+
+    # the strips, read back, are the grid from north to south
+    assert len(tags[273]) == 3 and tags[278] == [3]
+    strips = b"".join(data[o:o + n] for o, n in zip(tags[273], tags[279]))
+    vals = np.frombuffer(strips, dtype="<f4").reshape(7, 5)
+    np.testing.assert_array_equal(vals, da.values[::-1])
+
+
+def test_geotiff_north_to_south():
+    # latitude already descending: rows are written as they are
+    lat = -10 - 0.5 * np.arange(4)
+    lon = 140 + 0.5 * np.arange(3)
+    da = grid(lat, lon)
+    data = b"".join(geotiff_stream(da))
+    tags = read_ifd(data)
+
+    assert np.allclose(tags[33922][3:5], [140 - 0.25, -10 + 0.25])
+    vals = np.frombuffer(data[tags[273][0]:tags[273][0] + tags[279][0]], dtype="<f4").reshape(4, 3)
+    np.testing.assert_array_equal(vals, da.values)
+
+
+# a 6 x 8 grid at 1 degree with two sea cells in the middle of the polygon below
+def land_grid():
+    lat = -30. + np.arange(6)
+    lon = 120. + np.arange(8)
+    mask = np.ones((6, 8), dtype=bool)
+    mask[2, 3] = mask[0, 0] = False
+    return land_cells(xr.DataArray(mask, coords={"lat": lat, "lon": lon}, dims=("lat", "lon")))
+
+
+def test_polygon_selects_packed_cells(tmp_path):
+    cells = land_grid()
+    # lat -29.5..-26.5, lon 121.5..124.5: grid rows 1-3 and columns 2-4, less the sea cell at (2, 3)
+    path = tmp_path / "region.geojson"
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {}, "geometry": box(121.5, -29.5, 124.5, -26.5).__geo_interface__}]}))
+    inside = np.flatnonzero(points_inside(cells.lat, cells.lon, read_geojson(path)))
+
+    rows, cols = np.meshgrid(np.arange(1, 4), np.arange(2, 5), indexing="ij")
+    flat = (rows * 8 + cols).ravel()
+    expected = np.sort(cells.lookup[flat[flat != 2 * 8 + 3]])
+    assert (expected >= 0).all()
+    np.testing.assert_array_equal(inside, expected)
+    assert np.allclose(cells.lat[inside], -28, atol=1) and np.allclose(cells.lon[inside], 123, atol=1)
+
+
+def test_polygon_edge_is_inside():
+    # cell centres on the boundary count as inside
+    cells = land_grid()
+    inside = points_inside(cells.lat, cells.lon, box(125, -29, 126, -28))
+    assert inside.sum() == 4
+
+
+def test_region_index_never_unassigned():
+    cells = land_grid()
+    # two states covering the western half, with a gap at lon 123 and the east left uncovered
+    states = [box(119.5, -30.5, 122.5, -27.5), box(119.5, -27.5, 122.5, -24.5)]
+    index = region_index(cells.lat, cells.lon, states)
+
+    assert len(index) == len(cells.lat) and (index >= 0).all()
+    west = cells.lon <= 122
+    assert (index[west & (cells.lat < -27.5)] == 0).all()
+    assert (index[west & (cells.lat > -27.5)] == 1).all()
+    # cells beyond every state fall back to the nearest one
+    east = cells.lon >= 123
+    assert (index[east & (cells.lat <= -28)] == 0).all() and (index[east & (cells.lat >= -27)] == 1).all()
@@ -0,0 +1,89 @@
+"""Per-cell trends of annual values, and seasonal cycles of monthly climatologies."""
+import math
+
+import numpy as np
+
+from apic_surfaces import CELL_BLOCK, seasonal_cycle, trend_fits
+
+
+# OLS and Theil-Sen slopes and the Mann-Kendall z score and p value of one cell, over its valid years
+def reference_trend(years, vals):
+    ok = np.isfinite(vals)
+    t, v = years[ok], vals[ok]
+    n = len(t)
+    if n < 3:
+        return np.nan, np.nan, np.nan, np.nan, n
+    ols = np.polyfit(t, v, 1)[0]
+    pairs = [(k, m) for k in range(n) for m in range(k + 1, n)]
+    sen = np.median([(v[m] - v[k]) / (t[m] - t[k]) for k, m in pairs])
+    s = sum(np.sign(v[m] - v[k]) for k, m in pairs)
+    z = (s - np.sign(s)) / math.sqrt(n * (n - 1) * (2 * n + 5) / 18)
+    return ols, sen, z, math.erfc(abs(z) / math.sqrt(2)), n
+
+
+def test_trends_against_reference():
+    rng = np.random.default_rng(3)
+    years = np.arange(1990, 2020)
+    # more cells than one block, with trends of either sign
+    ncell = CELL_BLOCK // 8 + 40
+    vals = rng.normal(size=(len(years), ncell)) + rng.normal(0, 0.1, ncell) * (years[:, None] - 2005)
+    # scattered gaps, a cell with no data, one with too few years and one with a single gap
+    vals[rng.random(vals.shape) < 0.1] = np.nan
+    vals[:, 3] = np.nan
+    vals[2:, 7] = np.nan
+    vals[:, 9] = rng.normal(size=len(years))
+    vals[12, 9] = np.nan
+    out = trend_fits(years, vals)
+
+    ref = np.array([reference_trend(years.astype(np.float64), vals[:, c]) for c in range(ncell)])
+    np.testing.assert_allclose(out.ols_slope.values, ref[:, 0], rtol=1e-8, atol=1e-12)
+    np.testing.assert_allclose(out.sen_slope.values, ref[:, 1], rtol=1e-12)
+    np.testing.assert_allclose(out.mk_z.values, ref[:, 2], rtol=1e-12)
+    np.testing.assert_allclose(out.mk_p.values, ref[:, 3], rtol=1e-12)
+    np.testing.assert_array_equal(out.n.values, ref[:, 4])
+    assert out.n.values[3] == 0 and np.isnan(out.sen_slope.values[3]) and np.isnan(out.mk_p.values[3])
+    assert np.isnan(out.ols_slope.values[7])
+
+
+def test_trend_of_a_line():
+    years = np.arange(2000, 2010)
+    out = trend_fits(years, 0.5 * (years[:, None] - 2000.) + np.zeros((1, 2)))
+    np.testing.assert_allclose(out.ols_slope.values, 0.5)
+    np.testing.assert_allclose(out.sen_slope.values, 0.5)
+    # every pair increases: S = n(n-1)/2
+    np.testing.assert_allclose(out.mk_z.values, (45 - 1) / math.sqrt(10 * 9 * 25 / 18))
+
+
+# (12, cell) climatologies: a cosine of peak-to-trough amplitude `amp` peaking at (fractional) month `peak`
+def cosine(peak, amp, mean=-30.):
+    t = np.arange(12)
+    return mean + amp / 2 * np.cos(2 * np.pi * (t - (peak - 1)) / 12)
+
+
+def test_harmonic_of_a_cosine():
+    out = seasonal_cycle(np.stack([cosine(4.5, 6.), cosine(1, 2.), cosine(12, 4.)], axis=1))
+    harm = out.sel(fit="harmonic")
+    # the trough is half a year after the peak, wrapping round to the start of the year
+    np.testing.assert_allclose(harm.depleted_month.values, [10.5, 7., 6.])
+    np.testing.assert_allclose(harm.amplitude.values, [6., 2., 4.])
+    np.testing.assert_allclose(out.harmonic_r2.values, 1.)
+
+
+def test_monthly_range():
+    clim = cosine(4.5, 6.)[:, None]
+    out = seasonal_cycle(clim).sel(fit="range")
+    # the lowest months are October and November, equally: the first is taken
+    assert out.depleted_month.item() == 10.
+    np.testing.assert_allclose(out.amplitude.item(), clim.max() - clim.min())
+
+
+def test_missing_months():
+    clim = np.stack([cosine(3, 5.), cosine(3, 5.), np.full(12, np.nan), np.full(12, -20.)], axis=1)
+    clim[6, 1] = np.nan
+    out = seasonal_cycle(clim)
+    # a missing month rules out the harmonic fit but not the range
+    assert np.isnan(out.amplitude.sel(fit="harmonic").values[1:3]).all()
+    assert np.isfinite(out.amplitude.sel(fit="range").values[1])
+    assert np.isnan(out.amplitude.sel(fit="range").values[2])
+    # no seasonal cycle at all: no amplitude, and nothing for the harmonic to explain
+    assert abs(out.amplitude.sel(fit="harmonic").values[3]) < 1e-12 and np.isnan(out.harmonic_r2.values[3])